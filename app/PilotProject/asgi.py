@@ -2,6 +2,7 @@
 ASGI config for PilotProject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+It's served by gunicorn with uvicorn workers, see gunicorn.conf.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -9,8 +10,12 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "PilotProject.settings")
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from api_basics.asgi import ASGIHandler  # noqa: E402 - needs configured django
+
+application = ASGIHandler()
@@ -0,0 +1,14 @@
+"""URL configuration of ASGI deployment (PilotProject.asgi). Wallets list, details, history and CSV export are
+served by async views of api_basics.asgi, everything else by the same views as under WSGI."""
+from api_basics import asgi
+from django.urls import include, path, re_path
+
+urlpatterns = [
+    path("api/wallets/", asgi.wallet_list),
+    re_path(r"^api/wallets/(?P<name>[^/.]+)/$", asgi.wallet_detail),
+    re_path(r"^api/wallets/(?P<name>[^/.]+)/history/$", asgi.wallet_history),
+    re_path(
+        r"^api/wallets/(?P<name>[^/.]+)/export_history/$", asgi.wallet_export_history
+    ),
+    path("", include("PilotProject.urls")),
+]
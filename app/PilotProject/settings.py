@@ -15,6 +15,7 @@ from datetime import timedelta
 from pathlib import Path
 
 import sentry_sdk
+from api_basics.sampling import TracesSampler
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 from celery.schedules import crontab
@@ -63,6 +64,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api_basics.middleware.TraceSamplingMiddleware",
+    "api_basics.middleware.MetricsMiddleware",
+    "api_basics.middleware.QueryStatsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -122,6 +126,61 @@ DATABASES = {
     }
 }
 
+# read replicas of the default database: comma-separated hosts, or file names for sqlite. Read-only actions and
+# reporting reads go to them, see api_basics.routers
+DATABASE_REPLICAS = []
+replica_location_key = "NAME" if "sqlite3" in DATABASES["default"]["ENGINE"] else "HOST"
+for number, location in enumerate(
+    filter(None, os.environ.get("SQL_REPLICAS", "").split(","))
+):
+    alias = "replica_{}".format(number)
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        replica_location_key: location,
+        # tests read replicas through the connection of the test default database
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(alias)
+# databases that wallets and their transactions are split across by holder, see api_basics.sharding: "default"
+# and one more database per comma-separated host, or file name for sqlite, in SQL_SHARDS
+WALLET_SHARDS = ["default"]
+for number, location in enumerate(
+    filter(None, os.environ.get("SQL_SHARDS", "").split(",")), start=1
+):
+    alias = "shard_{}".format(number)
+    DATABASES[alias] = {**DATABASES["default"], replica_location_key: location}
+    WALLET_SHARDS.append(alias)
+DATABASE_ROUTERS = [
+    "api_basics.sharding.ShardRouter",
+    "api_basics.routers.ReplicaRouter",
+]
+# cross-shard transfers left unfinished by a crashed process for that many seconds are finished by a celery task
+SHARD_TRANSFERS_RECOVER_AFTER = timedelta(
+    seconds=int(os.environ.get("SHARD_TRANSFERS_RECOVER_AFTER", default=60))
+)
+# reads of a user go to the primary for that many seconds after their write
+DATABASE_REPLICA_PIN_SECONDS = int(
+    os.environ.get("DATABASE_REPLICA_PIN_SECONDS", default=5)
+)
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    }
+}
+
+# per-endpoint query count and DB time, see api_basics.middleware
+QUERY_STATS_ENABLED = bool(int(os.environ.get("QUERY_STATS_ENABLED", default=1)))
+
+# read-through wallet cache, see api_basics.cache
+WALLET_CACHE_ENABLED = bool(int(os.environ.get("WALLET_CACHE_ENABLED", default=1)))
+WALLET_CACHE_ALIAS = "default"
+WALLET_CACHE_TIMEOUT = 300
+WALLET_CACHE_LRU_SIZE = 10000
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -206,13 +265,113 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": crontab(
             minute=os.environ.get("WALLETS_TRANSACTIONS_REPORT_GENERATION_MINUTES")
         ),
-    }
+    },
+    "wallet_events": {
+        "task": "api_basics.tasks.publish_wallet_events",
+        "schedule": float(os.environ.get("WALLET_EVENTS_PUBLISH_SECONDS", default=5)),
+    },
+    "idempotency_keys": {
+        "task": "api_basics.tasks.purge_idempotency_keys",
+        "schedule": crontab(minute="30"),
+    },
+    "reconciliation": {
+        "task": "api_basics.tasks.reconcile_ledger",
+        "schedule": crontab(
+            minute=os.environ.get("LEDGER_RECONCILIATION_MINUTES", default="0")
+        ),
+    },
+    "archive": {
+        "task": "api_basics.tasks.archive_transactions",
+        "schedule": crontab(minute="45", hour="3"),
+    },
+    "shard_transfers": {
+        "task": "api_basics.tasks.recover_shard_transfers",
+        "schedule": crontab(),
+    },
+    "balance_slots": {
+        "task": "api_basics.tasks.fold_balance_slots",
+        "schedule": float(os.environ.get("HOT_WALLETS_FOLD_SECONDS", default=60)),
+    },
+    "transfer_queue": {
+        "task": "api_basics.tasks.execute_queued_transfers",
+        "schedule": float(os.environ.get("TRANSFER_QUEUE_EXECUTE_SECONDS", default=1)),
+    },
 }
 
+# number of subtasks that process transactions of different wallets in one report generation run
+WALLETS_TRANSACTIONS_REPORT_SHARDS = int(
+    os.environ.get("WALLETS_TRANSACTIONS_REPORT_SHARDS", default=8)
+)
+
+# number of wallet ids reconciled by one subtask of ledger reconciliation
+LEDGER_RECONCILIATION_CHUNK_SIZE = int(
+    os.environ.get("LEDGER_RECONCILIATION_CHUNK_SIZE", default=10000)
+)
+
+# wallet events outbox relay, see api_basics.events
+WALLET_EVENTS_BROKER_URL = os.environ.get(
+    "WALLET_EVENTS_BROKER_URL", default=CELERY_BROKER_URL
+)
+WALLET_EVENTS_EXCHANGE = "wallet_events"
+WALLET_EVENTS_BATCH_SIZE = int(os.environ.get("WALLET_EVENTS_BATCH_SIZE", default=500))
+# limit of batches published by one run of the celery task, so it doesn't occupy a worker for too long
+WALLET_EVENTS_MAX_BATCHES = 100
+
+# transactions older than that are moved from the hot table to the archive, in batches of that many rows
+TRANSACTIONS_ARCHIVE_AFTER = timedelta(
+    days=int(os.environ.get("TRANSACTIONS_ARCHIVE_AFTER_DAYS", default=365))
+)
+TRANSACTIONS_ARCHIVE_BATCH_SIZE = int(
+    os.environ.get("TRANSACTIONS_ARCHIVE_BATCH_SIZE", default=10000)
+)
+
+# ASGI deployment (PilotProject.asgi): size of the thread pool that async views run ORM work in, which is also the
+# number of database connections per process, and number of parts of a streaming response sent per call of the pool
+ASGI_ORM_THREADS = int(os.environ.get("ASGI_ORM_THREADS", default=8))
+ASGI_STREAM_CHUNK_PARTS = int(os.environ.get("ASGI_STREAM_CHUNK_PARTS", default=500))
+
+# 'make_transfer' only queues transfers and responds with 202, they are applied in batches of that many transfers
+# per database transaction, see api_basics.models.QueuedTransfer
+TRANSFER_QUEUE_ENABLED = bool(int(os.environ.get("TRANSFER_QUEUE_ENABLED", default=0)))
+TRANSFER_QUEUE_BATCH_SIZE = int(
+    os.environ.get("TRANSFER_QUEUE_BATCH_SIZE", default=200)
+)
+# limit of batches applied by one run of the celery task, so it doesn't occupy a worker for too long
+TRANSFER_QUEUE_MAX_BATCHES = 50
+
+# how long responses of requests with 'Idempotency-Key' header are kept for replaying
+IDEMPOTENCY_KEYS_TTL = timedelta(
+    hours=int(os.environ.get("IDEMPOTENCY_KEYS_TTL_HOURS", default=24))
+)
+
+
+# Sentry performance tracing, see api_basics.sampling.TracesSampler
+SENTRY_TRACES_SAMPLING = {
+    "default_rate": float(os.environ.get("SENTRY_TRACES_DEFAULT_RATE", default=0.05)),
+    "rates": {
+        "WalletViewSet.list": 0.01,
+        "WalletViewSet.retrieve": 0.01,
+        "WalletViewSet.balance": 0.01,
+        "WalletViewSet.make_deposit": 0.1,
+        "WalletViewSet.make_transfer": 0.1,
+        "WalletViewSet.make_transfers": 0.1,
+    },
+    # endpoints whose errors and responses slower than given number of seconds are always traced
+    "tail": {
+        "WalletViewSet.make_deposit": 0.5,
+        "WalletViewSet.make_transfer": float(
+            os.environ.get("SENTRY_SLOW_TRANSFER_SECONDS", default=0.5)
+        ),
+        "WalletViewSet.make_transfers": 2.0,
+    },
+    "budget_per_second": float(
+        os.environ.get("SENTRY_TRACES_BUDGET_PER_SECOND", default=10)
+    ),
+}
 
 sentry_sdk.init(
     dsn=os.environ.get("SENTRY_DSN"),
     integrations=[DjangoIntegration()],
-    traces_sample_rate=1.0,
+    traces_sampler=TracesSampler(**SENTRY_TRACES_SAMPLING),
     send_default_pii=True,
 )
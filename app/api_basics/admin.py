@@ -1,8 +1,32 @@
 from django.contrib import admin
 
-from .models import TransactionReport, TransactionV2, Wallet
+from .models import (
+    ArchivedTransaction,
+    LedgerImport,
+    QueuedTransfer,
+    ShardTransfer,
+    TransactionReport,
+    TransactionV2,
+    Wallet,
+    WalletArchiveCheckpoint,
+    WalletBalanceSlot,
+    WalletBalanceSnapshot,
+    WalletDirectory,
+    WalletEvent,
+    WalletReconciliation,
+)
 
 # Register your models here.
 admin.site.register(Wallet)
 admin.site.register(TransactionV2)
 admin.site.register(TransactionReport)
+admin.site.register(WalletReconciliation)
+admin.site.register(WalletEvent)
+admin.site.register(LedgerImport)
+admin.site.register(ArchivedTransaction)
+admin.site.register(WalletArchiveCheckpoint)
+admin.site.register(WalletDirectory)
+admin.site.register(ShardTransfer)
+admin.site.register(WalletBalanceSlot)
+admin.site.register(WalletBalanceSnapshot)
+admin.site.register(QueuedTransfer)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ApiBasicsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api_basics"
+
+    def ready(self):
+        # connects celery signal handlers that collect task metrics
+        from . import metrics  # noqa: F401
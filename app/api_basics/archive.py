@@ -0,0 +1,73 @@
+from heapq import merge
+from itertools import islice
+
+
+class MergedHistory:
+    """Transactions of a wallet from the hot TransactionV2 table and from ArchivedTransaction read as one sequence in
+    'order_by_key' ordering. Supports the part of TransactionV2QuerySet API that history pagination and CSV export
+    use: 'order_by_key', 'after_key', 'iterator_by_key', 'count' and slicing.
+
+    'archived_until' is the timestamp of the latest archived transaction of the wallet. When the newest first page is
+    filled by hot rows that are all newer than that, the archive isn't queried at all."""
+
+    ordered = True
+
+    def __init__(self, hot, archived, archived_until, ordering="-timestamp"):
+        self.hot = hot
+        self.archived = archived
+        self.archived_until = archived_until
+        self.ordering = ordering
+
+    def order_by_key(self, ordering="-timestamp"):
+        return MergedHistory(
+            self.hot.order_by_key(ordering),
+            self.archived.order_by_key(ordering),
+            self.archived_until,
+            ordering,
+        )
+
+    def after_key(self, timestamp, pk, ordering="-timestamp"):
+        return MergedHistory(
+            self.hot.after_key(timestamp, pk, ordering),
+            self.archived.after_key(timestamp, pk, ordering),
+            self.archived_until,
+            ordering,
+        )
+
+    def count(self):
+        return self.hot.count() + self.archived.count()
+
+    def iterator_by_key(self, ordering="-timestamp", chunk_size=2000):
+        return self._merge(
+            self.hot.iterator_by_key(ordering, chunk_size),
+            self.archived.iterator_by_key(ordering, chunk_size),
+            ordering,
+        )
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError("MergedHistory supports only slices without step")
+        start, stop = item.start or 0, item.stop
+        if stop is None:
+            rows = self.iterator_by_key(self.ordering)
+        else:
+            hot = list(self.hot.order_by_key(self.ordering)[:stop])
+            if (
+                self.ordering.startswith("-")
+                and len(hot) == stop
+                and hot[-1].timestamp > self.archived_until
+            ):
+                return hot[start:stop]
+            rows = self._merge(
+                hot, self.archived.order_by_key(self.ordering)[:stop], self.ordering
+            )
+        return list(islice(rows, start, stop))
+
+    @staticmethod
+    def _merge(hot, archived, ordering):
+        return merge(
+            hot,
+            archived,
+            key=lambda row: (row.timestamp, row.id),
+            reverse=ordering.startswith("-"),
+        )
@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.db import DatabaseError, connections
+from django.http import StreamingHttpResponse
+
+from .middleware import current_query_recorder
+from .views import WalletViewSet
+
+_orm_executor = None
+
+
+def orm_executor():
+    global _orm_executor
+    if _orm_executor is None:
+        _orm_executor = ThreadPoolExecutor(
+            max_workers=settings.ASGI_ORM_THREADS, thread_name_prefix="orm"
+        )
+    return _orm_executor
+
+
+async def run_orm(func, *args, **kwargs):
+    """Runs sync 'func', which may use the ORM, in the pool of ASGI_ORM_THREADS threads and waits for it without
+    blocking the event loop. Work beyond the size of the pool waits for a free thread, so the pool bounds the number
+    of database connections of a process: every thread keeps its own connection to each database it used, until a
+    database error. With ASGI_ORM_THREADS=0 'func' runs in the single thread that Django runs sync code in under
+    ASGI, which tests need to see data of their database transaction."""
+    if settings.ASGI_ORM_THREADS:
+        run = sync_to_async(
+            _run_pooled, thread_sensitive=False, executor=orm_executor()
+        )
+    else:
+        run = sync_to_async(_run_recorded)
+    return await run(func, *args, **kwargs)
+
+
+def _run_pooled(func, *args, **kwargs):
+    try:
+        return _run_recorded(func, *args, **kwargs)
+    except DatabaseError:
+        # the connection may be broken, the next call in this thread connects again
+        connections.close_all()
+        raise
+
+
+def _run_recorded(func, *args, **kwargs):
+    """Runs 'func' recording its queries to QueryRecorder of the current request, see QueryStatsMiddleware."""
+    recorder = current_query_recorder.get()
+    with ExitStack() as stack:
+        if recorder is not None:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+        return func(*args, **kwargs)
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """Async version of 'streaming_response' for ASGIHandler: its content is pulled from the iterator of the original
+    response by 'run_orm' in chunks of ASGI_STREAM_CHUNK_PARTS parts, so a slow client holds only its connection
+    while it reads, not a thread and a database connection."""
+
+    def __init__(self, streaming_response):
+        super().__init__(
+            status=streaming_response.status_code,
+            headers=streaming_response.headers,
+        )
+        self.cookies = streaming_response.cookies
+        self._parts = iter(streaming_response)
+        self._resource_closers.append(streaming_response.close)
+
+    async def __aiter__(self):
+        while True:
+            parts = await run_orm(
+                _next_parts, self._parts, settings.ASGI_STREAM_CHUNK_PARTS
+            )
+            if not parts:
+                return
+            yield b"".join(parts)
+
+
+def _next_parts(iterator, count):
+    parts = []
+    for part in iterator:
+        parts.append(part)
+        if len(parts) == count:
+            break
+    return parts
+
+
+class ASGIHandler(DjangoASGIHandler):
+    """ASGI handler of PilotProject.asgi. Requests are resolved with PilotProject.asgi_urls, which serves read
+    endpoints of wallets with async views, and AsyncStreamingHttpResponse is sent by 'async for', as Django itself
+    iterates streaming responses synchronously."""
+
+    urlconf = "PilotProject.asgi_urls"
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = self.urlconf
+        return request, error_response
+
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            await super().send_response(response, send)
+            return
+        headers = [
+            (header.encode("ascii"), value.encode("latin1"))
+            for header, value in response.items()
+        ] + [
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        ]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+        async for part in response:
+            for chunk, _ in self.chunk_bytes(part):
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def async_view(actions):
+    """Async view of 'actions' of WalletViewSet. Authentication, permissions, queries and rendering of the response
+    run in one 'run_orm' call, while the event loop serves other connections. A streaming response is turned into
+    AsyncStreamingHttpResponse."""
+    view = WalletViewSet.as_view(actions)
+
+    async def async_wallet_view(request, *args, **kwargs):
+        response = await run_orm(_render, view, request, *args, **kwargs)
+        if response.streaming:
+            return AsyncStreamingHttpResponse(response)
+        return response
+
+    # attributes of the DRF view that middleware rely on: no CSRF check, and endpoint name (see endpoint_name)
+    async_wallet_view.csrf_exempt = True
+    async_wallet_view.cls = view.cls
+    async_wallet_view.actions = view.actions
+    return async_wallet_view
+
+
+def _render(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if not response.streaming and hasattr(response, "render"):
+        # serialization to JSON or CSV happens here, Django would render the response in its single sync thread
+        response.render()
+    return response
+
+
+wallet_list = async_view({"get": "list", "post": "create"})
+wallet_detail = async_view({"get": "retrieve"})
+wallet_history = async_view({"get": "history"})
+wallet_export_history = async_view({"get": "export_history"})
@@ -0,0 +1,200 @@
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import sharding
+
+
+class WalletCache:
+    """Read-through cache of wallets by name and id: a per-process LRU in front of a shared django cache backend.
+
+    Every wallet has a version token in the shared backend, cached data is stored under the current token. Writers
+    replace the token (see 'invalidate'), which makes all copies of the previous data unreachable both in the shared
+    backend and in LRUs of all processes. A reader that loaded data from the database before the token was replaced
+    stores it under the old token, so it can't resurrect a stale balance either. For the same reason wallets are
+    always loaded from the primary database, never from a replica that may lag behind the token (see
+    sharding.load_wallets)."""
+
+    def __init__(self):
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return settings.WALLET_CACHE_ENABLED
+
+    @property
+    def backend(self):
+        return caches[settings.WALLET_CACHE_ALIAS]
+
+    def get_by_name(self, name):
+        """Returns unsaved-looking but complete Wallet instance with given name, or None if it doesn't exist."""
+        return self.get_many_by_name([name]).get(name)
+
+    def get_many_by_name(self, names):
+        """Returns dict of Wallet instances by name for those of given names that exist. Wallets that are not cached
+        are loaded by one query, whatever their number is.
+
+        A version token is always read before the data it guards is loaded from the database. So wallets whose id
+        is not known yet are loaded, but only their name is cached - their data gets cached on the next lookup."""
+        names = set(names)
+        if not self.enabled:
+            return {
+                wallet.name: wallet for wallet in sharding.load_wallets(name__in=names)
+            }
+        cached_ids = self.backend.get_many([self._name_key(name) for name in names])
+        ids = {name: cached_ids.get(self._name_key(name)) for name in names}
+        versions = {
+            wallet_id: self._version(wallet_id)
+            for wallet_id in ids.values()
+            if wallet_id is not None
+        }
+        wallets = {}
+        for name, wallet_id in ids.items():
+            if wallet_id is not None:
+                wallet = self._cached(wallet_id, versions[wallet_id])
+                if wallet is not None and wallet.name == name:
+                    wallets[name] = wallet
+        missing = names - wallets.keys()
+        if missing:
+            self.misses += len(missing)
+            for wallet in sharding.load_wallets(name__in=missing):
+                wallets[wallet.name] = wallet
+                if (
+                    versions.get(wallet.id) is not None
+                    and ids[wallet.name] == wallet.id
+                ):
+                    self._store(wallet, versions[wallet.id])
+                else:
+                    self.backend.set(
+                        self._name_key(wallet.name),
+                        wallet.id,
+                        settings.WALLET_CACHE_TIMEOUT,
+                    )
+        return wallets
+
+    def get_by_id(self, wallet_id):
+        """Returns Wallet instance with given id, or None if it doesn't exist."""
+        if not self.enabled:
+            return next(iter(sharding.load_wallets(id=wallet_id)), None)
+        version = self._version(wallet_id)
+        wallet = self._cached(wallet_id, version)
+        if wallet is not None:
+            return wallet
+        self.misses += 1
+        wallet = next(iter(sharding.load_wallets(id=wallet_id)), None)
+        if wallet is not None:
+            self._store(wallet, version)
+        return wallet
+
+    def invalidate(self, wallet_ids):
+        """Replaces version tokens of wallets, so their cached data is never served again. Called right away by
+        code that changes wallets, and again from 'on_commit' hook: readers between the two calls can only cache
+        pre-commit data under the intermediate token."""
+        if not self.enabled:
+            return
+        self.backend.set_many(
+            {self._version_key(wallet_id): uuid4().hex for wallet_id in wallet_ids},
+            settings.WALLET_CACHE_TIMEOUT,
+        )
+
+    def invalidate_on_commit(self, wallet_ids):
+        wallet_ids = list(wallet_ids)
+        self.invalidate(wallet_ids)
+        sharding.on_commit(lambda: self.invalidate(wallet_ids))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "lru_size": len(self.lru),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def _cached(self, wallet_id, version):
+        with self.lock:
+            cached = self.lru.get(wallet_id)
+            if cached is not None and cached[0] == version:
+                self.lru.move_to_end(wallet_id)
+                self.hits += 1
+                return self._instance(cached[1])
+        data = self.backend.get(self._data_key(wallet_id, version))
+        if data is not None:
+            self.shared_hits += 1
+            self._remember(wallet_id, version, data)
+            return self._instance(data)
+        return None
+
+    def _version(self, wallet_id):
+        version = self.backend.get(self._version_key(wallet_id))
+        if version is None:
+            self.backend.add(
+                self._version_key(wallet_id),
+                uuid4().hex,
+                settings.WALLET_CACHE_TIMEOUT,
+            )
+            version = self.backend.get(self._version_key(wallet_id))
+        return version
+
+    def _store(self, wallet, version):
+        data = {
+            "id": wallet.id,
+            "name": wallet.name,
+            "holder_id": wallet.holder_id,
+            "balance": wallet.balance,
+            "archived_until": wallet.archived_until,
+            "balance_slots": wallet.balance_slots,
+            "hot_since": wallet.hot_since,
+        }
+        self.backend.set(
+            self._data_key(wallet.id, version), data, settings.WALLET_CACHE_TIMEOUT
+        )
+        self._remember(wallet.id, version, data)
+
+    def _remember(self, wallet_id, version, data):
+        with self.lock:
+            self.lru[wallet_id] = (version, data)
+            self.lru.move_to_end(wallet_id)
+            while len(self.lru) > settings.WALLET_CACHE_LRU_SIZE:
+                self.lru.popitem(last=False)
+
+    @staticmethod
+    def _instance(data):
+        wallet = apps.get_model("api_basics", "Wallet")(**data)
+        wallet._state.adding = False
+        return wallet
+
+    @staticmethod
+    def _name_key(name):
+        return "wallet:name:{}".format(name)
+
+    @staticmethod
+    def _version_key(wallet_id):
+        return "wallet:version:{}".format(wallet_id)
+
+    @staticmethod
+    def _data_key(wallet_id, version):
+        return "wallet:{}:{}".format(wallet_id, version)
+
+
+wallet_cache = WalletCache()
+
+
+@receiver(post_save, sender="api_basics.Wallet")
+@receiver(post_delete, sender="api_basics.Wallet")
+def invalidate_saved_wallet(sender, instance, **kwargs):
+    wallet_cache.invalidate_on_commit([instance.id])
@@ -4,7 +4,16 @@ from api_basics.errors_exceptions import (
     RECIPIENT_IS_SENDER_ERROR,
     TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR,
 )
-from drf_spectacular.utils import OpenApiExample
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiExample, OpenApiParameter
+
+IDEMPOTENCY_KEY_PARAMETER = OpenApiParameter(
+    "Idempotency-Key",
+    type=OpenApiTypes.STR,
+    location=OpenApiParameter.HEADER,
+    description="Unique key of the request, up to 255 characters. Repeated requests with the same key return the "
+    "response of the first successful one without applying it again, with 'Idempotent-Replayed: true' header.",
+)
 
 CREATE_WALLET_REQUEST_EXAMPLE = OpenApiExample(
     "Valid request example",
@@ -67,6 +76,90 @@ RECIPIENT_DOESNT_EXIST_RESPONSE = OpenApiExample(
     status_codes=["400"],
 )
 
+QUEUED_TRANSFER_RESPONSE = OpenApiExample(
+    "Make Transfer response if transfers are queued (TRANSFER_QUEUE_ENABLED)",
+    description="The transfer is validated and queued, it's applied later. Its outcome is returned by GET "
+    "/api/wallets/{name}/transfers/{transfer_id}/ requests, 'Location' header has the URL.",
+    value={
+        "transfer_id": 42,
+        "recipient": "wallet_2",
+        "amount": "100.21",
+        "transaction_status": "pending",
+        "new_balance": None,
+        "errors": None,
+        "created_at": "2021-10-07T13:01:21.292678Z",
+        "processed_at": None,
+    },
+    response_only=True,
+    status_codes=["202"],
+)
+
+TRANSFER_STATUS_RESPONSE = OpenApiExample(
+    "Queued transfer status response example",
+    description="'transaction_status' is 'pending', 'success' or 'failed', 'new_balance' is balance of the sender "
+    "right after the transfer was processed.",
+    value={
+        "transfer_id": 42,
+        "recipient": "wallet_2",
+        "amount": "100.21",
+        "transaction_status": "failed",
+        "new_balance": "50.00",
+        "errors": {"amount": [INSUFFICIENT_FUNDS_ERROR]},
+        "created_at": "2021-10-07T13:01:21.292678Z",
+        "processed_at": "2021-10-07T13:01:21.512004Z",
+    },
+    response_only=True,
+    status_codes=["200"],
+)
+
+MAKE_TRANSFERS_REQUEST = OpenApiExample(
+    "Make Transfers request example",
+    description="'transfers' is a list of up to 1000 transfers with mandatory 'amount' and 'recipient' fields. "
+    "If 'all_or_nothing' is true, none of transfers is applied if at least one of them is invalid.",
+    value={
+        "transfers": [
+            {"amount": 100.21, "recipient": "wallet_2"},
+            {"amount": 20, "recipient": "wallet_3"},
+        ],
+        "all_or_nothing": False,
+    },
+    request_only=True,
+    status_codes=["200"],
+)
+
+MAKE_TRANSFERS_RESPONSE = OpenApiExample(
+    "Make Transfers response example",
+    description="Every transfer has its own result. If 'all_or_nothing' was true and some transfer failed, "
+    "response status is 400 and valid transfers have 'not_applied' status.",
+    value={
+        "transaction_status": "success",
+        "new_balance": "1779.11",
+        "results": [
+            {
+                "recipient": "wallet_2",
+                "amount": "100.21",
+                "transaction_status": "success",
+            },
+            {
+                "recipient": "wallet_3",
+                "amount": "20.00",
+                "transaction_status": "failed",
+                "errors": {"recipient": [RECIPIENT_DOESNT_EXIST_ERROR]},
+            },
+        ],
+    },
+    response_only=True,
+    status_codes=["200"],
+)
+
+GET_BALANCE_RESPONSE = OpenApiExample(
+    "Get Balance response example",
+    description="Balance of the wallet right after the last transaction made not later than 'at'.",
+    value={"name": "wallet_10", "at": "2021-10-07T13:00:00Z", "balance": "800.00"},
+    response_only=True,
+    status_codes=["200"],
+)
+
 history_csv_response_example = (
     "amount,balance_after,balance_before,id,recipient,sender,timestamp,transaction_type,wallet\n"
     "100.00,900.00,800.00,14,wallet_10,wallet_11,2021-10-07T13:01:21.292678Z,CRED,wallet_10\n"
@@ -26,3 +26,9 @@ INSUFFICIENT_FUNDS_ERROR = "Insufficient funds"
 RECIPIENT_IS_SENDER_ERROR = "Recipient cannot be sender"
 RECIPIENT_DOESNT_EXIST_ERROR = "Recipient with provided id doesn't exist"
 DATERANGE_BEFORE_AFTER_ERROR = "timestamp_before' is less then start date"
+IDEMPOTENCY_KEY_TOO_LONG_ERROR = "Idempotency-Key header is longer than 255 characters"
+IDEMPOTENCY_KEY_REUSED_ERROR = (
+    "Idempotency-Key was already used for a request with different parameters"
+)
+RECIPIENT_ON_ANOTHER_SHARD_ERROR = "Recipient is stored on another shard, transfers to it can't be batched, use 'make_transfer'"
+WALLET_NAME_TAKEN_ERROR = "wallet with this name already exists."
@@ -0,0 +1,54 @@
+from django.conf import settings
+from kombu import Connection, Exchange
+
+from . import sharding
+from .models import WalletEvent
+
+wallet_events_exchange = Exchange(
+    settings.WALLET_EVENTS_EXCHANGE, type="topic", durable=True
+)
+
+
+def publish_wallet_events(batch_size=None, max_batches=None):
+    """Drains WalletEvent outbox: publishes events to 'wallet_events' exchange with 'wallet.<event type>' routing key
+    and deletes them, one batch per database transaction. Batches are selected with SKIP LOCKED, so several relays can
+    drain the outbox in parallel. Delivery is at-least-once: if the transaction fails after publishing, the batch is
+    published again by the next run, so consumers should drop duplicates by 'event_id' of the payload, which is also
+    the message id. Events of a shard are published in the order they were written by a single relay, parallel relays
+    may publish events of the same wallet out of order.
+    Returns the number of published events."""
+    batch_size = batch_size or settings.WALLET_EVENTS_BATCH_SIZE
+    published = 0
+    batches = 0
+    with Connection(settings.WALLET_EVENTS_BROKER_URL) as connection:
+        producer = connection.Producer(serializer="json")
+        while max_batches is None or batches < max_batches:
+            with sharding.atomic():
+                events = list(
+                    WalletEvent.objects.select_for_update(skip_locked=True).order_by(
+                        "id"
+                    )[:batch_size]
+                )
+                for event in events:
+                    event_id = event_key(event)
+                    producer.publish(
+                        {"event_id": event_id, **event.payload},
+                        exchange=wallet_events_exchange,
+                        routing_key="wallet." + event.event_type,
+                        declare=[wallet_events_exchange],
+                        retry=True,
+                        message_id=event_id,
+                    )
+                WalletEvent.objects.filter(
+                    id__in=[event.id for event in events]
+                ).delete()
+            published += len(events)
+            batches += 1
+            if len(events) < batch_size:
+                break
+    return published
+
+
+def event_key(event):
+    """Id of 'event' unique across shards: ids of WalletEvent rows are only unique within their database."""
+    return "{}:{}".format(sharding.current_alias(), event.id)
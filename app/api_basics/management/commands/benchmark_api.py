@@ -0,0 +1,267 @@
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from api_basics.models import TransactionV2
+from api_basics.test.factory import HistoryFactory, WalletFactory
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.test.factory import UserFactory
+
+DEFAULT_MIX = "list=20,deposit=20,transfer=30,history=25,export=5"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test of the wallet API. Seeds users, wallets and their history with WalletFactory and "
+        "HistoryFactory, drives a mix of requests from a thread pool either through the DRF test client or against "
+        "a running server (--url, e.g. local gunicorn) and prints JSON with requests per second and p50/p95/p99 "
+        "latency per operation. Seeded users are deleted at the end unless --keep is given. The requests are "
+        "generated from --seed, so runs with the same options are comparable across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--wallets-per-user", type=int, default=2)
+        parser.add_argument("--history", type=int, default=50, help="rows per wallet")
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument(
+            "--mix",
+            default=DEFAULT_MIX,
+            help="weights of operations, default: {}".format(DEFAULT_MIX),
+        )
+        parser.add_argument("--url", help="base URL of a running server")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--keep", action="store_true")
+        parser.add_argument("--output", help="file to write JSON results to")
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options["mix"])
+        if connection.vendor == "sqlite" and options["workers"] > 1:
+            self.stderr.write(
+                "sqlite allows one writer at a time, concurrent deposits and transfers will fail with "
+                "'database is locked' errors that are counted as OperationalError failures"
+            )
+        prefix = "benchmark_api_{}_".format(options["seed"])
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(
+                "Users of a previous run with --seed {} exist, delete them or use another seed".format(
+                    options["seed"]
+                )
+            )
+        try:
+            seed_start = time.perf_counter()
+            wallets = self.seed(
+                prefix,
+                options["users"],
+                options["wallets_per_user"],
+                options["history"],
+            )
+            seed_duration = time.perf_counter() - seed_start
+            plan = self.plan(wallets, mix, options["requests"], options["seed"])
+            results = self.run(plan, options["workers"], options["url"])
+        finally:
+            if not options["keep"]:
+                User.objects.filter(username__startswith=prefix).delete()
+        results = {
+            "database": connection.vendor,
+            "target": options["url"] or "test_client",
+            "workers": options["workers"],
+            "users": options["users"],
+            "wallets": len(wallets),
+            "history_rows": len(wallets) * options["history"],
+            "seed": options["seed"],
+            "seed_seconds": round(seed_duration, 3),
+            **results,
+        }
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        self.stdout.write(output)
+
+    @staticmethod
+    def parse_mix(mix):
+        operations = {}
+        for item in mix.split(","):
+            operation, _, weight = item.partition("=")
+            if operation not in OPERATIONS or not weight.isdigit():
+                raise CommandError(
+                    "Invalid --mix item '{}', operations are: {}".format(
+                        item, ", ".join(OPERATIONS)
+                    )
+                )
+            operations[operation] = int(weight)
+        return operations
+
+    @staticmethod
+    def seed(prefix, users, wallets_per_user, history):
+        """Returns list of (wallet name, user token) of seeded wallets. Every wallet gets 'history' deposits of 10.00,
+        so it has enough money for transfers of the benchmark."""
+        wallets = []
+        for user_number in range(users):
+            user = UserFactory.create(username="{}{}".format(prefix, user_number))
+            token = str(RefreshToken.for_user(user).access_token)
+            for wallet_number in range(wallets_per_user):
+                wallet = WalletFactory.create(
+                    holder=user,
+                    name="{}{}_{}".format(prefix, user_number, wallet_number),
+                    balance=Decimal(10 * history),
+                )
+                TransactionV2.objects.bulk_create(
+                    HistoryFactory.build(
+                        wallet=wallet,
+                        sender=None,
+                        recipient=wallet,
+                        amount=Decimal(10),
+                        transaction_type=TransactionV2.CREDIT,
+                        balance_before=Decimal(10 * i),
+                        balance_after=Decimal(10 * (i + 1)),
+                    )
+                    for i in range(history)
+                )
+                wallets.append((wallet.name, token))
+        return wallets
+
+    @staticmethod
+    def plan(wallets, mix, requests, seed):
+        """Returns list of (operation, wallet name, token, other wallet name) to run."""
+        rng = random.Random(seed)
+        operations = rng.choices(list(mix), weights=list(mix.values()), k=requests)
+        plan = []
+        for operation in operations:
+            name, token = rng.choice(wallets)
+            other = rng.choice([wallet for wallet, _ in wallets if wallet != name])
+            plan.append((operation, name, token, other))
+        return plan
+
+    def run(self, plan, workers, url):
+        local = threading.local()
+
+        def send(method, path, token, data=None):
+            if url:
+                return send_http(url, method, path, token, data)
+            if not hasattr(local, "client"):
+                host = settings.ALLOWED_HOSTS[0].lstrip(".").replace("*", "localhost")
+                local.client = APIClient(SERVER_NAME=host)
+            local.client.credentials(HTTP_AUTHORIZATION="Bearer " + token)
+            # history returns its paginated JSON only to this header, CSV otherwise
+            if method == "GET":
+                response = local.client.get(path, data, HTTP_ACCEPT="application/json")
+            else:
+                response = local.client.post(
+                    path, data, format="json", HTTP_ACCEPT="application/json"
+                )
+            if response.streaming:
+                b"".join(response.streaming_content)
+            return response.status_code
+
+        def execute(item):
+            operation, name, token, other = item
+            start = time.perf_counter()
+            try:
+                status = OPERATIONS[operation](send, name, token, other)
+            except Exception as error:
+                status = type(error).__name__
+            finally:
+                if not url:
+                    # the test client doesn't do it, while a server does at the end of every request
+                    close_old_connections()
+            return operation, status, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(execute, plan))
+        duration = time.perf_counter() - start
+
+        operations = {}
+        for operation, status, latency in outcomes:
+            stats = operations.setdefault(
+                operation,
+                {"requests": 0, "errors": 0, "failures": {}, "latencies": []},
+            )
+            stats["requests"] += 1
+            # failures are counted by status code or by exception raised in the test client
+            if not isinstance(status, int) or status >= 400:
+                stats["errors"] += 1
+                stats["failures"][str(status)] = (
+                    stats["failures"].get(str(status), 0) + 1
+                )
+            stats["latencies"].append(latency * 1000)
+        for stats in operations.values():
+            stats.update(percentiles(stats.pop("latencies")))
+        return {
+            "requests": len(outcomes),
+            "errors": sum(stats["errors"] for stats in operations.values()),
+            "duration_seconds": round(duration, 3),
+            "requests_per_second": round(len(outcomes) / duration, 1),
+            **percentiles([latency * 1000 for _, _, latency in outcomes]),
+            "operations": dict(sorted(operations.items())),
+        }
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p{}_ms".format(percent): round(
+            latencies[min(len(latencies) - 1, len(latencies) * percent // 100)], 3
+        )
+        for percent in (50, 95, 99)
+    }
+
+
+def send_http(url, method, path, token, data):
+    if method == "GET":
+        body = None
+        if data:
+            path += "?" + "&".join(
+                "{}={}".format(key, value) for key, value in data.items()
+            )
+    else:
+        body = json.dumps(data).encode()
+    request = urllib.request.Request(
+        url.rstrip("/") + path,
+        data=body,
+        method=method,
+        headers={
+            "Authorization": "Bearer " + token,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        },
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+OPERATIONS = {
+    "list": lambda send, name, token, other: send("GET", "/api/wallets/", token),
+    "deposit": lambda send, name, token, other: send(
+        "POST", "/api/wallets/{}/make_deposit/".format(name), token, {"amount": "1.00"}
+    ),
+    "transfer": lambda send, name, token, other: send(
+        "POST",
+        "/api/wallets/{}/make_transfer/".format(name),
+        token,
+        {"amount": "0.01", "recipient": other},
+    ),
+    "history": lambda send, name, token, other: send(
+        "GET", "/api/wallets/{}/history/".format(name), token
+    ),
+    "export": lambda send, name, token, other: send(
+        "GET", "/api/wallets/{}/export_history/".format(name), token
+    ),
+}
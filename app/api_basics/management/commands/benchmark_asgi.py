@@ -0,0 +1,185 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+from api_basics.management.commands.benchmark_api import Command as BenchmarkApi
+from api_basics.management.commands.benchmark_api import percentiles
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+READ_PATHS = {
+    "list": "/api/wallets/",
+    "retrieve": "/api/wallets/{}/",
+    "history": "/api/wallets/{}/history/",
+    "export": "/api/wallets/{}/export_history/",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares how many concurrent connections running servers sustain on a read endpoint, e.g. gunicorn with "
+        "sync workers against gunicorn with uvicorn workers (ASGI=1) on the same database. Seeds users and wallets "
+        "with history like benchmark_api, then for every value of --connections opens that many connections at "
+        "once to every --target, each sends one --operation request and reads the response, optionally slowly "
+        "(--read-delay-ms per 16 KB read, a slow client). Prints JSON with successful requests, failures (status "
+        "codes, timeouts, refused connections), requests per second and p50/p95/p99 latency per target and number "
+        "of connections, and the largest number of connections every target served without failures."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target",
+            action="append",
+            required=True,
+            help="NAME=URL of a running server, e.g. wsgi=http://localhost:8000, may be repeated",
+        )
+        parser.add_argument(
+            "--connections",
+            default="10,50,200,500",
+            help="comma-separated numbers of concurrent connections",
+        )
+        parser.add_argument("--operation", choices=list(READ_PATHS), default="history")
+        parser.add_argument("--read-delay-ms", type=float, default=0)
+        parser.add_argument(
+            "--timeout", type=float, default=10, help="seconds per request"
+        )
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--history", type=int, default=200, help="rows per wallet")
+        parser.add_argument("--keep", action="store_true")
+        parser.add_argument("--output", help="file to write JSON results to")
+
+    def handle(self, *args, **options):
+        targets = {}
+        for target in options["target"]:
+            name, _, url = target.partition("=")
+            if not url.startswith("http://"):
+                raise CommandError(
+                    "Invalid --target '{}', should be NAME=http://host:port".format(
+                        target
+                    )
+                )
+            targets[name] = url
+        try:
+            levels = [int(level) for level in options["connections"].split(",")]
+        except ValueError:
+            raise CommandError("--connections should be comma-separated integers")
+        prefix = "benchmark_asgi_"
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(
+                "Users of a previous run exist, delete them or run without --keep"
+            )
+        try:
+            wallets = BenchmarkApi.seed(prefix, options["users"], 1, options["history"])
+            path = READ_PATHS[options["operation"]]
+            results = {}
+            for name, url in targets.items():
+                results[name] = {}
+                for level in levels:
+                    requests = [
+                        (path.format(wallet_name), token)
+                        for wallet_name, token in (
+                            wallets[i % len(wallets)] for i in range(level)
+                        )
+                    ]
+                    results[name][str(level)] = asyncio.run(
+                        self.run_level(
+                            url,
+                            requests,
+                            options["timeout"],
+                            options["read_delay_ms"] / 1000,
+                        )
+                    )
+        finally:
+            if not options["keep"]:
+                User.objects.filter(username__startswith=prefix).delete()
+        output = json.dumps(
+            {
+                "database": connection.vendor,
+                "operation": options["operation"],
+                "read_delay_ms": options["read_delay_ms"],
+                "timeout_seconds": options["timeout"],
+                "max_connections_without_failures": {
+                    name: max(
+                        (
+                            int(level)
+                            for level, stats in levels_results.items()
+                            if not stats["failures"]
+                        ),
+                        default=0,
+                    )
+                    for name, levels_results in results.items()
+                },
+                "targets": results,
+            },
+            indent=2,
+        )
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        self.stdout.write(output)
+
+    async def run_level(self, url, requests, timeout, read_delay):
+        """Sends all 'requests' (path, token) to 'url' at once, every one over its own connection."""
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(
+            *(
+                self.timed_get(url, path, token, timeout, read_delay)
+                for path, token in requests
+            )
+        )
+        duration = time.perf_counter() - start
+        failures = {}
+        for outcome, _ in outcomes:
+            if outcome != 200:
+                failures[str(outcome)] = failures.get(str(outcome), 0) + 1
+        succeeded = [latency * 1000 for outcome, latency in outcomes if outcome == 200]
+        return {
+            "requests": len(outcomes),
+            "succeeded": len(succeeded),
+            "failures": failures,
+            "duration_seconds": round(duration, 3),
+            "requests_per_second": round(len(succeeded) / duration, 1),
+            **(percentiles(succeeded) if succeeded else {}),
+        }
+
+    @staticmethod
+    async def timed_get(url, path, token, timeout, read_delay):
+        start = time.perf_counter()
+        try:
+            status = await asyncio.wait_for(
+                http_get(url, path, token, read_delay), timeout
+            )
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except OSError as error:
+            status = type(error).__name__
+        return status, time.perf_counter() - start
+
+
+async def http_get(url, path, token, read_delay):
+    """Minimal HTTP/1.1 GET over its own connection, which is closed by the server after the response. Returns the
+    status code once the whole response is read. Unlike urllib it needs no thread per connection, so thousands of
+    concurrent connections cost only sockets."""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        writer.write(
+            (
+                "GET {} HTTP/1.1\r\nHost: {}\r\nAuthorization: Bearer {}\r\nAccept: application/json\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            .format(path, parts.netloc, token)
+            .encode()
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            return "ConnectionClosed"
+        while await reader.read(16384):
+            if read_delay:
+                await asyncio.sleep(read_delay)
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
@@ -0,0 +1,115 @@
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from api_basics.management.ledger import write_transactions
+from api_basics.models import TransactionV2, Wallet
+from api_basics.utils import TransactionsCursorPagination, TransactionsPagination
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares latency of 'history' pages fetched with page number and cursor pagination at increasing depth. "
+        "Seeds one wallet with pages * page_size transactions inside a transaction that is rolled back at the end, "
+        "prints JSON with median milliseconds per page."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, default=10000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--ordering", choices=["-timestamp", "timestamp"], default="-timestamp"
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            results = self.run_benchmark(
+                options["pages"], options["repeat"], options["ordering"]
+            )
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def run_benchmark(self, pages, repeat, ordering):
+        page_size = TransactionsPagination.page_size
+        wallet = self.seed(pages * page_size)
+        transactions = TransactionV2.objects.filter(wallet=wallet).with_wallet_names()
+        factory = APIRequestFactory()
+        depths = [depth for depth in (1, 10, 100, 1000, 10000) if depth <= pages]
+        results = {"ordering": ordering, "rows": pages * page_size, "pages": []}
+        for depth in depths:
+            page_request = Request(
+                factory.get("/", {"page_size": depth, "ordering": ordering})
+            )
+            cursor_params = {"ordering": ordering}
+            if depth > 1:
+                # key of the last row of the previous page, computed once and not timed
+                last = transactions.order_by_key(ordering)[(depth - 1) * page_size - 1]
+                cursor_params["cursor"] = TransactionsCursorPagination.encode_cursor(
+                    last.timestamp, last.id
+                )
+            cursor_request = Request(factory.get("/", cursor_params))
+            results["pages"].append(
+                {
+                    "page": depth,
+                    "page_number_ms": self.measure(
+                        TransactionsPagination,
+                        transactions.order_by_key(ordering),
+                        page_request,
+                        repeat,
+                    ),
+                    "cursor_ms": self.measure(
+                        TransactionsCursorPagination,
+                        transactions,
+                        cursor_request,
+                        repeat,
+                    ),
+                }
+            )
+        return results
+
+    @staticmethod
+    def measure(pagination_class, queryset, request, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            page = pagination_class().paginate_queryset(queryset, request)
+            if len(page) != pagination_class.page_size:
+                raise CommandError(
+                    "{} returned {} rows instead of {}".format(
+                        pagination_class.__name__, len(page), pagination_class.page_size
+                    )
+                )
+            timings.append((time.perf_counter() - start) * 1000)
+        return round(sorted(timings)[len(timings) // 2], 3)
+
+    @staticmethod
+    def seed(rows):
+        holder = User.objects.create(username="history_pagination_benchmark")
+        wallet = Wallet.objects.create(
+            name="history_pagination_benchmark", holder=holder
+        )
+        start = timezone.now() - timedelta(seconds=rows)
+        write_transactions(
+            [
+                (
+                    TransactionV2(
+                        wallet=wallet,
+                        recipient=wallet,
+                        amount=Decimal("1.00"),
+                        transaction_type=TransactionV2.CREDIT,
+                        balance_before=Decimal(i),
+                        balance_after=Decimal(i + 1),
+                    ),
+                    start + timedelta(seconds=i),
+                )
+                for i in range(rows)
+            ]
+        )
+        return wallet
@@ -0,0 +1,104 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from api_basics.cache import wallet_cache
+from api_basics.management.commands.benchmark_api import percentiles
+from api_basics.models import TransactionV2, Wallet, WalletBalanceSlot
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures how throughput of concurrent deposits to a single wallet scales with the number of its balance "
+        "slots. For every value of --slots, --workers threads make --deposits deposits of 0.01 to the same wallet "
+        "by Wallet.make_deposit, the same code path as the API. Slots are folded and the balance is checked against "
+        "the number of successful deposits after every run. Prints JSON with deposits per second and p50/p95/p99 "
+        "latency per number of slots (0 is a regular wallet). Meaningful on Postgres only: sqlite locks the whole "
+        "database for every write."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--slots",
+            default="0,1,4,16,64",
+            help="comma-separated numbers of balance slots to compare",
+        )
+        parser.add_argument("--deposits", type=int, default=2000)
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument("--output", help="file to write JSON results to")
+
+    def handle(self, *args, **options):
+        try:
+            slot_counts = [int(slots) for slots in options["slots"].split(",")]
+        except ValueError:
+            raise CommandError("--slots should be comma-separated integers")
+        if connection.vendor == "sqlite" and options["workers"] > 1:
+            self.stderr.write(
+                "sqlite allows one writer at a time, concurrent deposits will fail with 'database is locked' "
+                "errors that are counted as failures"
+            )
+        holder = User.objects.create(username="benchmark_hot_wallet")
+        try:
+            wallet = Wallet.objects.create(name="benchmark_hot_wallet", holder=holder)
+            runs = {}
+            for slots in slot_counts:
+                wallet.set_balance_slots(slots)
+                runs[str(slots)] = self.run(
+                    wallet, options["deposits"], options["workers"]
+                )
+        finally:
+            holder.delete()
+        results = {
+            "database": connection.vendor,
+            "workers": options["workers"],
+            "deposits": options["deposits"],
+            "slots": runs,
+        }
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        self.stdout.write(output)
+
+    @staticmethod
+    def run(wallet, deposits, workers):
+        amount = Decimal("0.01")
+        balance_before = Wallet.objects.with_total_balance().get(id=wallet.id).balance
+        records_before = TransactionV2.objects.filter(wallet=wallet).count()
+
+        def deposit(_):
+            start = time.perf_counter()
+            try:
+                wallet_cache.get_by_id(wallet.id).make_deposit(amount)
+                failure = None
+            except Exception as error:
+                failure = type(error).__name__
+            finally:
+                close_old_connections()
+            return failure, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(deposit, range(deposits)))
+        duration = time.perf_counter() - start
+
+        failures = {}
+        for failure, _ in outcomes:
+            if failure is not None:
+                failures[failure] = failures.get(failure, 0) + 1
+        succeeded = deposits - sum(failures.values())
+        WalletBalanceSlot.fold()
+        balance = Wallet.objects.get(id=wallet.id).balance
+        return {
+            "deposits_per_second": round(succeeded / duration, 1),
+            "duration_seconds": round(duration, 3),
+            "failures": failures,
+            **percentiles([latency * 1000 for _, latency in outcomes]),
+            "balance_is_consistent": balance == balance_before + amount * succeeded
+            and TransactionV2.objects.filter(wallet=wallet).count()
+            == records_before + succeeded,
+        }
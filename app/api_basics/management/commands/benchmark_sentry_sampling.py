@@ -0,0 +1,127 @@
+import json
+import time
+from decimal import Decimal
+
+import sentry_sdk
+from api_basics.models import Wallet
+from api_basics.sampling import TracesSampler
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, transaction
+from django.test import RequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+from sentry_sdk.integrations.django import DjangoIntegration
+from sentry_sdk.transport import Transport
+
+
+class StubTransport(Transport):
+    """Sentry transport that only counts envelopes instead of sending them."""
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.envelopes = 0
+
+    def capture_envelope(self, envelope):
+        self.envelopes += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures per-request overhead of Sentry tracing: with tracing off, with every request traced and with "
+        "SENTRY_TRACES_SAMPLING settings. Requests go through the WSGI handler, so that Sentry starts transactions "
+        "as in production, and transactions are sent to a stub transport. Seeds wallets inside a transaction that "
+        "is rolled back at the end, prints JSON with median and 95th percentile microseconds per request and number "
+        "of transactions sent."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        # the handler closes connection at the end of request, which would end the transaction below
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            with transaction.atomic():
+                results = self.run_benchmark(options["requests"])
+                transaction.set_rollback(True)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def run_benchmark(self, requests):
+        holder = User.objects.create(username="sentry_sampling_benchmark")
+        sender = Wallet.objects.create(
+            name="sentry_sampling_benchmark_sender",
+            holder=holder,
+            balance=Decimal(requests + 100),
+        )
+        recipient = Wallet.objects.create(
+            name="sentry_sampling_benchmark_recipient", holder=holder
+        )
+        token = "Bearer " + str(RefreshToken.for_user(holder).access_token)
+        host = settings.ALLOWED_HOSTS[0].lstrip(".").replace("*", "localhost")
+        factory = RequestFactory(HTTP_HOST=host)
+        configurations = {
+            "no_tracing": {},
+            "sample_all": {"traces_sample_rate": 1.0},
+            "adaptive": {
+                "traces_sampler": TracesSampler(**settings.SENTRY_TRACES_SAMPLING)
+            },
+        }
+        endpoints = {
+            "retrieve": lambda: factory.get(
+                "/api/wallets/{}/".format(sender.name), HTTP_AUTHORIZATION=token
+            ),
+            "make_transfer": lambda: factory.post(
+                "/api/wallets/{}/make_transfer/".format(sender.name),
+                {"amount": "0.01", "recipient": recipient.name},
+                content_type="application/json",
+                HTTP_AUTHORIZATION=token,
+            ),
+        }
+        # warm up caches and lazily imported code, so that the first configuration isn't penalized
+        for make_request in endpoints.values():
+            self.measure(min(requests, 100), make_request)
+        results = {"requests": requests}
+        for name, sentry_options in configurations.items():
+            transport = StubTransport()
+            sentry_sdk.init(
+                **{
+                    "dsn": "https://public@localhost/1",
+                    "integrations": [DjangoIntegration()],
+                    "transport": transport,
+                    **sentry_options,
+                }
+            )
+            results[name] = {
+                endpoint: self.measure(requests, make_request)
+                for endpoint, make_request in endpoints.items()
+            }
+            sentry_sdk.flush()
+            results[name]["transactions_sent"] = transport.envelopes
+        return results
+
+    @staticmethod
+    def measure(requests, make_request):
+        handler = WSGIHandler()
+        timings = []
+        for _ in range(requests):
+            environ = make_request().environ
+            statuses = []
+            start = time.perf_counter()
+            response = handler(environ, lambda status, headers: statuses.append(status))
+            b"".join(response)
+            response.close()
+            timings.append((time.perf_counter() - start) * 1000000)
+            if statuses != ["200 OK"]:
+                raise CommandError("Request failed with {}".format(statuses))
+        timings.sort()
+        return {
+            "median_us": round(timings[len(timings) // 2]),
+            "p95_us": round(timings[int(len(timings) * 0.95)]),
+        }
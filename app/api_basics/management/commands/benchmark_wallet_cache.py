@@ -0,0 +1,71 @@
+import json
+import time
+
+from api_basics.cache import wallet_cache
+from api_basics.models import Wallet
+from api_basics.views import WalletViewSet
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares latency and number of queries of wallet 'retrieve' with wallet cache enabled and disabled. "
+        "Seeds wallets inside a transaction that is rolled back at the end, prints JSON with median milliseconds "
+        "per request, queries per request and cache stats."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--wallets", type=int, default=100)
+        parser.add_argument("--requests", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            results = self.run_benchmark(options["wallets"], options["requests"])
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def run_benchmark(self, wallets, requests):
+        holder = User.objects.create(username="wallet_cache_benchmark")
+        names = [
+            wallet.name
+            for wallet in Wallet.objects.bulk_create(
+                Wallet(name="wallet_cache_benchmark_{}".format(i), holder=holder)
+                for i in range(wallets)
+            )
+        ]
+        results = {"wallets": wallets, "requests": requests}
+        for enabled in (False, True):
+            wallet_cache.clear()
+            with override_settings(WALLET_CACHE_ENABLED=enabled):
+                results["cache_enabled" if enabled else "cache_disabled"] = {
+                    **self.measure(holder, names, requests),
+                    "cache": wallet_cache.stats(),
+                }
+        return results
+
+    @staticmethod
+    def measure(holder, names, requests):
+        factory = APIRequestFactory()
+        view = WalletViewSet.as_view({"get": "retrieve"})
+        timings = []
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(requests):
+                name = names[i % len(names)]
+                request = factory.get("/api/wallets/{}/".format(name))
+                force_authenticate(request, user=holder)
+                start = time.perf_counter()
+                response = view(request, name=name)
+                response.render()
+                timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(
+                        "Request failed with status {}".format(response.status_code)
+                    )
+        return {
+            "median_ms": round(sorted(timings)[len(timings) // 2], 3),
+            "queries_per_request": round(len(queries) / requests, 2),
+        }
@@ -0,0 +1,37 @@
+import time
+
+from api_basics.models import QueuedTransfer
+from api_basics.sharding import on_shard, shard_aliases
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Executor process that keeps applying transfers queued by 'make_transfer' in async mode "
+        "(TRANSFER_QUEUE_ENABLED), one batch per database transaction. Several executors may run in parallel. Sleeps "
+        "for '--interval' seconds only when the queue of every shard is drained."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0.05)
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.TRANSFER_QUEUE_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the queue once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = 0
+            for alias in shard_aliases():
+                with on_shard(alias):
+                    processed += QueuedTransfer.execute(options["batch_size"])
+            if options["once"]:
+                self.stdout.write("Processed {} transfers.".format(processed))
+                return
+            if not processed:
+                time.sleep(options["interval"])
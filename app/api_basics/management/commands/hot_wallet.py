@@ -0,0 +1,36 @@
+import json
+
+from api_basics.cache import wallet_cache
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Turns hot wallet mode on for a wallet that receives many concurrent deposits and transfers: its credits "
+        "are spread over --slots balance slots instead of all locking the wallet row. --slots 0 makes it a regular "
+        "wallet again. Balances of the current slots are moved into the wallet in both cases. Prints JSON with the "
+        "new state of the wallet."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", help="name of the wallet")
+        parser.add_argument("--slots", type=int, default=8)
+
+    def handle(self, *args, **options):
+        if not 0 <= options["slots"] <= 1000:
+            raise CommandError("--slots should be between 0 and 1000")
+        wallet = wallet_cache.get_by_name(options["name"])
+        if wallet is None:
+            raise CommandError("Wallet '{}' doesn't exist".format(options["name"]))
+        wallet.set_balance_slots(options["slots"])
+        self.stdout.write(
+            json.dumps(
+                {
+                    "wallet": wallet.name,
+                    "balance_slots": wallet.balance_slots,
+                    "balance": str(wallet.balance),
+                    "hot_since": wallet.hot_since and wallet.hot_since.isoformat(),
+                },
+                indent=2,
+            )
+        )
@@ -0,0 +1,252 @@
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from api_basics import sharding
+from api_basics.management.ledger import copy_supported, deposit, write_transactions
+from api_basics.models import LedgerImport, TransactionV2, Wallet
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+MAX_REPORTED_ERRORS = 100
+MAX_AMOUNT = Decimal(10) ** (
+    TransactionV2._meta.get_field("amount").max_digits
+    - TransactionV2._meta.get_field("amount").decimal_places
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports transaction history from a CSV file with 'sender,recipient,amount,timestamp' header or from an "
+        "NDJSON file with objects with these keys. Empty sender means a deposit to recipient, otherwise it's a "
+        "transfer that makes a debit and a credit record. The file is streamed in batches, each batch resolves new "
+        "wallet names by one query and is inserted with bulk_create or COPY on Postgres in its own database "
+        "transaction together with the import progress and net amounts added to balances of its wallets by one "
+        "UPDATE, so an interrupted import resumes after the last committed batch when the command is run again "
+        "with the same --name. Reports aren't generated until the import is finished, because imported rows have "
+        "past timestamps. The file is trusted history, so balances are not checked for funds, while rows with unknown "
+        "wallets or invalid values are skipped and reported in the JSON summary."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=["csv", "ndjson"])
+        parser.add_argument(
+            "--name", help="name of the import to resume, file name by default"
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--holder",
+            help="username of the user that gets wallets which don't exist yet, rows with them are skipped otherwise",
+        )
+        parser.add_argument(
+            "--no-copy", action="store_true", help="use bulk_create on Postgres too"
+        )
+
+    def handle(self, *args, **options):
+        if sharding.is_sharded():
+            # rows are transfers between any two wallets, written with both sides in one database transaction
+            raise CommandError(
+                "Importing transactions isn't supported when wallets are sharded"
+            )
+        path = options["path"]
+        file_format = options["format"] or (
+            "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+        )
+        holder = None
+        if options["holder"]:
+            holder = User.objects.filter(username=options["holder"]).first()
+            if holder is None:
+                raise CommandError("User '{}' doesn't exist".format(options["holder"]))
+        ledger_import, _ = LedgerImport.objects.get_or_create(
+            name=options["name"] or os.path.basename(path)
+        )
+        if ledger_import.finished_at is not None:
+            raise CommandError(
+                "Import '{}' is already finished".format(ledger_import.name)
+            )
+        self.use_copy = copy_supported() and not options["no_copy"]
+        self.holder = holder
+        self.wallets = {}
+        self.errors = []
+        self.updated_wallets = set()
+        resumed_from = ledger_import.rows_done
+        transactions = 0
+        start = time.perf_counter()
+        with open(path, newline="") as file:
+            rows = islice(
+                enumerate(self.read_rows(file, file_format), start=1),
+                ledger_import.rows_done,
+                None,
+            )
+            while True:
+                batch = list(islice(rows, options["batch_size"]))
+                if not batch:
+                    break
+                transactions += self.import_batch(ledger_import, batch)
+        ledger_import.finish()
+        duration = time.perf_counter() - start
+        imported_rows = ledger_import.rows_done - resumed_from
+        self.stdout.write(
+            json.dumps(
+                {
+                    "name": ledger_import.name,
+                    "resumed_from_row": resumed_from,
+                    "rows": imported_rows,
+                    "transactions": transactions,
+                    "skipped": len(self.errors),
+                    "wallets_updated": len(self.updated_wallets),
+                    "method": "copy" if self.use_copy else "bulk_create",
+                    "seconds": round(duration, 3),
+                    "rows_per_second": round(imported_rows / duration)
+                    if duration
+                    else 0,
+                    "errors": sorted(self.errors, key=lambda error: error["row"])[
+                        :MAX_REPORTED_ERRORS
+                    ],
+                },
+                indent=2,
+            )
+        )
+
+    @staticmethod
+    def read_rows(file, file_format):
+        if file_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield line
+
+    def import_batch(self, ledger_import, batch):
+        """Imports a batch of (row number, row) in one database transaction, returns number of inserted records."""
+        parsed = []
+        for number, raw in batch:
+            try:
+                parsed.append((number, self.parse_row(raw)))
+            except ValueError as error:
+                self.errors.append({"row": number, "error": str(error)})
+        with transaction.atomic():
+            self.resolve_wallets(
+                {
+                    name
+                    for _, row in parsed
+                    for name in (row["sender"], row["recipient"])
+                    if name
+                }
+            )
+            chunk = []
+            for number, row in parsed:
+                sender = self.wallets.get(row["sender"]) if row["sender"] else None
+                recipient = self.wallets.get(row["recipient"])
+                missing = [
+                    name
+                    for name, wallet in (
+                        (row["sender"], sender),
+                        (row["recipient"], recipient),
+                    )
+                    if name and wallet is None
+                ]
+                if missing:
+                    self.errors.append(
+                        {
+                            "row": number,
+                            "error": "Unknown wallet '{}'".format(missing[0]),
+                        }
+                    )
+                    continue
+                if sender is None:
+                    records = [deposit(recipient, row["amount"])]
+                else:
+                    records = Wallet._transfer(sender, recipient, row["amount"])
+                chunk.extend((record, row["timestamp"]) for record in records)
+            if chunk:
+                deltas = defaultdict(Decimal)
+                for record, _ in chunk:
+                    if record.transaction_type == TransactionV2.CREDIT:
+                        deltas[record.wallet_id] += record.amount
+                    else:
+                        deltas[record.wallet_id] -= record.amount
+                # wallets are locked before the records are inserted, so ids of records of a wallet commit in order,
+                # which reconciliation relies on
+                LedgerImport.add_to_balances(deltas)
+                write_transactions(chunk, self.use_copy)
+                self.updated_wallets.update(deltas)
+            ledger_import.rows_done += len(batch)
+            ledger_import.save(update_fields=["rows_done"])
+        return len(chunk)
+
+    def resolve_wallets(self, names):
+        """Loads wallets with given names that are not loaded yet by one query. Balance of a loaded wallet is set to
+        'balance_after' of its latest transaction, which is where its running balance stopped if the import is
+        resumed, and then it's changed in memory by imported records."""
+        missing = names - self.wallets.keys()
+        if not missing:
+            return
+        if self.holder is not None:
+            existing = set(
+                Wallet.objects.filter(name__in=missing).values_list("name", flat=True)
+            )
+            Wallet.objects.bulk_create(
+                Wallet(name=name, holder=self.holder) for name in missing - existing
+            )
+        wallets = Wallet.objects.filter(name__in=missing).annotate(
+            last_balance=Subquery(
+                TransactionV2.objects.filter(wallet=OuterRef("pk"))
+                .order_by("-id")
+                .values("balance_after")[:1]
+            )
+        )
+        for wallet in wallets:
+            if wallet.last_balance is not None:
+                wallet.balance = wallet.last_balance
+            self.wallets[wallet.name] = wallet
+
+    @staticmethod
+    def parse_row(raw):
+        """Returns dict with 'sender', 'recipient', 'amount' and 'timestamp' of a row, raises ValueError if it's
+        invalid."""
+        if isinstance(raw, str):
+            try:
+                raw = json.loads(raw)
+            except ValueError:
+                raise ValueError("Invalid JSON")
+            if not isinstance(raw, dict):
+                raise ValueError("Row is not an object")
+        sender = raw.get("sender") or None
+        recipient = raw.get("recipient")
+        if not recipient:
+            raise ValueError("Recipient is required")
+        if sender == recipient:
+            raise ValueError("Sender and recipient are the same wallet")
+        try:
+            amount = Decimal(str(raw.get("amount")))
+        except InvalidOperation:
+            raise ValueError("Invalid amount '{}'".format(raw.get("amount")))
+        if (
+            not amount.is_finite()
+            or amount <= 0
+            or amount != amount.quantize(Decimal("0.01"))
+        ):
+            raise ValueError("Invalid amount '{}'".format(raw.get("amount")))
+        if amount >= MAX_AMOUNT:
+            raise ValueError("Amount '{}' is too large".format(raw.get("amount")))
+        timestamp = parse_datetime(raw.get("timestamp") or "")
+        if timestamp is None:
+            raise ValueError("Invalid timestamp '{}'".format(raw.get("timestamp")))
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, timezone.utc)
+        return {
+            "sender": sender,
+            "recipient": recipient,
+            "amount": amount,
+            "timestamp": timestamp,
+        }
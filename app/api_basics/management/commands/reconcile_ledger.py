@@ -0,0 +1,78 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from api_basics.models import WalletReconciliation
+from api_basics.tasks import reconcile_ledger
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks that balance of every wallet equals the sum of its credit minus debit transactions. Only "
+        "transactions made since the previous reconciliation are read. Prints JSON report of inconsistent wallets."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.LEDGER_RECONCILIATION_CHUNK_SIZE,
+            help="Number of wallet ids reconciled at once.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes that reconcile chunks in parallel.",
+        )
+        parser.add_argument(
+            "--celery",
+            action="store_true",
+            help="Dispatch chunks to celery workers instead of reconciling them here.",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Forget previous reconciliations and re-audit all transactions that aren't archived, starting from "
+            "sums of archived ones.",
+        )
+
+    def handle(self, *args, **options):
+        if options["full"]:
+            WalletReconciliation.objects.all().delete()
+        if options["celery"]:
+            reconcile_ledger.delay()
+            self.stderr.write("Reconciliation is dispatched to celery workers.")
+            return
+        chunks = WalletReconciliation.wallet_id_chunks(options["chunk_size"])
+        if options["workers"] > 1:
+            # forked workers must open their own database connections
+            connections.close_all()
+            with ProcessPoolExecutor(options["workers"]) as executor:
+                list(executor.map(WalletReconciliation.reconcile, *zip(*chunks)))
+        else:
+            for first_wallet_id, last_wallet_id in chunks:
+                WalletReconciliation.reconcile(first_wallet_id, last_wallet_id)
+        self.stdout.write(
+            json.dumps(
+                [
+                    {
+                        "wallet": reconciliation.wallet.name,
+                        "balance": str(reconciliation.balance),
+                        "ledger_balance": str(reconciliation.ledger_balance),
+                        "difference": str(
+                            reconciliation.balance - reconciliation.ledger_balance
+                        ),
+                        "checked_at": reconciliation.checked_at.isoformat(),
+                    }
+                    for reconciliation in WalletReconciliation.objects.filter(
+                        is_consistent=False
+                    )
+                    .select_related("wallet")
+                    .order_by("wallet")
+                ],
+                indent=2,
+            )
+        )
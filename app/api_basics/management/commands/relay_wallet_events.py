@@ -0,0 +1,33 @@
+import time
+
+from api_basics.events import publish_wallet_events
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Relay process that keeps publishing wallet events from the outbox to message broker. Sleeps for "
+        "'--interval' seconds only when the outbox is drained. Several relays drain the outbox in parallel, but may "
+        "publish events of the same wallet out of order."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0.5)
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.WALLET_EVENTS_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the outbox once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            published = publish_wallet_events(options["batch_size"])
+            if options["once"]:
+                self.stdout.write("Published {} events.".format(published))
+                return
+            if not published:
+                time.sleep(options["interval"])
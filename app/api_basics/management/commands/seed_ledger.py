@@ -0,0 +1,179 @@
+import json
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from api_basics import sharding
+from api_basics.management.ledger import copy_supported, deposit, write_transactions
+from api_basics.models import Wallet
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+CENT = Decimal("0.01")
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds users, wallets and a consistent ledger of deposits and transfers between them: every transfer is a "
+        "pair of DEB/CRED rows, running balances of rows and final balances of wallets match. Rows are written in "
+        "chunks with bulk_create, or with COPY on Postgres. Activity of wallets can be skewed towards hot wallets "
+        "and along a Zipf-like long tail, and is spread over --days. The same --seed always produces the same data. "
+        "Prints JSON with number of rows and time spent."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--wallets-per-user", type=int, default=1)
+        parser.add_argument(
+            "--operations",
+            type=int,
+            default=100000,
+            help="number of deposits and transfers, every transfer makes two rows",
+        )
+        parser.add_argument(
+            "--deposit-share",
+            type=float,
+            default=0.2,
+            help="share of deposits among operations",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=30,
+            help="history ends now and spans that many days",
+        )
+        parser.add_argument(
+            "--hot-wallets",
+            type=int,
+            default=0,
+            help="number of wallets that take part in --hot-share of operations",
+        )
+        parser.add_argument("--hot-share", type=float, default=0.5)
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=0.0,
+            help="exponent of Zipf-like activity of the rest of wallets, 0 means uniform",
+        )
+        parser.add_argument("--chunk-size", type=int, default=10000)
+        parser.add_argument(
+            "--no-copy",
+            action="store_true",
+            help="use bulk_create on Postgres too",
+        )
+        parser.add_argument("--prefix", default="seed")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if sharding.is_sharded():
+            # wallets are created without WalletDirectory, transfers are written with both sides in one database
+            # transaction
+            raise CommandError(
+                "Seeding a ledger isn't supported when wallets are sharded"
+            )
+        prefix = "{}_{}_".format(options["prefix"], options["seed"])
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(
+                "Users with '{}' prefix exist, use another --prefix or --seed".format(
+                    prefix
+                )
+            )
+        use_copy = copy_supported() and not options["no_copy"]
+        start = time.perf_counter()
+        with transaction.atomic():
+            wallets = self.create_wallets(
+                prefix, options["users"], options["wallets_per_user"]
+            )
+            rows = 0
+            for chunk in self.generate(wallets, options):
+                write_transactions(chunk, use_copy)
+                rows += len(chunk)
+            Wallet.objects.bulk_update(
+                wallets, ["balance"], batch_size=options["chunk_size"]
+            )
+        duration = time.perf_counter() - start
+        self.stdout.write(
+            json.dumps(
+                {
+                    "users": options["users"],
+                    "wallets": len(wallets),
+                    "transactions": rows,
+                    "method": "copy" if use_copy else "bulk_create",
+                    "seconds": round(duration, 3),
+                    "rows_per_second": round(rows / duration),
+                },
+                indent=2,
+            )
+        )
+
+    @staticmethod
+    def create_wallets(prefix, users, wallets_per_user):
+        User.objects.bulk_create(
+            User(username="{}{}".format(prefix, number), password="!")
+            for number in range(users)
+        )
+        holders = User.objects.filter(username__startswith=prefix).order_by("id")
+        Wallet.objects.bulk_create(
+            Wallet(holder=holder, name="{}_{}".format(holder.username, number))
+            for holder in holders
+            for number in range(wallets_per_user)
+        )
+        # bulk_create doesn't set ids on sqlite
+        return list(
+            Wallet.objects.filter(holder__username__startswith=prefix).order_by("id")
+        )
+
+    @staticmethod
+    def generate(wallets, options):
+        """Yields chunks of unsaved (TransactionV2, timestamp) in chronological order, changing balances of
+        'wallets' in memory. A transfer from a wallet that can't afford it or to itself becomes a deposit to this
+        wallet."""
+        rng = random.Random(options["seed"])
+        hot = min(options["hot_wallets"], len(wallets))
+        cum_weights = list(
+            accumulate(
+                1 / (rank + 1) ** options["skew"] for rank in range(len(wallets) - hot)
+            )
+        )
+        tail = wallets[hot:]
+
+        def pick():
+            if hot and (not tail or rng.random() < options["hot_share"]):
+                return wallets[rng.randrange(hot)]
+            return rng.choices(tail, cum_weights=cum_weights)[0]
+
+        end = timezone.now()
+        step = timedelta(days=options["days"]) / max(options["operations"], 1)
+        moment = end - timedelta(days=options["days"])
+        chunk = []
+        for _ in range(options["operations"]):
+            # gaps between operations are random, but the history never goes past 'end'
+            moment = min(moment + step * rng.expovariate(1), end)
+            amount = (Decimal(rng.lognormvariate(3, 1)) + CENT).quantize(CENT)
+            sender = pick()
+            recipient = pick()
+            # with few or very hot wallets the sender may keep being picked, then it's a deposit
+            for _ in range(3):
+                if recipient is not sender:
+                    break
+                recipient = pick()
+            if (
+                recipient is sender
+                or rng.random() < options["deposit_share"]
+                or sender.balance < amount
+            ):
+                chunk.append((deposit(sender, amount), moment))
+            else:
+                chunk.extend(
+                    (record, moment)
+                    for record in Wallet._transfer(sender, recipient, amount)
+                )
+            if len(chunk) >= options["chunk_size"]:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
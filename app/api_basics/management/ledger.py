@@ -0,0 +1,101 @@
+import csv
+import io
+
+from api_basics.models import TransactionV2
+from django.db import connection
+
+FIELDS = [
+    TransactionV2._meta.get_field(name)
+    for name in [
+        "wallet",
+        "sender",
+        "recipient",
+        "amount",
+        "transaction_type",
+        "balance_before",
+        "balance_after",
+        "timestamp",
+    ]
+]
+
+
+def deposit(wallet, amount):
+    """Returns unsaved CRED record of a deposit to 'wallet' and adds 'amount' to its balance in memory."""
+    record = TransactionV2(
+        wallet=wallet,
+        recipient=wallet,
+        amount=amount,
+        transaction_type=TransactionV2.CREDIT,
+        balance_before=wallet.balance,
+        balance_after=wallet.balance + amount,
+    )
+    wallet.balance += amount
+    return record
+
+
+def copy_supported():
+    return connection.vendor == "postgresql"
+
+
+def write_transactions(chunk, use_copy=False):
+    """Inserts a chunk of unsaved (TransactionV2, timestamp) pairs with given timestamps by one COPY on Postgres
+    if 'use_copy' is set, or by multi-row INSERTs otherwise."""
+    if use_copy:
+        copy_transactions(chunk)
+    else:
+        insert_transactions(chunk)
+
+
+def insert_transactions(chunk):
+    """'timestamp' of TransactionV2 is auto_now_add, so bulk_create would give every row the current time, and the
+    rows are inserted by SQL with their own timestamps instead."""
+    sql = "INSERT INTO {} ({}) VALUES ".format(
+        connection.ops.quote_name(TransactionV2._meta.db_table),
+        ", ".join(connection.ops.quote_name(field.column) for field in FIELDS),
+    )
+    row = "({})".format(", ".join(["%s"] * len(FIELDS)))
+    batch_size = connection.ops.bulk_batch_size(FIELDS, chunk)
+    with connection.cursor() as cursor:
+        for start in range(0, len(chunk), batch_size):
+            batch = chunk[start : start + batch_size]
+            cursor.execute(
+                sql + ", ".join([row] * len(batch)),
+                [
+                    field.get_db_prep_save(
+                        moment
+                        if field.name == "timestamp"
+                        else getattr(record, field.attname),
+                        connection,
+                    )
+                    for record, moment in batch
+                    for field in FIELDS
+                ],
+            )
+
+
+def copy_transactions(chunk):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record, moment in chunk:
+        writer.writerow(
+            [
+                record.wallet_id,
+                # empty unquoted value is NULL in CSV format of COPY
+                record.sender_id if record.sender_id is not None else "",
+                record.recipient_id,
+                record.amount,
+                record.transaction_type,
+                record.balance_before,
+                record.balance_after,
+                moment.isoformat(),
+            ]
+        )
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                TransactionV2._meta.db_table,
+                ", ".join(field.column for field in FIELDS),
+            ),
+            buffer,
+        )
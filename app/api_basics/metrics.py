@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from functools import wraps
+
+from celery.signals import (
+    task_failure,
+    task_postrun,
+    task_prerun,
+    task_retry,
+    worker_init,
+    worker_process_shutdown,
+)
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from rest_framework.exceptions import APIException
+
+from .errors_exceptions import INSUFFICIENT_FUNDS_ERROR
+
+REQUEST_LATENCY = Histogram(
+    "wallets_http_request_duration_seconds",
+    "Latency of HTTP requests by endpoint ('<ViewSet>.<action>')",
+    ["endpoint", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUESTS = Counter(
+    "wallets_http_requests_total",
+    "HTTP requests by endpoint and response status code",
+    ["endpoint", "method", "status"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "wallets_http_requests_in_progress",
+    "HTTP requests being handled by endpoint",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+OPERATIONS = Counter(
+    "wallets_operations_total",
+    "Deposits and transfers by result: success, queued, insufficient_funds, rejected, not_applied or error",
+    ["operation", "result"],
+)
+TASK_DURATION = Histogram(
+    "wallets_celery_task_duration_seconds",
+    "Duration of celery task runs, including failed ones and ones that are retried",
+    ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+TASK_RETRIES = Counter(
+    "wallets_celery_task_retries_total", "Retries of celery tasks", ["task"]
+)
+TASK_FAILURES = Counter(
+    "wallets_celery_task_failures_total",
+    "Celery task runs that failed and won't be retried",
+    ["task"],
+)
+
+_task_starts = {}
+
+
+def multiprocess_mode():
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def metrics_registry():
+    """Returns registry with metrics of this process, or of all processes that share PROMETHEUS_MULTIPROC_DIR
+    directory (gunicorn workers, celery pool processes) if it is set."""
+    if not multiprocess_mode():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    """Serves metrics in Prometheus text format at /metrics."""
+    return HttpResponse(
+        generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST
+    )
+
+
+def operation_result(status_code, data):
+    if status_code == 202:
+        return "queued"
+    if 200 <= status_code < 300:
+        return "success"
+    if INSUFFICIENT_FUNDS_ERROR in json.dumps(data, default=str):
+        return "insufficient_funds"
+    if status_code < 500:
+        return "rejected"
+    return "error"
+
+
+def count_operation(operation):
+    """Decorator for deposit and transfer view actions that counts them in 'wallets_operations_total' by result.
+    Every transfer of a batch is counted separately. It should be applied under 'idempotent', so that replayed
+    responses are not counted again."""
+
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            try:
+                response = view_method(self, request, *args, **kwargs)
+            except APIException as error:
+                OPERATIONS.labels(
+                    operation, operation_result(error.status_code, error.detail)
+                ).inc()
+                raise
+            except Exception:
+                OPERATIONS.labels(operation, "error").inc()
+                raise
+            results = (
+                response.data.get("results")
+                if isinstance(response.data, dict)
+                else None
+            )
+            if results is None:
+                OPERATIONS.labels(
+                    operation, operation_result(response.status_code, response.data)
+                ).inc()
+            else:
+                for result in results:
+                    if result["transaction_status"] == "failed":
+                        OPERATIONS.labels(
+                            operation, operation_result(400, result["errors"])
+                        ).inc()
+                    else:
+                        OPERATIONS.labels(operation, result["transaction_status"]).inc()
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+@task_prerun.connect
+def task_started(task_id, task, **kwargs):
+    _task_starts[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def task_finished(task_id, task, **kwargs):
+    start = _task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_DURATION.labels(task.name).observe(time.perf_counter() - start)
+
+
+@task_retry.connect
+def task_retried(sender, **kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
+
+
+@task_failure.connect
+def task_failed(sender, **kwargs):
+    TASK_FAILURES.labels(sender.name).inc()
+
+
+@worker_init.connect
+def start_worker_metrics_server(**kwargs):
+    """Celery worker serves metrics of its pool processes on CELERY_METRICS_PORT, if it is set."""
+    port = os.environ.get("CELERY_METRICS_PORT")
+    if port:
+        start_http_server(int(port), registry=metrics_registry())
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid, **kwargs):
+    if multiprocess_mode():
+        multiprocess.mark_process_dead(pid)
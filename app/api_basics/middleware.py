@@ -0,0 +1,250 @@
+import asyncio
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+import sentry_sdk
+from django.conf import settings
+from django.db import connections
+
+from .metrics import REQUEST_LATENCY, REQUESTS, REQUESTS_IN_PROGRESS
+from .sampling import TracesSampler
+
+
+class QueryRecorder:
+    """Connection 'execute_wrapper' that counts queries of one request, their total time and the slowest of them."""
+
+    def __init__(self):
+        self.endpoint = None
+        self.count = 0
+        self.duration = 0.0
+        self.slowest_sql = None
+        self.slowest_duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            if self.slowest_sql is None or duration > self.slowest_duration:
+                self.slowest_sql = sql
+                self.slowest_duration = duration
+
+
+class QueryStats:
+    """Per-process aggregated query stats of endpoints since start or last 'reset'."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, recorder):
+        with self.lock:
+            stats = self.endpoints.setdefault(
+                recorder.endpoint,
+                {
+                    "requests": 0,
+                    "queries": 0,
+                    "max_queries": 0,
+                    "db_ms": 0.0,
+                    "slowest_sql": None,
+                    "slowest_ms": 0.0,
+                },
+            )
+            stats["requests"] += 1
+            stats["queries"] += recorder.count
+            stats["max_queries"] = max(stats["max_queries"], recorder.count)
+            stats["db_ms"] += recorder.duration * 1000
+            if recorder.slowest_duration * 1000 > stats["slowest_ms"]:
+                stats["slowest_sql"] = recorder.slowest_sql
+                stats["slowest_ms"] = recorder.slowest_duration * 1000
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    **stats,
+                    "avg_queries": round(stats["queries"] / stats["requests"], 2),
+                    "avg_db_ms": round(stats["db_ms"] / stats["requests"], 3),
+                    "db_ms": round(stats["db_ms"], 3),
+                    "slowest_ms": round(stats["slowest_ms"], 3),
+                }
+                for endpoint, stats in self.endpoints.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+
+
+query_stats = QueryStats()
+
+# QueryRecorder of the request being handled under ASGI, queries are made in threads of api_basics.asgi.run_orm then
+current_query_recorder = ContextVar("query_recorder", default=None)
+
+
+class AsyncCapableMiddleware:
+    """Base of middleware that work both under WSGI and ASGI. Under ASGI Django adapts sync-only middleware, and
+    every view below it, to run in a thread, so async views wouldn't be async anymore. Subclasses implement 'call'
+    for WSGI and 'acall' for ASGI."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # makes Django see the instance as a coroutine function, like MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.acall(request)
+        return self.call(request)
+
+
+class QueryStatsMiddleware(AsyncCapableMiddleware):
+    """Records queries made by every request on all database connections.
+        - Endpoint is '<ViewSet>.<action>' for DRF viewsets and view name for other views
+        - Response gets 'Server-Timing' header with number of queries and DB time, and 'query_stats' attribute with
+          the QueryRecorder, which is used by tests to check query budgets
+        - Totals per endpoint are aggregated in 'query_stats' and served by GET /api/query_stats/
+    Queries of streaming responses made while the response is consumed are not recorded."""
+
+    def call(self, request):
+        if not settings.QUERY_STATS_ENABLED:
+            return self.get_response(request)
+        recorder = QueryRecorder()
+        request.query_recorder = recorder
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+        return self.finish(response, recorder, start)
+
+    async def acall(self, request):
+        if not settings.QUERY_STATS_ENABLED:
+            return await self.get_response(request)
+        recorder = QueryRecorder()
+        request.query_recorder = recorder
+        start = time.perf_counter()
+        token = current_query_recorder.set(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_query_recorder.reset(token)
+        return self.finish(response, recorder, start)
+
+    @staticmethod
+    def finish(response, recorder, start):
+        duration = time.perf_counter() - start
+        if recorder.endpoint is None:
+            recorder.endpoint = "unresolved"
+        query_stats.record(recorder)
+        response.query_stats = recorder
+        response[
+            "Server-Timing"
+        ] = 'db;dur={:.3f};desc="{} queries", total;dur={:.3f}'.format(
+            recorder.duration * 1000, recorder.count, duration * 1000
+        )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        recorder = getattr(request, "query_recorder", None)
+        if recorder is not None:
+            recorder.endpoint = endpoint_name(request.method, request.resolver_match)
+        return None
+
+
+class MetricsMiddleware(AsyncCapableMiddleware):
+    """Exports latency, status codes and number of in-flight requests per endpoint as Prometheus metrics. Requests
+    that are not resolved to a view (e.g. 404) are counted as 'unresolved' endpoint."""
+
+    def call(self, request):
+        request.metrics_endpoint = "unresolved"
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            self.request_done(request)
+        return self.count(request, response, start)
+
+    async def acall(self, request):
+        request.metrics_endpoint = "unresolved"
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.request_done(request)
+        return self.count(request, response, start)
+
+    @staticmethod
+    def request_done(request):
+        if getattr(request, "metrics_in_progress", False):
+            REQUESTS_IN_PROGRESS.labels(request.metrics_endpoint).dec()
+
+    @staticmethod
+    def count(request, response, start):
+        REQUEST_LATENCY.labels(request.metrics_endpoint, request.method).observe(
+            time.perf_counter() - start
+        )
+        REQUESTS.labels(
+            request.metrics_endpoint, request.method, response.status_code
+        ).inc()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_endpoint = endpoint_name(request.method, request.resolver_match)
+        request.metrics_in_progress = True
+        REQUESTS_IN_PROGRESS.labels(request.metrics_endpoint).inc()
+        return None
+
+
+class TraceSamplingMiddleware(AsyncCapableMiddleware):
+    """Makes the final decision whether to send Sentry transactions of 'tail' endpoints of TracesSampler, which are
+    always traced, by response status code and duration (see api_basics.sampling)."""
+
+    def call(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        return self.sample(request, response, time.perf_counter() - start)
+
+    async def acall(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        return self.sample(request, response, time.perf_counter() - start)
+
+    @staticmethod
+    def sample(request, response, duration):
+        client = sentry_sdk.Hub.current.client
+        sampler = client and client.options.get("traces_sampler")
+        transaction = sentry_sdk.Hub.current.scope.transaction
+        if (
+            isinstance(sampler, TracesSampler)
+            and transaction is not None
+            and transaction.sampled
+            and transaction.parent_sampled is None
+            and request.resolver_match is not None
+        ):
+            endpoint = endpoint_name(request.method, request.resolver_match)
+            if endpoint in sampler.tail and not sampler.keep(
+                endpoint, response.status_code, duration
+            ):
+                transaction.sampled = False
+        return response
+
+
+def endpoint_name(method, resolver_match):
+    """Returns '<ViewSet>.<action>' for DRF viewsets and view name for other views."""
+    actions = getattr(resolver_match.func, "actions", None)
+    if actions:
+        method = method.lower()
+        return "{}.{}".format(
+            resolver_match.func.cls.__name__, actions.get(method, method)
+        )
+    return resolver_match.view_name
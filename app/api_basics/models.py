@@ -1,24 +1,85 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
 from decimal import Decimal
+from uuid import uuid4
 
 from django.contrib.auth.models import User
-from django.db import models, transaction
-from django.db.models import F, Q, Sum
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    Max,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, TruncDate
+from django.db.models.query import ModelIterable
 from django.utils import timezone
 from rest_framework import serializers
 
-from .errors_exceptions import INSUFFICIENT_FUNDS_ERROR
+from . import sharding
+from .cache import wallet_cache
+from .errors_exceptions import (
+    INSUFFICIENT_FUNDS_ERROR,
+    RECIPIENT_DOESNT_EXIST_ERROR,
+    RECIPIENT_IS_SENDER_ERROR,
+    RECIPIENT_ON_ANOTHER_SHARD_ERROR,
+    TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR,
+)
+from .routers import replica_alias
+
+
+class WalletQuerySet(models.QuerySet):
+    def with_total_balance(self):
+        """Adds balances of slots of hot wallets (see WalletBalanceSlot) to 'balance' of fetched wallets, by a
+        subquery in the same query. Such wallets are for reading and must not be saved."""
+        slots_balance = (
+            WalletBalanceSlot.objects.filter(wallet=OuterRef("pk"))
+            .order_by()
+            .values("wallet")
+            .annotate(total=Sum("balance"))
+            .values("total")
+        )
+        queryset = self.annotate(slots_balance=Subquery(slots_balance))
+        queryset._iterable_class = TotalBalanceIterable
+        return queryset
+
+
+class TotalBalanceIterable(ModelIterable):
+    def __iter__(self):
+        for wallet in super().__iter__():
+            if wallet.slots_balance:
+                wallet.balance += wallet.slots_balance
+            yield wallet
 
 
 class Wallet(models.Model):
     """A model of wallet that implements 'make_deposit' and 'make_transaction" actions logic in corresponding methods"""
 
     name = models.CharField(max_length=100, unique=True)
+    # holders stay in the 'default' database when wallets are sharded
     holder = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="users_wallet"
+        User, on_delete=models.CASCADE, related_name="users_wallet", db_constraint=False
     )
     balance = models.DecimalField(
         max_digits=10, decimal_places=2, blank=True, default=0.0
     )
+    # timestamp of the latest archived transaction, history reaching back to it reads ArchivedTransaction too
+    archived_until = models.DateTimeField(null=True, blank=True)
+    # number of WalletBalanceSlot rows that credits of a hot wallet are spread over, 0 for a regular wallet
+    balance_slots = models.PositiveSmallIntegerField(default=0)
+    # when the wallet became hot for the first time, credits made since then may have no running balance
+    hot_since = models.DateTimeField(null=True, blank=True)
+
+    objects = WalletQuerySet.as_manager()
 
     class Meta:
         indexes = [
@@ -34,61 +95,397 @@ class Wallet(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def shard(self):
+        """Index in WALLET_SHARDS of the shard the wallet and its transactions are stored on."""
+        return sharding.shard_index(self.holder_id)
+
+    @property
+    def shard_alias(self):
+        return sharding.shard_alias(self.holder_id)
+
+    def save(self, *args, **kwargs):
+        """When wallets are sharded, a wallet is always saved to the shard of its holder, and a new one gets its id
+        from WalletDirectory, which also keeps its name unique across all shards."""
+        if not sharding.is_sharded():
+            return super().save(*args, **kwargs)
+        kwargs["using"] = self.shard_alias
+        if not (self._state.adding and self.id is None):
+            return super().save(*args, **kwargs)
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            entry = WalletDirectory.objects.create(
+                name=self.name, holder_id=self.holder_id
+            )
+        self.id = entry.id
+        try:
+            kwargs["force_insert"] = True
+            super().save(*args, **kwargs)
+        except Exception:
+            self.id = None
+            entry.delete()
+            raise
+
     def make_deposit(self, amount):
         """Implements 'make_deposit' action on wallet resource. Arguments should be validated before calling.
         Arguments:
-            - 'amount' > 0 in US dollars"""
-        balance_before = Wallet.objects.filter(id=self.id)[0].balance
-        with transaction.atomic():
-            Wallet.objects.filter(id=self.id).update(balance=F("balance") + amount)
-            TransactionV2(
-                wallet=self,
-                recipient=self,
-                amount=amount,
-                transaction_type="CRED",
-                balance_before=balance_before,
-                balance_after=balance_before + amount,
-            ).save()
+            - 'amount' > 0 in US dollars
+        A deposit to a hot wallet goes to one of its balance slots without locking the wallet.
+        Returns new balance of the wallet."""
+        with sharding.on_shard(self.shard_alias), sharding.atomic():
+            if self.balance_slots and WalletBalanceSlot.credit(self, amount):
+                record = TransactionV2.objects.create(
+                    wallet=self,
+                    recipient=self,
+                    amount=amount,
+                    transaction_type=TransactionV2.CREDIT,
+                    balance_before=None,
+                    balance_after=None,
+                )
+                WalletEvent.for_deposit(record).save()
+                wallet_cache.invalidate_on_commit([self.id])
+                wallet = Wallet.objects.with_total_balance().get(id=self.id)
+            else:
+                wallet = Wallet.objects.select_for_update().get(id=self.id)
+                record = TransactionV2.objects.create(
+                    wallet=wallet,
+                    recipient=wallet,
+                    amount=amount,
+                    transaction_type=TransactionV2.CREDIT,
+                    **wallet.credit_balances(amount),
+                )
+                WalletEvent.for_deposit(record).save()
+                wallet.balance += amount
+                wallet.save(update_fields=["balance"])
+        self.balance = wallet.balance
+        return self.balance
 
     def make_transaction(self, amount, recipient_id):
         """Implements 'make_transaction' action on wallet resource. Arguments should be validated before calling.
         Arguments:
             - 'amount' > 0 in US dollars, should be >= sender's balance
-            - 'recipient_id' - id of recipient wallet, should be != id of sender wallet"""
-        sender_obj = Wallet.objects.filter(id=self.id)[0]
-        recipient_obj = Wallet.objects.filter(id=recipient_id)[0]
-        with transaction.atomic():
-            if Wallet.objects.filter(id=self.id, balance__gte=amount).update(
-                balance=F("balance") - amount
-            ):
-                # increment recipient balance
-                Wallet.objects.filter(id=recipient_id).update(
-                    balance=F("balance") + amount
+            - 'recipient_id' - id of recipient wallet, should be != id of sender wallet
+        Both wallets are locked in the order of their ids, so concurrent transfers between the same wallets in
+        opposite directions wait for each other instead of deadlocking, and balances in transaction records are read
+        under the lock. A transfer to a wallet on another shard is made by ShardTransfer.
+        Returns new balance of the sender."""
+        if sharding.is_sharded():
+            recipient = wallet_cache.get_by_id(recipient_id)
+            if recipient is None:
+                raise serializers.ValidationError(
+                    {"recipient": [RECIPIENT_DOESNT_EXIST_ERROR]}
                 )
-                # transaction record for debit
-                TransactionV2(
-                    wallet=self,
-                    sender=self,
-                    recipient=recipient_obj,
-                    amount=amount,
-                    transaction_type="DEB",
-                    balance_before=sender_obj.balance,
-                    balance_after=sender_obj.balance - amount,
-                ).save()
-                # transaction record for credit
-                TransactionV2(
-                    wallet=recipient_obj,
-                    sender=self,
-                    recipient=recipient_obj,
-                    amount=amount,
-                    transaction_type="CRED",
-                    balance_before=recipient_obj.balance,
-                    balance_after=recipient_obj.balance + amount,
-                ).save()
-            else:
+            if recipient.shard != self.shard:
+                self.balance = ShardTransfer.transfer(self, recipient, amount)
+                return self.balance
+        with sharding.on_shard(self.shard_alias), sharding.atomic():
+            # a hot recipient isn't locked, the amount goes to one of its balance slots
+            wallets = {
+                wallet.id: wallet
+                for wallet in Wallet.objects.select_for_update()
+                .filter(Q(id=self.id) | Q(id=recipient_id, balance_slots=0))
+                .order_by("id")
+            }
+            sender = wallets[self.id]
+            recipient = wallets.get(recipient_id)
+            if recipient is None:
+                recipient = Wallet.objects.get(id=recipient_id)
+                if not WalletBalanceSlot.credit(recipient, amount):
+                    # hot mode has just been turned off, the order of locks doesn't matter this once
+                    recipient = Wallet.objects.select_for_update().get(id=recipient_id)
+                    wallets[recipient_id] = recipient
+            sender.collect_balance_slots()
+            if sender.balance < amount:
                 raise serializers.ValidationError(
                     {"amount": [INSUFFICIENT_FUNDS_ERROR]}
                 )
+            records = TransactionV2.objects.bulk_create(
+                self._transfer(sender, recipient, amount)
+            )
+            WalletEvent.for_transfer(*records).save()
+            Wallet.objects.bulk_update(wallets.values(), ["balance"])
+            wallet_cache.invalidate_on_commit([sender.id, recipient.id])
+        self.balance = sender.balance
+        return self.balance
+
+    def make_transactions(self, transfers, all_or_nothing=False):
+        """Implements 'make_transfers' action on wallet resource: applies a batch of transfers from this wallet in one
+        database transaction.
+        Arguments:
+            - 'transfers' - list of dicts with 'amount' and 'recipient' (name of recipient wallet), only their types
+            should be validated before calling, every transfer is validated here and gets its own result
+            - 'all_or_nothing' - if True, nothing is applied when at least one transfer is invalid
+        Recipients are resolved and all wallets are locked in the order of their ids by one query, then transfers
+        are applied in memory in the given order, all transaction records are inserted by one query and all balances
+        are updated by another one.
+        Returns a tuple of results list (in the same order as 'transfers') and new balance of the sender."""
+        recipient_names = {item["recipient"] for item in transfers}
+        with sharding.on_shard(self.shard_alias), sharding.atomic():
+            wallets = {
+                wallet.name: wallet
+                for wallet in Wallet.objects.select_for_update()
+                .filter(Q(id=self.id) | Q(name__in=recipient_names))
+                .order_by("id")
+            }
+            sender = wallets[self.name]
+            if sender.collect_balance_slots():
+                # slots are zeroed even if no transfer of the batch is applied
+                sender.save(update_fields=["balance"])
+            remote = self._remote_wallet_names(recipient_names, wallets)
+            balance_before = sender.balance
+            results = []
+            records = []
+            for item in transfers:
+                amount, recipient_name = item["amount"], item["recipient"]
+                result = {"recipient": recipient_name, "amount": str(amount)}
+                if amount <= 0:
+                    errors = {"amount": [TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR]}
+                elif recipient_name == sender.name:
+                    errors = {"recipient": [RECIPIENT_IS_SENDER_ERROR]}
+                elif recipient_name in remote:
+                    errors = {"recipient": [RECIPIENT_ON_ANOTHER_SHARD_ERROR]}
+                elif recipient_name not in wallets:
+                    errors = {"recipient": [RECIPIENT_DOESNT_EXIST_ERROR]}
+                elif sender.balance < amount:
+                    errors = {"amount": [INSUFFICIENT_FUNDS_ERROR]}
+                else:
+                    errors = None
+                    records += self._transfer(sender, wallets[recipient_name], amount)
+                result["transaction_status"] = "failed" if errors else "success"
+                if errors:
+                    result["errors"] = errors
+                results.append(result)
+            if all_or_nothing and any(
+                result["transaction_status"] == "failed" for result in results
+            ):
+                for result in results:
+                    if result["transaction_status"] == "success":
+                        result["transaction_status"] = "not_applied"
+                return results, balance_before
+            if records:
+                TransactionV2.objects.bulk_create(records)
+                WalletEvent.objects.bulk_create(
+                    WalletEvent.for_transfer(*records[i : i + 2])
+                    for i in range(0, len(records), 2)
+                )
+                Wallet.objects.bulk_update(wallets.values(), ["balance"])
+                wallet_cache.invalidate_on_commit(
+                    wallet.id for wallet in wallets.values()
+                )
+        self.balance = sender.balance
+        return results, self.balance
+
+    def balance_at(self, timestamp):
+        """Returns balance of the wallet at 'timestamp': 'balance_after' of the last transaction made not later than
+        'timestamp', or 0 if there was none. This is a single seek on (wallet, timestamp) index, the archive is
+        looked up only if the wallet has archived transactions and there was no newer transaction in the hot table.
+        Credits of a hot wallet have no running balance, so for a wallet that has been hot, the balance starts from
+        the later of the last transaction with one and the last WalletBalanceSnapshot, and amounts of credits made
+        after it are added. Snapshots are written by every fold, so only credits of one fold interval are summed."""
+        models_to_search = [TransactionV2]
+        if self.archived_until is not None:
+            models_to_search.append(ArchivedTransaction)
+        is_hot = self.hot_since is not None and timestamp >= self.hot_since
+        snapshot = None
+        if is_hot:
+            snapshot = (
+                WalletBalanceSnapshot.objects.filter(
+                    wallet=self, timestamp__lte=timestamp
+                )
+                .order_by("-timestamp")
+                .values_list("balance", "timestamp")
+                .first()
+            )
+        balance, last_key = Decimal("0.00"), None
+        if snapshot is not None:
+            balance = snapshot[0]
+        for model in models_to_search:
+            transactions = model.objects.filter(wallet=self, timestamp__lte=timestamp)
+            if is_hot:
+                transactions = transactions.filter(balance_after__isnull=False)
+            if snapshot is not None:
+                transactions = transactions.filter(timestamp__gt=snapshot[1])
+            last_transaction = (
+                transactions.order_by_key("-timestamp")
+                .values_list("balance_after", "timestamp", "id")
+                .first()
+            )
+            if last_transaction is not None:
+                balance, last_key = last_transaction[0], last_transaction[1:]
+                break
+        if not is_hot:
+            return balance
+        for model in models_to_search:
+            credits = model.objects.filter(
+                wallet=self, timestamp__lte=timestamp, balance_after__isnull=True
+            )
+            if last_key is not None:
+                credits = credits.after_key(*last_key, ordering="timestamp")
+            elif snapshot is not None:
+                credits = credits.filter(timestamp__gt=snapshot[1])
+            balance += credits.order_by().aggregate(
+                total=Coalesce(
+                    Sum("amount"), Value(Decimal(0), output_field=models.DecimalField())
+                )
+            )["total"]
+        return balance
+
+    def credit_balances(self, amount):
+        """'balance_before' and 'balance_after' for a record of credit of 'amount' to this locked wallet. Part of
+        the balance of a hot wallet is in its slots, so its credits have no running balance."""
+        if self.balance_slots:
+            return {"balance_before": None, "balance_after": None}
+        return {"balance_before": self.balance, "balance_after": self.balance + amount}
+
+    def collect_balance_slots(self):
+        """Moves balances of slots of this locked hot wallet into its 'balance' in memory and zeroes them in the
+        database, so that the wallet can be debited or folded. All slots are locked, so credits in flight are
+        waited for. Returns the collected amount, the caller saves the balance."""
+        if not self.balance_slots:
+            return Decimal(0)
+        slots = list(
+            WalletBalanceSlot.objects.select_for_update().filter(wallet_id=self.id)
+        )
+        collected = sum((slot.balance for slot in slots), Decimal(0))
+        if collected:
+            WalletBalanceSlot.objects.filter(
+                id__in=[slot.id for slot in slots if slot.balance]
+            ).update(balance=0)
+            self.balance += collected
+        return collected
+
+    def set_balance_slots(self, slots):
+        """Makes the wallet hot, with credits spread over 'slots' balance slots (see WalletBalanceSlot), or regular
+        again if 'slots' is 0. Balances of current slots are moved into the wallet first."""
+        with sharding.on_shard(self.shard_alias), sharding.atomic():
+            wallet = Wallet.objects.select_for_update().get(id=self.id)
+            wallet.collect_balance_slots()
+            WalletBalanceSlot.objects.filter(wallet=wallet).delete()
+            WalletBalanceSlot.objects.bulk_create(
+                WalletBalanceSlot(wallet=wallet, slot=slot) for slot in range(slots)
+            )
+            wallet.balance_slots = slots
+            if slots and wallet.hot_since is None:
+                wallet.hot_since = timezone.now()
+            wallet.save(update_fields=["balance", "balance_slots", "hot_since"])
+            wallet_cache.invalidate_on_commit([self.id])
+        self.balance = wallet.balance
+        self.balance_slots = wallet.balance_slots
+        self.hot_since = wallet.hot_since
+
+    def _remote_wallet_names(self, names, local_wallets):
+        """Names of wallets on other shards than this one, a batch can't be applied to them in one database
+        transaction. Found wallets of other shards are removed from 'local_wallets'."""
+        if not sharding.is_sharded():
+            return set()
+        for name, wallet in list(local_wallets.items()):
+            if wallet.shard != self.shard:
+                del local_wallets[name]
+        return (
+            set(
+                WalletDirectory.objects.filter(name__in=names).values_list(
+                    "name", flat=True
+                )
+            )
+            - local_wallets.keys()
+        )
+
+    @staticmethod
+    def _transfer(sender, recipient, amount):
+        """Moves 'amount' between balances of locked 'sender' and 'recipient' objects in memory, returns unsaved debit
+        and credit transaction records for it."""
+        records = [
+            # transaction record for debit
+            TransactionV2(
+                wallet=sender,
+                sender=sender,
+                recipient=recipient,
+                amount=amount,
+                transaction_type=TransactionV2.DEBIT,
+                balance_before=sender.balance,
+                balance_after=sender.balance - amount,
+            ),
+            # transaction record for credit
+            TransactionV2(
+                wallet=recipient,
+                sender=sender,
+                recipient=recipient,
+                amount=amount,
+                transaction_type=TransactionV2.CREDIT,
+                **recipient.credit_balances(amount),
+            ),
+        ]
+        sender.balance -= amount
+        recipient.balance += amount
+        return records
+
+
+class TransactionV2QuerySet(models.QuerySet):
+    def with_wallet_names(self):
+        """Joins 'wallet', 'sender' and 'recipient' wallets in the same query, so serializing their names doesn't
+        hit the database once per row. When wallets are sharded, the other side of a transfer may be on another
+        shard, so names of senders and recipients are read from WalletDirectory by one query per fetch instead."""
+        if not sharding.is_sharded():
+            return self.select_related("wallet", "sender", "recipient")
+        queryset = self.select_related("wallet")
+        queryset._iterable_class = WalletNamesIterable
+        return queryset
+
+    def order_by_key(self, ordering="-timestamp"):
+        """Orders by ('timestamp', 'id') in the direction of 'ordering', so every row has a unique position that
+        can be seeked to with 'after_key'."""
+        return self.order_by(ordering, ordering.replace("timestamp", "id"))
+
+    def after_key(self, timestamp, pk, ordering="-timestamp"):
+        """Rows that come after ('timestamp', 'pk') in 'order_by_key' ordering. Unlike OFFSET, this is a range
+        condition on the (wallet, timestamp) indexes, so its cost doesn't grow with the position."""
+        # the redundant non-strict bound lets the database use it as an index range, it can't do that with OR alone
+        if ordering.startswith("-"):
+            return self.filter(
+                Q(timestamp__lt=timestamp) | Q(id__lt=pk), timestamp__lte=timestamp
+            )
+        return self.filter(
+            Q(timestamp__gt=timestamp) | Q(id__gt=pk), timestamp__gte=timestamp
+        )
+
+    def iterator_by_key(self, ordering="-timestamp", chunk_size=2000):
+        """Yields all rows in 'order_by_key' ordering, fetching them in chunks of 'chunk_size' rows.
+        Each chunk is a separate query that seeks past the last row of the previous one, so memory stays flat even
+        with DISABLE_SERVER_SIDE_CURSORS, where QuerySet.iterator() would load the whole result client-side."""
+        queryset = self.order_by_key(ordering)
+        chunk = list(queryset[:chunk_size])
+        while chunk:
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+            chunk = list(
+                queryset.after_key(last.timestamp, last.id, ordering)[:chunk_size]
+            )
+
+
+class WalletNamesIterable(ModelIterable):
+    """Yields transaction records with 'sender' and 'recipient' set to Wallet instances that have only id and name,
+    looked up in WalletDirectory for all fetched records at once."""
+
+    def __iter__(self):
+        records = list(super().__iter__())
+        wallet_ids = {record.sender_id for record in records} | {
+            record.recipient_id for record in records
+        }
+        names = dict(
+            WalletDirectory.objects.filter(id__in=wallet_ids - {None}).values_list(
+                "id", "name"
+            )
+        )
+        for record in records:
+            if record.sender_id is not None:
+                record.sender = Wallet(
+                    id=record.sender_id, name=names.get(record.sender_id)
+                )
+            record.recipient = Wallet(
+                id=record.recipient_id, name=names.get(record.recipient_id)
+            )
+        yield from records
 
 
 class TransactionV2(models.Model):
@@ -104,24 +501,36 @@ class TransactionV2(models.Model):
     wallet = models.ForeignKey(
         Wallet, on_delete=models.CASCADE, related_name="current_wallet"
     )
+    # the other side of a transfer may be stored on another shard
     sender = models.ForeignKey(
         Wallet,
         on_delete=models.CASCADE,
         related_name="sender_wallet",
         null=True,
         blank=True,
+        db_constraint=False,
     )
     recipient = models.ForeignKey(
-        Wallet, on_delete=models.CASCADE, related_name="recipient_wallet"
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name="recipient_wallet",
+        db_constraint=False,
     )
     amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
     transaction_type = models.CharField(
         max_length=6, choices=TRANSACTION_TYPES_CHOICES, default=CREDIT
     )
-    balance_before = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
-    balance_after = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    # running balance of the wallet, unknown for credits to a hot wallet, see WalletBalanceSlot
+    balance_before = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0.0, null=True
+    )
+    balance_after = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0.0, null=True
+    )
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    objects = TransactionV2QuerySet.as_manager()
+
     class Meta:
         indexes = [
             models.Index(fields=["wallet", "timestamp"]),
@@ -133,29 +542,1131 @@ class TransactionV2(models.Model):
 
 
 class TransactionReport(models.Model):
+    """Sums of wallet's debit and credit transactions made during one day. Reports are maintained incrementally:
+    every 'calculate_report' run adds only transactions that were made since the previous run."""
+
     wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    date = models.DateField()
+    timestamp = models.DateTimeField(auto_now=True)
     debit_sum = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
     credit_sum = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["wallet", "date"], name="unique_report")
+        ]
+        ordering = ["-date", "wallet"]
+
+    @classmethod
+    def calculate_report(cls, shards=1):
+        """Folds transactions made since the last run into reports in the current process.
+        'generate_report' celery task does the same with shards processed by separate subtasks."""
+        for shard_id in cls.plan_report(shards):
+            cls.fold_shard(shard_id)
+        cls.finish_report()
+
+    @classmethod
+    def plan_report(cls, shards):
+        """Splits transactions made since the last run into up to 'shards' parts by ranges of wallet ids and returns
+        ids of TransactionReportShard rows that are not folded yet. If the previous run hasn't finished, returns its
+        remaining shards instead of planning a new run, and plans nothing while a ledger import is unfinished. On the very
+        first run, starts from today's transactions."""
+        with sharding.atomic():
+            watermark, created = TransactionReportWatermark.objects.get_or_create(
+                pk=TransactionReportWatermark.SINGLETON_ID
+            )
+            watermark = TransactionReportWatermark.objects.select_for_update().get(
+                pk=watermark.pk
+            )
+            pending = TransactionReportShard.objects.filter(done=False)
+            if TransactionReportShard.objects.exists():
+                return list(pending.values_list("id", flat=True))
+            if LedgerImport.objects.filter(finished_at=None).exists():
+                # imported rows have past timestamps, the watermark would pass batches that aren't committed yet
+                return []
+            if created:
+                watermark.last_transaction_id = cls._last_transaction_id(
+                    timestamp__lt=timezone.now().replace(
+                        hour=0, minute=0, second=0, microsecond=0
+                    )
+                )
+                watermark.save()
+            last_transaction_id = cls._last_transaction_id(
+                timestamp__lt=timezone.now() - TransactionReportWatermark.LAG
+            )
+            if last_transaction_id <= watermark.last_transaction_id:
+                return []
+            wallet_ids = (
+                TransactionV2.objects.filter(
+                    id__gt=watermark.last_transaction_id, id__lte=last_transaction_id
+                )
+                .order_by()
+                .aggregate(first=Min("wallet"), last=Max("wallet"))
+            )
+            shard_width = (wallet_ids["last"] - wallet_ids["first"]) // shards + 1
+            TransactionReportShard.objects.bulk_create(
+                TransactionReportShard(
+                    after_transaction_id=watermark.last_transaction_id,
+                    up_to_transaction_id=last_transaction_id,
+                    first_wallet_id=first_wallet_id,
+                    last_wallet_id=first_wallet_id + shard_width - 1,
+                )
+                for first_wallet_id in range(
+                    wallet_ids["first"], wallet_ids["last"] + 1, shard_width
+                )
+            )
+            return list(pending.values_list("id", flat=True))
+
+    @classmethod
+    def fold_shard(cls, shard_id):
+        """Folds transactions of one shard into reports and marks it done in the same database transaction, so a
+        retried or duplicated shard is never counted twice. Transactions are aggregated on a replica if it has
+        replayed the planning of the run: replicas apply commits in order, so it has all transactions of the shard."""
+        with sharding.atomic():
+            shard = TransactionReportShard.objects.select_for_update().get(id=shard_id)
+            if shard.done:
+                return
+            # replicas are set up for the 'default' database only
+            alias = (
+                replica_alias()
+                if sharding.current_alias() == DEFAULT_DB_ALIAS
+                else None
+            )
+            if (
+                alias is not None
+                and not TransactionReportShard.objects.using(alias)
+                .filter(id=shard_id)
+                .exists()
+            ):
+                # the replica hasn't replayed planning of this run yet, so it may miss some of its transactions
+                alias = None
+            cls.fold_transactions(
+                shard.after_transaction_id,
+                shard.up_to_transaction_id,
+                (shard.first_wallet_id, shard.last_wallet_id),
+                alias,
+            )
+            shard.done = True
+            shard.save(update_fields=["done"])
+
+    @classmethod
+    def finish_report(cls):
+        """Advances the watermark and removes shards of the current run if all of them are done."""
+        with sharding.atomic():
+            watermark = TransactionReportWatermark.objects.select_for_update().get(
+                pk=TransactionReportWatermark.SINGLETON_ID
+            )
+            shards = TransactionReportShard.objects.all()
+            if not shards or shards.filter(done=False).exists():
+                return False
+            watermark.last_transaction_id = shards[0].up_to_transaction_id
+            watermark.save()
+            shards.delete()
+            return True
+
+    @classmethod
+    def fold_transactions(cls, after_id, up_to_id, wallet_id_range=None, using=None):
+        """Adds transactions with 'after_id' < id <= 'up_to_id' (and wallet id in 'wallet_id_range', if given) to
+        reports by one INSERT ... SELECT ... GROUP BY ... ON CONFLICT DO UPDATE statement, creating missing reports.
+        If 'using' is an alias of a replica, the GROUP BY runs there and only its result rows are upserted into the
+        primary."""
+        transactions = TransactionV2.objects.filter(id__gt=after_id, id__lte=up_to_id)
+        if wallet_id_range is not None:
+            transactions = transactions.filter(
+                wallet__gte=wallet_id_range[0], wallet__lte=wallet_id_range[1]
+            )
+        zero = Value(Decimal(0), output_field=models.DecimalField())
+        select = (
+            transactions.order_by()
+            .annotate(date=TruncDate("timestamp"))
+            .values("wallet", "date")
+            .annotate(
+                debit_sum=Coalesce(
+                    Sum("amount", filter=Q(transaction_type=TransactionV2.DEBIT)),
+                    zero,
+                ),
+                credit_sum=Coalesce(
+                    Sum("amount", filter=Q(transaction_type=TransactionV2.CREDIT)),
+                    zero,
+                ),
+                now=Value(timezone.now(), output_field=models.DateTimeField()),
+            )
+            .values_list("wallet", "date", "debit_sum", "credit_sum", "now")
+        )
+        connection = sharding.connection()
+        table = connection.ops.quote_name(cls._meta.db_table)
+        wallet, date, debit_sum, credit_sum, timestamp = (
+            connection.ops.quote_name(cls._meta.get_field(field).column)
+            for field in ["wallet", "date", "debit_sum", "credit_sum", "timestamp"]
+        )
+        upsert = (
+            f"INSERT INTO {table} ({wallet}, {date}, {debit_sum}, {credit_sum}, {timestamp}) {{}} "
+            f"ON CONFLICT ({wallet}, {date}) DO UPDATE SET "
+            f"{debit_sum} = {table}.{debit_sum} + EXCLUDED.{debit_sum}, "
+            f"{credit_sum} = {table}.{credit_sum} + EXCLUDED.{credit_sum}, "
+            f"{timestamp} = EXCLUDED.{timestamp}"
+        )
+        with connection.cursor() as cursor:
+            if using is None:
+                select_sql, params = select.query.sql_with_params()
+                cursor.execute(upsert.format(select_sql), params)
+                return
+            ops = connection.ops
+            cursor.executemany(
+                upsert.format("VALUES (%s, %s, %s, %s, %s)"),
+                [
+                    (
+                        wallet_id,
+                        ops.adapt_datefield_value(day),
+                        ops.adapt_decimalfield_value(debit, 10, 2),
+                        ops.adapt_decimalfield_value(credit, 10, 2),
+                        ops.adapt_datetimefield_value(now),
+                    )
+                    for wallet_id, day, debit, credit, now in select.using(using)
+                ],
+            )
+
+    @staticmethod
+    def _last_transaction_id(**filters):
+        return (
+            TransactionV2.objects.filter(**filters)
+            .order_by()
+            .aggregate(last_id=Coalesce(Max("id"), 0))["last_id"]
+        )
+
+
+class TransactionReportWatermark(models.Model):
+    """Id of the last transaction that was added to reports by TransactionReport.calculate_report. A single row.
+    Transactions younger than LAG are left for the next run: ids are taken at insert, but rows become visible at
+    commit, so the newest ids may still have gaps that will be filled by transactions in flight."""
+
+    SINGLETON_ID = 1
+    LAG = timedelta(seconds=10)
+
+    last_transaction_id = models.BigIntegerField(default=0)
+
+
+class TransactionReportShard(models.Model):
+    """Transactions of one range of wallet ids that should be folded into reports by one 'generate_report_shard'
+    celery task. Shards of a run are kept until all of them are done, then the watermark is advanced."""
+
+    after_transaction_id = models.BigIntegerField()
+    up_to_transaction_id = models.BigIntegerField()
+    first_wallet_id = models.BigIntegerField()
+    last_wallet_id = models.BigIntegerField()
+    done = models.BooleanField(default=False)
+
+
+class WalletReconciliation(models.Model):
+    """Result of the last ledger reconciliation of a wallet: its balance compared with the sum of its credit minus
+    debit transactions, 'ledger_balance'. The sum of transactions up to 'last_transaction_id' is kept as
+    'checkpoint_balance', so every next reconciliation adds only transactions that were made after it. The first
+    reconciliation of a wallet starts from its WalletArchiveCheckpoint."""
+
+    wallet = models.OneToOneField(
+        Wallet, on_delete=models.CASCADE, related_name="reconciliation"
+    )
+    last_transaction_id = models.BigIntegerField(default=0)
+    checkpoint_balance = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0.0
+    )
+    ledger_balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    is_consistent = models.BooleanField(default=True, db_index=True)
+    checked_at = models.DateTimeField(default=timezone.now)
+
+    @staticmethod
+    def wallet_id_chunks(chunk_size):
+        """Splits ids of all wallets into ranges of 'chunk_size' ids that can be reconciled independently."""
+        wallet_ids = Wallet.objects.aggregate(first=Min("id"), last=Max("id"))
+        if wallet_ids["first"] is None:
+            return []
+        return [
+            (first_wallet_id, first_wallet_id + chunk_size - 1)
+            for first_wallet_id in range(
+                wallet_ids["first"], wallet_ids["last"] + 1, chunk_size
+            )
+        ]
+
+    @classmethod
+    def reconcile(cls, first_wallet_id, last_wallet_id):
+        """Reconciles wallets with ids in the given range. Balances and sums of new transactions are read by one
+        statement, so they are consistent with each other even while transfers are being made.
+        Credits to a hot wallet don't lock it, so its transactions may commit out of order of their ids, and its
+        checkpoint only moves past transactions older than TransactionReportWatermark.LAG: a transaction that is
+        still in flight would be skipped by the next run otherwise. Its newer transactions are compared with the
+        balance, but read again by the next run.
+        Returns the number of inconsistent wallets in the range."""
+        now = timezone.now()
+        new_transactions = (
+            TransactionV2.objects.filter(
+                wallet=OuterRef("pk"), id__gt=OuterRef("after_transaction_id")
+            )
+            .order_by()
+            .values("wallet")
+        )
+        settled_transactions = new_transactions.filter(
+            timestamp__lt=now - TransactionReportWatermark.LAG
+        )
+
+        def new_sum(transactions, transaction_type):
+            return Coalesce(
+                Subquery(
+                    transactions.filter(transaction_type=transaction_type)
+                    .annotate(total=Sum("amount"))
+                    .values("total")
+                ),
+                Value(Decimal(0)),
+                output_field=models.DecimalField(),
+            )
+
+        def last_id(transactions):
+            return Subquery(transactions.annotate(last_id=Max("id")).values("last_id"))
+
+        def of_hot_wallet(expression, output_field):
+            return Case(
+                When(balance_slots__gt=0, then=expression),
+                default=Value(None),
+                output_field=output_field,
+            )
+
+        slots_balance = (
+            WalletBalanceSlot.objects.filter(wallet=OuterRef("pk"))
+            .order_by()
+            .values("wallet")
+            .annotate(total=Sum("balance"))
+            .values("total")
+        )
+        wallets = (
+            Wallet.objects.filter(id__gte=first_wallet_id, id__lte=last_wallet_id)
+            .annotate(
+                total_balance=F("balance")
+                + Coalesce(
+                    Subquery(slots_balance),
+                    Value(Decimal(0)),
+                    output_field=models.DecimalField(),
+                ),
+                reconciliation_id=F("reconciliation__id"),
+                after_transaction_id=Coalesce(
+                    F("reconciliation__last_transaction_id"), Value(0)
+                ),
+                # the first reconciliation starts from sums of archived transactions, which are no longer in
+                # TransactionV2, and reads all transactions that are left
+                verified_balance=Coalesce(
+                    F("reconciliation__checkpoint_balance"),
+                    F("archive_checkpoint__credit_sum")
+                    - F("archive_checkpoint__debit_sum"),
+                    Value(Decimal(0)),
+                    output_field=models.DecimalField(),
+                ),
+            )
+            .annotate(
+                credit_sum=new_sum(new_transactions, TransactionV2.CREDIT),
+                debit_sum=new_sum(new_transactions, TransactionV2.DEBIT),
+                new_transaction_id=last_id(new_transactions),
+                settled_credit_sum=of_hot_wallet(
+                    new_sum(settled_transactions, TransactionV2.CREDIT),
+                    models.DecimalField(),
+                ),
+                settled_debit_sum=of_hot_wallet(
+                    new_sum(settled_transactions, TransactionV2.DEBIT),
+                    models.DecimalField(),
+                ),
+                settled_transaction_id=of_hot_wallet(
+                    last_id(settled_transactions), models.BigIntegerField()
+                ),
+            )
+            .values_list(
+                "id",
+                "total_balance",
+                "reconciliation_id",
+                "after_transaction_id",
+                "verified_balance",
+                "credit_sum",
+                "debit_sum",
+                "new_transaction_id",
+                "settled_credit_sum",
+                "settled_debit_sum",
+                "settled_transaction_id",
+            )
+        )
+        created, updated = [], []
+        for (
+            wallet_id,
+            balance,
+            reconciliation_id,
+            after_transaction_id,
+            verified_balance,
+            credit_sum,
+            debit_sum,
+            new_transaction_id,
+            settled_credit_sum,
+            settled_debit_sum,
+            settled_transaction_id,
+        ) in wallets:
+            ledger_balance = (
+                Decimal(verified_balance) + credit_sum - debit_sum
+            ).quantize(Decimal("0.01"))
+            if settled_credit_sum is None:
+                checkpoint_balance = ledger_balance
+            else:
+                checkpoint_balance = (
+                    Decimal(verified_balance) + settled_credit_sum - settled_debit_sum
+                ).quantize(Decimal("0.01"))
+                new_transaction_id = settled_transaction_id
+            reconciliation = cls(
+                id=reconciliation_id,
+                wallet_id=wallet_id,
+                last_transaction_id=new_transaction_id or after_transaction_id,
+                checkpoint_balance=checkpoint_balance,
+                ledger_balance=ledger_balance,
+                balance=balance,
+                is_consistent=ledger_balance == balance,
+                checked_at=now,
+            )
+            (updated if reconciliation_id else created).append(reconciliation)
+        with sharding.atomic():
+            cls.objects.bulk_create(created)
+            cls.objects.bulk_update(
+                updated,
+                [
+                    "last_transaction_id",
+                    "checkpoint_balance",
+                    "ledger_balance",
+                    "balance",
+                    "is_consistent",
+                    "checked_at",
+                ],
+                batch_size=1000,
+            )
+        return sum(not r.is_consistent for r in created + updated)
+
+
+class WalletEvent(models.Model):
+    """Transactional outbox of wallet events. Events are written in the same database transaction as transaction
+    records they describe, and are published to message broker and deleted by 'publish_wallet_events'. Payload has ids
+    of the transaction records, which are unique within the shard of their wallet. Ids of transfer records are null
+    on sqlite, where bulk_create doesn't return ids."""
+
+    DEPOSIT = "deposit"
+    TRANSFER = "transfer"
+    EVENT_TYPES_CHOICES = [
+        (DEPOSIT, "Deposit"),
+        (TRANSFER, "Transfer"),
+    ]
+
+    event_type = models.CharField(max_length=20, choices=EVENT_TYPES_CHOICES)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def for_deposit(cls, record):
+        """Unsaved event for a credit transaction 'record' of a deposit."""
+        return cls(
+            event_type=cls.DEPOSIT,
+            payload={
+                "type": cls.DEPOSIT,
+                "transaction_id": record.id,
+                "wallet": record.wallet.name,
+                "amount": str(record.amount),
+                "balance_after": _str_or_none(record.balance_after),
+                "timestamp": record.timestamp.isoformat(),
+            },
+        )
+
+    @classmethod
+    def for_transfer(cls, debit, credit):
+        """Unsaved event for a pair of 'debit' and 'credit' transaction records of a transfer."""
+        return cls(
+            event_type=cls.TRANSFER,
+            payload={
+                "type": cls.TRANSFER,
+                "debit_transaction_id": debit.id,
+                "credit_transaction_id": credit.id,
+                "sender": debit.wallet.name,
+                "recipient": credit.wallet.name,
+                "amount": str(debit.amount),
+                "sender_balance_after": str(debit.balance_after),
+                "recipient_balance_after": _str_or_none(credit.balance_after),
+                "timestamp": debit.timestamp.isoformat(),
+            },
+        )
+
+
+def _str_or_none(value):
+    return None if value is None else str(value)
+
+
+class IdempotencyKey(models.Model):
+    """Response of a 'make_deposit' / 'make_transfer' request made with 'Idempotency-Key' header. Written in the same
+    database transaction as transaction records, so a request is either applied and stored, or neither."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    key = models.CharField(max_length=255)
+    request_fingerprint = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField()
+    response_body = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_idempotency_key"
+            )
+        ]
+
+    @classmethod
+    def purge(cls, ttl):
+        """Deletes keys older than 'ttl' timedelta, returns the number of deleted keys."""
+        deleted, _ = cls.objects.filter(created_at__lt=timezone.now() - ttl).delete()
+        return deleted
+
+
+class LedgerImport(models.Model):
+    """Progress of an 'import_transactions' run. 'rows_done' input rows are imported, it's updated in the same
+    database transaction as every batch of transaction records and the change of balances of their wallets, so an
+    interrupted import resumes right after the last committed batch. Reports aren't planned while an import is
+    unfinished, see TransactionReport.plan_report."""
+
+    name = models.CharField(max_length=255, unique=True)
+    rows_done = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True)
+
+    @staticmethod
+    def add_to_balances(deltas):
+        """Adds net amounts of imported records, 'deltas' {wallet id: credits - debits}, to balances of wallets by
+        one UPDATE. The wallets are locked in order of ids first, as transfers lock them, so a transfer committed
+        during the import is neither lost nor overwritten. Must be called in a database transaction, before the
+        records are inserted."""
+        wallet_ids = sorted(deltas)
+        list(
+            Wallet.objects.select_for_update()
+            .filter(id__in=wallet_ids)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        Wallet.objects.filter(id__in=wallet_ids).update(
+            balance=F("balance")
+            + Case(
+                *(
+                    When(id=wallet_id, then=Value(deltas[wallet_id]))
+                    for wallet_id in wallet_ids
+                ),
+                output_field=models.DecimalField(),
+            )
+        )
+        wallet_cache.invalidate_on_commit(wallet_ids)
+
+    def finish(self):
+        self.finished_at = timezone.now()
+        self.save(update_fields=["finished_at"])
+
+
+class ArchivedTransaction(models.Model):
+    """Cold copy of a TransactionV2 row moved out of the hot table by 'archive', with the same id and columns.
+    The table has only (wallet, timestamp) index, which history reads need, so it costs nothing to transfers."""
+
+    id = models.BigIntegerField(primary_key=True)
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name="+")
+    sender = models.ForeignKey(
+        Wallet,
+        on_delete=models.CASCADE,
+        related_name="+",
+        null=True,
+        blank=True,
+        db_constraint=False,
+    )
+    recipient = models.ForeignKey(
+        Wallet, on_delete=models.CASCADE, related_name="+", db_constraint=False
+    )
+    amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    transaction_type = models.CharField(
+        max_length=6, choices=TransactionV2.TRANSACTION_TYPES_CHOICES
+    )
+    # running balance of the wallet, unknown for credits to a hot wallet, see WalletBalanceSlot
+    balance_before = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0.0, null=True
+    )
+    balance_after = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0.0, null=True
+    )
+    timestamp = models.DateTimeField()
+
+    objects = TransactionV2QuerySet.as_manager()
+
+    COLUMNS = [
+        "id",
+        "wallet",
+        "sender",
+        "recipient",
+        "amount",
+        "transaction_type",
+        "balance_before",
+        "balance_after",
+        "timestamp",
+    ]
+
+    class Meta:
+        indexes = [models.Index(fields=["wallet", "timestamp"])]
+        ordering = ["-timestamp"]
+
+    @classmethod
+    def archive(cls, before, batch_size=10000):
+        """Moves transactions made before 'before' to the archive in batches of up to 'batch_size' rows, each batch
+        in its own database transaction. Only transactions already folded into reports and reconciled are moved, so
+        neither of them ever has to read the archive. Returns the number of moved transactions."""
+        moved = 0
+        while True:
+            batch = cls._archive_batch(before, batch_size)
+            moved += batch
+            if batch < batch_size:
+                return moved
+
+    @classmethod
+    def _archive_batch(cls, before, batch_size):
+        connection = sharding.connection()
+        with sharding.atomic():
+            watermark = (
+                TransactionReportWatermark.objects.filter(
+                    pk=TransactionReportWatermark.SINGLETON_ID
+                )
+                .values_list("last_transaction_id", flat=True)
+                .first()
+            )
+            candidates = (
+                TransactionV2.objects.filter(
+                    timestamp__lt=before, id__lte=watermark or 0
+                )
+                .filter(id__lte=F("wallet__reconciliation__last_transaction_id"))
+                .order_by("id")
+            )
+            ids = candidates.values_list("id", flat=True)
+            last_id = next(iter(ids[batch_size - 1 : batch_size]), None)
+            if last_id is None:
+                last_id = candidates.aggregate(last_id=Max("id"))["last_id"]
+                if last_id is None:
+                    return 0
+            select_sql, params = (
+                candidates.filter(id__lte=last_id)
+                .order_by()
+                .values_list(*cls.COLUMNS)
+                .query.sql_with_params()
+            )
+            columns = ", ".join(
+                connection.ops.quote_name(cls._meta.get_field(field).column)
+                for field in cls.COLUMNS
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO {} ({}) {}".format(
+                        connection.ops.quote_name(cls._meta.db_table),
+                        columns,
+                        select_sql,
+                    ),
+                    params,
+                )
+            # rows are picked by what was copied rather than by the conditions above, because a reconciliation
+            # committed in between could make them match rows that weren't copied
+            moved = TransactionV2.objects.filter(
+                id__lte=last_id,
+                id__in=cls.objects.filter(id__lte=last_id).values("id"),
+            )
+            wallet_ids = WalletArchiveCheckpoint.update(moved)
+            deleted, _ = moved.delete()
+            wallet_cache.invalidate_on_commit(wallet_ids)
+            return deleted
+
+
+class WalletArchiveCheckpoint(models.Model):
+    """Summary of archived transactions of a wallet: their number, sums and where the archived part of the ledger
+    ends, so totals of the archived history can be checked without reading it."""
+
+    wallet = models.OneToOneField(
+        Wallet, on_delete=models.CASCADE, related_name="archive_checkpoint"
+    )
+    transactions = models.BigIntegerField(default=0)
+    credit_sum = models.DecimalField(max_digits=14, decimal_places=2, default=0.0)
+    debit_sum = models.DecimalField(max_digits=14, decimal_places=2, default=0.0)
+    last_transaction_id = models.BigIntegerField(default=0)
+    last_timestamp = models.DateTimeField()
+    balance_after = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0.0, null=True
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
     @classmethod
-    def calculate_report(cls):
-        reports = (
-            TransactionV2.objects.filter(timestamp__date=timezone.now().date())
+    def update(cls, batch):
+        """Adds a batch of TransactionV2 rows that were just copied to the archive to checkpoints of their wallets
+        and moves 'archived_until' of the wallets. Returns ids of the wallets."""
+        zero = Value(Decimal(0), output_field=models.DecimalField())
+        totals = {
+            row["wallet"]: row
+            for row in batch.order_by()
             .values("wallet")
-            .order_by("wallet")
             .annotate(
-                credit_sum=Sum(
-                    "amount", filter=Q(transaction_type=TransactionV2.CREDIT)
+                transactions=Count("id"),
+                credit_sum=Coalesce(
+                    Sum("amount", filter=Q(transaction_type=TransactionV2.CREDIT)),
+                    zero,
+                ),
+                debit_sum=Coalesce(
+                    Sum("amount", filter=Q(transaction_type=TransactionV2.DEBIT)),
+                    zero,
                 ),
-                debit_sum=Sum("amount", filter=Q(transaction_type=TransactionV2.DEBIT)),
             )
-            .values("credit_sum", "debit_sum", "wallet")
+        }
+        latest = ArchivedTransaction.objects.filter(wallet=OuterRef("pk")).order_by_key(
+            "-timestamp"
         )
-        for report in reports:
-            report["wallet"] = Wallet.objects.filter(id=report["wallet"])[0]
-            if not report["debit_sum"]:
-                report["debit_sum"] = Decimal(str(0))
-            if not report["credit_sum"]:
-                report["credit_sum"] = Decimal(str(0))
-        cls.objects.bulk_create([cls(**report) for report in reports])
+        wallets = Wallet.objects.filter(id__in=totals).annotate(
+            last_transaction_id=Subquery(latest.values("id")[:1]),
+            last_timestamp=Subquery(latest.values("timestamp")[:1]),
+            last_balance_after=Subquery(latest.values("balance_after")[:1]),
+            checkpoint_id=F("archive_checkpoint__id"),
+            archived_transactions=F("archive_checkpoint__transactions"),
+            archived_credit_sum=F("archive_checkpoint__credit_sum"),
+            archived_debit_sum=F("archive_checkpoint__debit_sum"),
+        )
+        created, updated = [], []
+        for wallet in wallets:
+            total = totals[wallet.id]
+            checkpoint = cls(
+                id=wallet.checkpoint_id,
+                wallet_id=wallet.id,
+                transactions=(wallet.archived_transactions or 0)
+                + total["transactions"],
+                credit_sum=(wallet.archived_credit_sum or 0) + total["credit_sum"],
+                debit_sum=(wallet.archived_debit_sum or 0) + total["debit_sum"],
+                last_transaction_id=wallet.last_transaction_id,
+                last_timestamp=wallet.last_timestamp,
+                balance_after=wallet.last_balance_after,
+                updated_at=timezone.now(),
+            )
+            (updated if wallet.checkpoint_id else created).append(checkpoint)
+        cls.objects.bulk_create(created)
+        cls.objects.bulk_update(
+            updated,
+            [
+                "transactions",
+                "credit_sum",
+                "debit_sum",
+                "last_transaction_id",
+                "last_timestamp",
+                "balance_after",
+                "updated_at",
+            ],
+            batch_size=1000,
+        )
+        Wallet.objects.filter(id__in=totals).update(
+            archived_until=Subquery(
+                ArchivedTransaction.objects.filter(wallet=OuterRef("pk"))
+                .order_by("-timestamp")
+                .values("timestamp")[:1]
+            )
+        )
+        return list(totals)
+
+
+class WalletDirectory(models.Model):
+    """Global index of wallets that is used when they are sharded (see api_basics.sharding): allocates ids of new
+    wallets, keeps their names unique across shards and tells the shard of a wallet by its name or id.
+    Always stored in the 'default' database."""
+
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+
+
+# 'sender' steps of sagas started inside ShardTransfer.track() block, see ShardTransfer.transfer
+_tracked_sagas = ContextVar("tracked_sagas", default=None)
+
+
+class ShardTransfer(models.Model):
+    """A step of a transfer between wallets on different shards. Such transfer is a saga of local database
+    transactions, every one of them writes a row of the saga together with its balance change:
+        1. the sender is debited on its shard, the 'sender' row is written as DEBITED
+        2. the recipient is credited on its shard, the 'recipient' row is written as CREDITED
+        3. the 'sender' row is marked COMPLETED
+    If the credit fails, an ABORTED 'recipient' row is written instead. Unique (saga_id, role) makes it exclusive
+    with the credit, so a credit that was only delayed either has won, and the saga is completed, or can't happen
+    anymore. In the latter case the sender gets the amount back by a compensating credit transaction record and the
+    'sender' row becomes COMPENSATED. Sagas left DEBITED by a crashed process are finished by 'recover'."""
+
+    SENDER = "sender"
+    RECIPIENT = "recipient"
+    ROLES_CHOICES = [
+        (SENDER, "Sender"),
+        (RECIPIENT, "Recipient"),
+    ]
+    DEBITED = "debited"
+    CREDITED = "credited"
+    COMPLETED = "completed"
+    ABORTED = "aborted"
+    COMPENSATED = "compensated"
+    STATES_CHOICES = [
+        (DEBITED, "Debited"),
+        (CREDITED, "Credited"),
+        (COMPLETED, "Completed"),
+        (ABORTED, "Aborted"),
+        (COMPENSATED, "Compensated"),
+    ]
+
+    saga_id = models.UUIDField(default=uuid4)
+    role = models.CharField(max_length=10, choices=ROLES_CHOICES)
+    state = models.CharField(max_length=12, choices=STATES_CHOICES)
+    sender_id = models.BigIntegerField()
+    recipient_id = models.BigIntegerField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # transaction record written by the step: the debit for 'sender' row, the credit for 'recipient' one
+    transaction_id = models.BigIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["saga_id", "role"], name="unique_shard_transfer_step"
+            )
+        ]
+        indexes = [models.Index(fields=["role", "state", "created_at"])]
+
+    @staticmethod
+    @contextmanager
+    def track():
+        """Yields a list that gets 'sender' steps of sagas started inside the block. A saga started in an outer
+        database transaction is finished only when it commits, so its outcome has to be checked after that by
+        'raise_error' of its step."""
+        steps = []
+        token = _tracked_sagas.set(steps)
+        try:
+            yield steps
+        finally:
+            _tracked_sagas.reset(token)
+
+    @classmethod
+    def transfer(cls, sender, recipient, amount):
+        """Debits 'sender' wallet and starts a saga that credits 'recipient' wallet on its shard as soon as the debit
+        is committed. Raises the error of the credit if the debit has been compensated, unless the saga is left to an
+        outer database transaction (see 'track'). Returns new balance of the sender."""
+        with sharding.on_shard(sender.shard_alias), sharding.atomic():
+            wallet = Wallet.objects.select_for_update().get(id=sender.id)
+            wallet.collect_balance_slots()
+            if wallet.balance < amount:
+                raise serializers.ValidationError(
+                    {"amount": [INSUFFICIENT_FUNDS_ERROR]}
+                )
+            debit = TransactionV2.objects.create(
+                wallet=wallet,
+                sender=wallet,
+                recipient_id=recipient.id,
+                amount=amount,
+                transaction_type=TransactionV2.DEBIT,
+                balance_before=wallet.balance,
+                balance_after=wallet.balance - amount,
+            )
+            wallet.balance -= amount
+            wallet.save(update_fields=["balance"])
+            step = cls.objects.create(
+                role=cls.SENDER,
+                state=cls.DEBITED,
+                sender_id=wallet.id,
+                recipient_id=recipient.id,
+                amount=amount,
+                transaction_id=debit.id,
+            )
+            # runs right away if there is no outer database transaction
+            sharding.on_commit(lambda: step.finish(debit))
+            tracked = _tracked_sagas.get()
+            if tracked is not None:
+                tracked.append(step)
+        step.raise_error()
+        return wallet.balance
+
+    @classmethod
+    def recover(cls, older_than):
+        """Finishes sagas of the current shard that are still DEBITED 'older_than' timedelta after they started,
+        returns their number."""
+        steps = list(
+            cls.objects.filter(
+                role=cls.SENDER,
+                state=cls.DEBITED,
+                created_at__lt=timezone.now() - older_than,
+            )
+        )
+        for step in steps:
+            step.finish()
+        return len(steps)
+
+    def finish(self, debit=None):
+        """Runs the remaining steps of the saga of this 'sender' row: credits the recipient and completes the saga, or
+        compensates the debit if the credit fails. The error of the failed credit is kept in 'error'."""
+        self.error = None
+        if debit is None:
+            debit = (
+                TransactionV2.objects.using(self._state.db)
+                .select_related("wallet")
+                .get(id=self.transaction_id)
+            )
+        try:
+            self._credit(debit)
+        except Exception as error:
+            if not self._settle():
+                self.error = error
+            return
+        self._complete()
+
+    def raise_error(self):
+        """Raises the error of the failed credit if the debit of this 'sender' step has been compensated."""
+        if self.state != self.COMPENSATED:
+            return
+        if isinstance(self.error, Wallet.DoesNotExist):
+            raise serializers.ValidationError(
+                {"recipient": [RECIPIENT_DOESNT_EXIST_ERROR]}
+            )
+        raise self.error
+
+    def _credit(self, debit):
+        recipient = wallet_cache.get_by_id(self.recipient_id)
+        if recipient is None:
+            raise Wallet.DoesNotExist
+        with sharding.on_shard(recipient.shard_alias), sharding.atomic():
+            # a hot recipient isn't locked, the amount goes to one of its balance slots
+            if recipient.balance_slots and WalletBalanceSlot.credit(
+                recipient, self.amount
+            ):
+                balances = {"balance_before": None, "balance_after": None}
+            else:
+                recipient = Wallet.objects.select_for_update().get(id=self.recipient_id)
+                balances = recipient.credit_balances(self.amount)
+                recipient.balance += self.amount
+                recipient.save(update_fields=["balance"])
+            credit = TransactionV2.objects.create(
+                wallet=recipient,
+                sender_id=self.sender_id,
+                recipient=recipient,
+                amount=self.amount,
+                transaction_type=TransactionV2.CREDIT,
+                **balances,
+            )
+            self._step(self.RECIPIENT, self.CREDITED, credit.id).save()
+            WalletEvent.for_transfer(debit, credit).save()
+
+    def _settle(self):
+        """Makes the outcome of the credit final by writing an ABORTED 'recipient' row, then compensates the debit.
+        Returns True if the credit has been made after all, and completes the saga in this case."""
+        recipient = wallet_cache.get_by_id(self.recipient_id)
+        if recipient is not None:
+            try:
+                with sharding.on_shard(recipient.shard_alias), sharding.atomic():
+                    self._step(self.RECIPIENT, self.ABORTED).save()
+            except IntegrityError:
+                self._complete()
+                return True
+        self._compensate()
+        return False
+
+    def _complete(self):
+        with sharding.on_shard(self._state.db):
+            type(self).objects.filter(pk=self.pk, state=self.DEBITED).update(
+                state=self.COMPLETED, updated_at=timezone.now()
+            )
+        self.state = self.COMPLETED
+
+    def _compensate(self):
+        with sharding.on_shard(self._state.db), sharding.atomic():
+            step = type(self).objects.select_for_update().get(pk=self.pk)
+            if step.state == self.DEBITED:
+                sender = Wallet.objects.select_for_update().get(id=self.sender_id)
+                TransactionV2.objects.create(
+                    wallet=sender,
+                    sender_id=self.recipient_id,
+                    recipient=sender,
+                    amount=self.amount,
+                    transaction_type=TransactionV2.CREDIT,
+                    **sender.credit_balances(self.amount),
+                )
+                sender.balance += self.amount
+                sender.save(update_fields=["balance"])
+                step.state = self.COMPENSATED
+                step.save(update_fields=["state", "updated_at"])
+        self.state = step.state
+
+    def _step(self, role, state, transaction_id=None):
+        return type(self)(
+            saga_id=self.saga_id,
+            role=role,
+            state=state,
+            sender_id=self.sender_id,
+            recipient_id=self.recipient_id,
+            amount=self.amount,
+            transaction_id=transaction_id,
+        )
+
+
+class WalletBalanceSlot(models.Model):
+    """Part of balance of a hot wallet: its balance is 'Wallet.balance' plus balances of all its slots. Credits to a
+    hot wallet go to a random slot by 'UPDATE ... SET balance = balance + amount', so they only wait for credits to
+    the same slot instead of all of them queueing for the lock of the wallet row. Debits lock the wallet and all its
+    slots and move balances of the slots into the wallet first (see Wallet.collect_balance_slots), 'fold' does the
+    same periodically. Running balance is not known when a slot is credited, so records of credits to a hot wallet
+    have no 'balance_before' and 'balance_after'."""
+
+    wallet = models.ForeignKey(
+        Wallet, on_delete=models.CASCADE, related_name="balance_slot_set"
+    )
+    slot = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["wallet", "slot"], name="unique_balance_slot"
+            )
+        ]
+
+    @classmethod
+    def credit(cls, wallet, amount):
+        """Adds 'amount' to a random slot of hot 'wallet'. Returns False if the wallet has no slots anymore."""
+        return (
+            cls.objects.filter(
+                wallet_id=wallet.id, slot=random.randrange(wallet.balance_slots)
+            ).update(balance=F("balance") + amount)
+            > 0
+        )
+
+    @classmethod
+    def fold(cls):
+        """Moves balances of slots of hot wallets of the current shard into their 'Wallet.balance', one wallet per
+        database transaction, and writes a WalletBalanceSnapshot of every wallet that had anything to fold.
+        Returns the number of such wallets."""
+        folded = 0
+        for wallet_id in Wallet.objects.filter(balance_slots__gt=0).values_list(
+            "id", flat=True
+        ):
+            with sharding.atomic():
+                wallet = Wallet.objects.select_for_update().get(id=wallet_id)
+                if wallet.collect_balance_slots():
+                    wallet.save(update_fields=["balance"])
+                    WalletBalanceSnapshot.objects.create(
+                        wallet=wallet, balance=wallet.balance
+                    )
+                    folded += 1
+        return folded
+
+
+class WalletBalanceSnapshot(models.Model):
+    """Balance of a hot wallet at 'timestamp', written by WalletBalanceSlot.fold while the wallet and all its slots
+    are locked: no transaction of the wallet is in flight then, and credits that wait for the locks get later
+    timestamps. Serves as a running balance for Wallet.balance_at, which has to sum credits to a hot wallet
+    otherwise."""
+
+    wallet = models.ForeignKey(
+        Wallet, on_delete=models.CASCADE, related_name="balance_snapshot_set"
+    )
+    timestamp = models.DateTimeField(auto_now_add=True)
+    balance = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        indexes = [models.Index(fields=["wallet", "timestamp"])]
+
+
+class QueuedTransfer(models.Model):
+    """A transfer accepted by 'make_transfer' action when TRANSFER_QUEUE_ENABLED is set: the request is only
+    validated and this row is inserted, the transfer is applied later by 'execute' together with other queued ones.
+    Stored on the shard of the sender, so its id is unique only within the shard and it's looked up through the
+    sender wallet. Transfers to wallets on other shards are never queued, they are sagas (see ShardTransfer)."""
+
+    PENDING = "pending"
+    SUCCEEDED = "success"
+    FAILED = "failed"
+    STATES_CHOICES = [
+        (PENDING, "Pending"),
+        (SUCCEEDED, "Success"),
+        (FAILED, "Failed"),
+    ]
+
+    sender = models.ForeignKey(
+        Wallet, on_delete=models.CASCADE, related_name="queued_transfer_set"
+    )
+    recipient = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name="+")
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    state = models.CharField(max_length=10, choices=STATES_CHOICES, default=PENDING)
+    # validation errors in the same format as responses of synchronous transfers, if the transfer failed
+    errors = models.JSONField(null=True, blank=True)
+    # balance of the sender right after the transfer was applied or failed
+    balance_after = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["state", "id"])]
+
+    @classmethod
+    def execute(cls, batch_size, max_batches=None):
+        """Applies pending transfers of the current shard in batches of 'batch_size' until the queue is drained or
+        'max_batches' batches are done. Returns the number of processed transfers."""
+        processed = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            executed = cls.execute_batch(batch_size)
+            processed += executed
+            batches += 1
+            if executed < batch_size:
+                break
+        return processed
+
+    @classmethod
+    def execute_batch(cls, batch_size):
+        """Claims up to 'batch_size' oldest pending transfers with SKIP LOCKED, so several executors can drain the
+        queue in parallel, and applies them in the order they were queued in one database transaction: the whole
+        batch costs one commit. All their senders and recipients are locked by one query in the order of their ids,
+        like in Wallet.make_transaction, transaction records, events, balances and states of the transfers are written
+        by one query each. Transfers exceeding the balance of the sender at their turn are marked FAILED.
+        Returns the number of processed transfers."""
+        with sharding.atomic():
+            queued = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(state=cls.PENDING)
+                .order_by("id")[:batch_size]
+            )
+            if not queued:
+                return 0
+            wallet_ids = {transfer.sender_id for transfer in queued} | {
+                transfer.recipient_id for transfer in queued
+            }
+            wallets = {
+                wallet.id: wallet
+                for wallet in Wallet.objects.select_for_update()
+                .filter(id__in=wallet_ids)
+                .order_by("id")
+            }
+            for sender_id in {transfer.sender_id for transfer in queued}:
+                wallets[sender_id].collect_balance_slots()
+            records = []
+            processed_at = timezone.now()
+            for transfer in queued:
+                sender = wallets[transfer.sender_id]
+                if sender.balance < transfer.amount:
+                    transfer.state = cls.FAILED
+                    transfer.errors = {"amount": [INSUFFICIENT_FUNDS_ERROR]}
+                else:
+                    transfer.state = cls.SUCCEEDED
+                    records += Wallet._transfer(
+                        sender, wallets[transfer.recipient_id], transfer.amount
+                    )
+                transfer.balance_after = sender.balance
+                transfer.processed_at = processed_at
+            TransactionV2.objects.bulk_create(records)
+            WalletEvent.objects.bulk_create(
+                WalletEvent.for_transfer(*records[i : i + 2])
+                for i in range(0, len(records), 2)
+            )
+            # balances of senders may have changed by collected slots even if all their transfers failed
+            Wallet.objects.bulk_update(wallets.values(), ["balance"])
+            wallet_cache.invalidate_on_commit(wallets.keys())
+            cls.objects.bulk_update(
+                queued, ["state", "errors", "balance_after", "processed_at"]
+            )
+        return len(queued)
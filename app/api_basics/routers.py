@@ -0,0 +1,79 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# alias of the replica that reads of the current request or task go to, None means the primary
+_read_alias = ContextVar("read_alias", default=None)
+
+
+class ReplicaRouter:
+    """Database router that sends reads made inside 'read_from_replica' to one of DATABASE_REPLICAS aliases.
+    All other reads and all writes go to the primary 'default' database, which is the only one migrated: replicas
+    get schema and data by replication."""
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # objects read from a replica would be saved to it otherwise
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+def replica_alias():
+    """Returns a random alias from DATABASE_REPLICAS, or None if there are no replicas."""
+    if not settings.DATABASE_REPLICAS:
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def read_from_replica():
+    """Routes reads made inside the block to a replica, or to the primary if there are no replicas."""
+    token = _read_alias.set(replica_alias())
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def in_current_context(iterable):
+    """Yields items of 'iterable' running it in a copy of the current context, so that a generator consumed after
+    the view has returned, like a streaming response, reads from the same database as the view."""
+    context = copy_context()
+    iterator = iter(iterable)
+
+    def run():
+        while True:
+            try:
+                yield context.run(next, iterator)
+            except StopIteration:
+                return
+
+    # the context is copied right away, not when the stream starts
+    return run()
+
+
+def pin_to_primary(user_id):
+    """Makes reads of the user go to the primary for DATABASE_REPLICA_PIN_SECONDS, which should be longer than the
+    usual replication lag, so the user sees their own writes."""
+    cache.set(_pin_key(user_id), 1, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(user_id):
+    return cache.get(_pin_key(user_id)) is not None
+
+
+def _pin_key(user_id):
+    return "replica:pinned:{}".format(user_id)
@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """Rate limiter that allows up to 'rate' events per second on average and bursts of up to 'rate' events."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class TracesSampler:
+    """Sentry 'traces_sampler' that samples transactions of endpoints ('<ViewSet>.<action>') at their own rates.
+        - 'rates' are sample rates by endpoint, 'default_rate' is used for endpoints that are not listed
+        - 'budget_per_second' limits number of transactions sampled by rates in this process, so that a traffic
+          spike doesn't turn into a spike of tracing overhead
+        - Endpoints listed in 'tail' are traced always, and TraceSamplingMiddleware decides whether to send the
+          transaction when response is ready: errors and responses slower than the endpoint's threshold in seconds
+          are always sent, the rest is sampled by rates and budget as usual
+    Transactions that continue a trace sampled by an upstream service keep its decision."""
+
+    def __init__(self, rates=None, default_rate=0.0, tail=None, budget_per_second=10):
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.tail = tail or {}
+        self.budget = TokenBucket(budget_per_second)
+
+    def __call__(self, sampling_context):
+        if sampling_context.get("parent_sampled") is not None:
+            return sampling_context["parent_sampled"]
+        environ = sampling_context.get("wsgi_environ")
+        if environ is None:
+            return self.head_sample(None)
+        endpoint = self.endpoint(environ["REQUEST_METHOD"], environ["PATH_INFO"])
+        if endpoint in self.tail:
+            return True
+        return self.head_sample(endpoint)
+
+    def head_sample(self, endpoint):
+        rate = self.rates.get(endpoint, self.default_rate)
+        return bool(rate) and random.random() < rate and self.budget.take()
+
+    def keep(self, endpoint, status_code, duration):
+        """Decides whether to send transaction of a 'tail' endpoint once its response is ready."""
+        return (
+            status_code >= 500
+            or duration >= self.tail[endpoint]
+            or self.head_sample(endpoint)
+        )
+
+    @staticmethod
+    def endpoint(method, path):
+        from django.urls import Resolver404, resolve
+
+        from .middleware import endpoint_name
+
+        try:
+            return endpoint_name(method, resolve(path))
+        except Resolver404:
+            return "unresolved"
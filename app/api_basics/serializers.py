@@ -2,6 +2,7 @@ from drf_spectacular.utils import extend_schema_serializer
 from rest_framework import serializers
 from rest_framework.exceptions import NotFound
 
+from .cache import wallet_cache
 from .documentation_stuff import CREATE_WALLET_REQUEST_EXAMPLE
 from .errors_exceptions import (
     DATERANGE_BEFORE_AFTER_ERROR,
@@ -10,7 +11,7 @@ from .errors_exceptions import (
     RECIPIENT_IS_SENDER_ERROR,
     TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR,
 )
-from .models import TransactionReport, TransactionV2, Wallet
+from .models import QueuedTransfer, TransactionReport, TransactionV2, Wallet
 
 
 @extend_schema_serializer(examples=[CREATE_WALLET_REQUEST_EXAMPLE])
@@ -39,8 +40,34 @@ class DepositSerializer(serializers.Serializer):
         return value
 
 
+class QueuedTransferSerializer(serializers.ModelSerializer):
+    """Serializer of a transfer queued by 'make_transfer' action in async mode, for its response and status."""
+
+    transfer_id = serializers.IntegerField(source="id")
+    recipient = serializers.SlugRelatedField(slug_field="name", read_only=True)
+    transaction_status = serializers.CharField(source="state")
+    new_balance = serializers.DecimalField(
+        source="balance_after", max_digits=10, decimal_places=2
+    )
+
+    class Meta:
+        model = QueuedTransfer
+        fields = [
+            "transfer_id",
+            "recipient",
+            "amount",
+            "transaction_status",
+            "new_balance",
+            "errors",
+            "created_at",
+            "processed_at",
+        ]
+
+
 class TransactionV2Serializer(serializers.ModelSerializer):
-    """Serializer for 'history' action on wallet resource to replace wallet ids with wallet names in response."""
+    """Serializer for 'history' action on wallet resource to replace wallet ids with wallet names in response.
+    Expects a queryset with 'wallet', 'sender' and 'recipient' already joined
+    (see TransactionV2QuerySet.with_wallet_names), otherwise every row costs up to 3 extra queries."""
 
     class Meta:
         model = TransactionV2
@@ -51,15 +78,15 @@ class TransactionV2Serializer(serializers.ModelSerializer):
     recipient = serializers.SerializerMethodField()
 
     def get_wallet(self, obj):
-        return Wallet.objects.filter(id=obj.wallet.id)[0].name
+        return obj.wallet.name
 
     def get_sender(self, obj):
         if obj.sender:
-            return Wallet.objects.filter(id=obj.sender.id)[0].name
+            return obj.sender.name
         return obj.sender
 
     def get_recipient(self, obj):
-        return Wallet.objects.filter(id=obj.recipient.id)[0].name
+        return obj.recipient.name
 
 
 class GetHistoryParamsSerializer(serializers.Serializer):
@@ -75,6 +102,13 @@ class GetHistoryParamsSerializer(serializers.Serializer):
         choices=[("-timestamp", "-timestamp"), ("timestamp", "timestamp")],
         required=False,
     )
+    pagination = serializers.ChoiceField(
+        choices=[("page", "page"), ("cursor", "cursor")],
+        required=False,
+        help_text="'cursor' switches JSON response to keyset pagination: 'next' link instead of 'count' and "
+        "page numbers, constant cost for any page depth.",
+    )
+    cursor = serializers.CharField(required=False)
 
     def validate(self, data):
         if (
@@ -86,6 +120,12 @@ class GetHistoryParamsSerializer(serializers.Serializer):
         return data
 
 
+class GetBalanceParamsSerializer(serializers.Serializer):
+    """Serializer for 'balance' action on wallet resource to validate request parameters."""
+
+    at = serializers.DateTimeField(required=False)
+
+
 class MakeTransferSerializer(serializers.Serializer):
     """Serializer for 'make_transfer' action on wallet resource to validate user input."""
 
@@ -95,18 +135,43 @@ class MakeTransferSerializer(serializers.Serializer):
     def validate_amount(self, value):
         if value <= 0:
             raise serializers.ValidationError(TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR)
-        try:
-            balance = Wallet.objects.filter(name=self.context.get("sender"))[0].balance
-        except IndexError:
+        sender = self.get_wallet(self.context.get("sender"))
+        if sender is None:
             raise NotFound
-        else:
-            if balance < value:
-                raise serializers.ValidationError(INSUFFICIENT_FUNDS_ERROR)
+        if sender.balance < value:
+            raise serializers.ValidationError(INSUFFICIENT_FUNDS_ERROR)
         return value
 
     def validate_recipient(self, value):
-        if not Wallet.objects.filter(name=value):
+        if self.get_wallet(value) is None:
             raise serializers.ValidationError(RECIPIENT_DOESNT_EXIST_ERROR)
         if self.context.get("sender") == value:
             raise serializers.ValidationError(RECIPIENT_IS_SENDER_ERROR)
         return value
+
+    def get_wallet(self, name):
+        """Wallets are looked up by 'wallets' WalletResolver from context if view provides it, so that the view
+        doesn't load them again."""
+        wallets = self.context.get("wallets")
+        if wallets is not None:
+            return wallets.get(name)
+        return wallet_cache.get_by_name(name)
+
+
+class TransfersItemSerializer(serializers.Serializer):
+    """Serializer for one transfer of 'make_transfers' action on wallet resource. Only types are validated here,
+    the rest of validations is done per transfer by Wallet.make_transactions."""
+
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=True)
+    recipient = serializers.CharField(max_length=100, required=True)
+
+
+class MakeTransfersSerializer(serializers.Serializer):
+    """Serializer for 'make_transfers' action on wallet resource to validate user input."""
+
+    MAX_TRANSFERS = 1000
+
+    transfers = serializers.ListField(
+        child=TransfersItemSerializer(), allow_empty=False, max_length=MAX_TRANSFERS
+    )
+    all_or_nothing = serializers.BooleanField(default=False)
@@ -0,0 +1,170 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from operator import attrgetter
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+# alias of the shard that queries of the current request or task go to, None means none was chosen
+_shard_alias = ContextVar("shard_alias", default=None)
+
+# models of api_basics that are not sharded and always stay in the 'default' database
+GLOBAL_MODELS = {"walletdirectory"}
+
+
+def is_sharded():
+    return len(settings.WALLET_SHARDS) > 1
+
+
+def shard_index(holder_id):
+    """Index in WALLET_SHARDS of the shard that wallets of the holder are placed on. All wallets of a user share a
+    shard, so listing them and transfers between them never leave it."""
+    return holder_id % len(settings.WALLET_SHARDS)
+
+
+def shard_alias(holder_id):
+    return settings.WALLET_SHARDS[shard_index(holder_id)]
+
+
+def shard_aliases():
+    """Distinct database aliases of all shards, the 'default' one first."""
+    return list(dict.fromkeys(settings.WALLET_SHARDS))
+
+
+def current_alias():
+    return _shard_alias.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def on_shard(alias):
+    """Routes queries of sharded models made inside the block to the 'alias' database."""
+    token = _shard_alias.set(alias)
+    try:
+        yield
+    finally:
+        _shard_alias.reset(token)
+
+
+def atomic():
+    """transaction.atomic() on the database of the current shard."""
+    return transaction.atomic(using=current_alias())
+
+
+def on_commit(func):
+    transaction.on_commit(func, using=current_alias())
+
+
+def connection():
+    return connections[current_alias()]
+
+
+def load_wallets(**filters):
+    """Wallets matching 'filters' on their id or name, read from the primary database of their shards, with total
+    balance of hot wallets. When wallets are sharded, the shards are found by WalletDirectory first, then each shard
+    is queried once."""
+    wallets = apps.get_model("api_basics", "Wallet").objects.with_total_balance()
+    if not is_sharded():
+        return list(wallets.using(DEFAULT_DB_ALIAS).filter(**filters))
+    directory = apps.get_model("api_basics", "WalletDirectory")
+    ids_by_shard = defaultdict(list)
+    for wallet_id, holder_id in (
+        directory.objects.using(DEFAULT_DB_ALIAS)
+        .filter(**filters)
+        .values_list("id", "holder_id")
+    ):
+        ids_by_shard[shard_alias(holder_id)].append(wallet_id)
+    return [
+        wallet
+        for alias, wallet_ids in ids_by_shard.items()
+        for wallet in wallets.using(alias).filter(id__in=wallet_ids)
+    ]
+
+
+class AllShards:
+    """Read-only list of objects of a sharded model's queryset from all shards, in the queryset's ordering. Supports
+    just what a paginator needs: count() sums counts of the shards, and a slice reads its end rows from every shard
+    and merges them, which is fine for the first pages of admin listings like reports."""
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.ordered = queryset.ordered
+
+    def count(self):
+        return sum(self.queryset.using(alias).count() for alias in shard_aliases())
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError("AllShards supports only slices without a step")
+        objects = [
+            obj
+            for alias in shard_aliases()
+            for obj in self.queryset.using(alias)[: index.stop]
+        ]
+        model = self.queryset.model
+        ordering = self.queryset.query.order_by or model._meta.ordering
+        # stable sorts by the last field first give the order of all of them
+        for field in reversed(ordering):
+            attname = model._meta.get_field(field.lstrip("-")).attname
+            objects.sort(key=attrgetter(attname), reverse=field.startswith("-"))
+        return objects[index]
+
+
+class ShardRouter:
+    """Database router that places wallets and everything stored per wallet on WALLET_SHARDS by their holder.
+    Queries of api_basics models, except GLOBAL_MODELS, go to the shard of the current 'on_shard' block, or to the
+    database of the instance they are made through. Objects of other apps, like the holders themselves, are only in
+    the 'default' database. Does nothing unless there are several shards, other queries are left to the next
+    routers."""
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in settings.WALLET_SHARDS:
+            return None
+        return app_label == "api_basics" and model_name not in GLOBAL_MODELS
+
+    @staticmethod
+    def _db(model, **hints):
+        if not is_sharded():
+            return None
+        instance = hints.get("instance")
+        if (
+            model._meta.app_label != "api_basics"
+            or model._meta.model_name in GLOBAL_MODELS
+        ):
+            if instance is not None and instance._state.db in shard_aliases()[1:]:
+                # e.g. the holder of a wallet loaded from another shard
+                return DEFAULT_DB_ALIAS
+            return None
+        alias = _shard_alias.get()
+        if alias is not None:
+            return alias
+        if instance is not None:
+            if instance._state.db is not None:
+                return instance._state.db
+            holder_id = getattr(instance, "holder_id", None)
+            if holder_id is not None:
+                return shard_alias(holder_id)
+        return None
+
+
+@receiver(post_delete, sender="api_basics.Wallet")
+def delete_directory_entry(sender, instance, **kwargs):
+    if is_sharded():
+        apps.get_model("api_basics", "WalletDirectory").objects.filter(
+            id=instance.id
+        ).delete()
@@ -1,5 +1,18 @@
-from api_basics.models import TransactionReport
-from celery import shared_task
+from api_basics.events import publish_wallet_events as publish_events
+from api_basics.models import (
+    ArchivedTransaction,
+    IdempotencyKey,
+    QueuedTransfer,
+    ShardTransfer,
+    TransactionReport,
+    WalletBalanceSlot,
+    WalletReconciliation,
+)
+from api_basics.sharding import on_shard, shard_aliases
+from celery import chord, group, shared_task
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
 
 
 @shared_task(
@@ -9,4 +22,123 @@ from celery import shared_task
     retry_kwargs={"max_retries": 3},
 )
 def generate_report():
-    TransactionReport.calculate_report()
+    """Plans a report run on every shard of wallets and fans each of them out as a chord of per-shard subtasks with
+    'finish_report' as a callback. If this task itself is executed eagerly, shards are executed eagerly too."""
+    for alias in shard_aliases():
+        with on_shard(alias):
+            shard_ids = TransactionReport.plan_report(
+                settings.WALLETS_TRANSACTIONS_REPORT_SHARDS
+            )
+        if not shard_ids:
+            continue
+        workflow = chord(
+            (generate_report_shard.si(shard_id, alias) for shard_id in shard_ids),
+            finish_report.si(alias),
+        )
+        if generate_report.request.is_eager:
+            workflow.apply()
+        else:
+            workflow.apply_async()
+
+
+@shared_task(
+    autoretry_for=(Exception,),
+    retry_backoff=10,
+    retry_kwargs={"max_retries": 3},
+)
+def generate_report_shard(shard_id, database=DEFAULT_DB_ALIAS):
+    with on_shard(database):
+        TransactionReport.fold_shard(shard_id)
+
+
+@shared_task(
+    ignore_result=True,
+    autoretry_for=(Exception,),
+    retry_backoff=10,
+    retry_kwargs={"max_retries": 3},
+)
+def finish_report(database=DEFAULT_DB_ALIAS):
+    with on_shard(database):
+        TransactionReport.finish_report()
+
+
+@shared_task(ignore_result=True)
+def reconcile_ledger():
+    """Fans out ledger reconciliation as a group of subtasks, one per chunk of wallet ids of every shard of wallets.
+    If this task itself is executed eagerly, chunks are executed eagerly too."""
+    chunks = []
+    for alias in shard_aliases():
+        with on_shard(alias):
+            chunks += [
+                reconcile_ledger_chunk.si(first_wallet_id, last_wallet_id, alias)
+                for first_wallet_id, last_wallet_id in WalletReconciliation.wallet_id_chunks(
+                    settings.LEDGER_RECONCILIATION_CHUNK_SIZE
+                )
+            ]
+    chunks = group(chunks)
+    if reconcile_ledger.request.is_eager:
+        chunks.apply()
+    else:
+        chunks.apply_async()
+
+
+@shared_task(
+    autoretry_for=(Exception,),
+    retry_backoff=10,
+    retry_kwargs={"max_retries": 3},
+)
+def reconcile_ledger_chunk(first_wallet_id, last_wallet_id, database=DEFAULT_DB_ALIAS):
+    with on_shard(database):
+        return WalletReconciliation.reconcile(first_wallet_id, last_wallet_id)
+
+
+@shared_task(
+    ignore_result=True,
+    autoretry_for=(Exception,),
+    retry_backoff=1,
+    retry_kwargs={"max_retries": 3},
+)
+def publish_wallet_events():
+    for alias in shard_aliases():
+        with on_shard(alias):
+            publish_events(max_batches=settings.WALLET_EVENTS_MAX_BATCHES)
+
+
+@shared_task(ignore_result=True)
+def purge_idempotency_keys():
+    for alias in shard_aliases():
+        with on_shard(alias):
+            IdempotencyKey.purge(settings.IDEMPOTENCY_KEYS_TTL)
+
+
+@shared_task(ignore_result=True)
+def archive_transactions():
+    for alias in shard_aliases():
+        with on_shard(alias):
+            ArchivedTransaction.archive(
+                timezone.now() - settings.TRANSACTIONS_ARCHIVE_AFTER,
+                settings.TRANSACTIONS_ARCHIVE_BATCH_SIZE,
+            )
+
+
+@shared_task(ignore_result=True)
+def recover_shard_transfers():
+    for alias in shard_aliases():
+        with on_shard(alias):
+            ShardTransfer.recover(settings.SHARD_TRANSFERS_RECOVER_AFTER)
+
+
+@shared_task(ignore_result=True)
+def fold_balance_slots():
+    for alias in shard_aliases():
+        with on_shard(alias):
+            WalletBalanceSlot.fold()
+
+
+@shared_task(ignore_result=True)
+def execute_queued_transfers():
+    for alias in shard_aliases():
+        with on_shard(alias):
+            QueuedTransfer.execute(
+                settings.TRANSFER_QUEUE_BATCH_SIZE, settings.TRANSFER_QUEUE_MAX_BATCHES
+            )
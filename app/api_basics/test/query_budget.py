@@ -0,0 +1,16 @@
+class QueryBudgetMixin:
+    """Mixin for API test cases to check number of queries made by endpoints, as recorded by QueryStatsMiddleware.
+    Budgets are set per endpoint ('<ViewSet>.<action>') in 'query_budgets', so that an N+1 regression fails tests."""
+
+    query_budgets = {}
+
+    def assertQueryBudget(self, response, budget=None):
+        recorder = response.query_stats
+        if budget is None:
+            budget = self.query_budgets[recorder.endpoint]
+        if recorder.count > budget:
+            self.fail(
+                "{} made {} queries, budget is {}. The slowest one was: {}".format(
+                    recorder.endpoint, recorder.count, budget, recorder.slowest_sql
+                )
+            )
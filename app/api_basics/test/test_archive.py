@@ -0,0 +1,176 @@
+import datetime
+import json
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from api_basics.models import (
+    ArchivedTransaction,
+    TransactionReportWatermark,
+    TransactionV2,
+    WalletArchiveCheckpoint,
+    WalletReconciliation,
+)
+from api_basics.test.factory import WalletFactory
+from api_basics.utils import TransactionsCursorPagination
+from django.core.management import call_command
+from django.db.models import Max
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+def at_day(day):
+    return patch.object(
+        timezone,
+        "now",
+        return_value=timezone.make_aware(datetime.datetime(2021, 10, day, 12)),
+    )
+
+
+class ArchiveTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wallet = WalletFactory.create(balance=0)
+        cls.recipient = WalletFactory.create(balance=0)
+        for day in range(1, 7):
+            with at_day(day):
+                cls.wallet.make_deposit(Decimal("10.00"))
+                cls.wallet.make_transaction(Decimal("2.50"), cls.recipient.id)
+        cls.client = APIClient()
+        cls.history_url = "/api/wallets/" + cls.wallet.name + "/history/"
+        cls.export_url = "/api/wallets/" + cls.wallet.name + "/export_history/"
+
+    def setUp(self):
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def archive(self, day=4):
+        """Reconciles and reports all transactions, then archives ones made before 'day'."""
+        WalletReconciliation.reconcile(self.wallet.id, self.recipient.id)
+        TransactionReportWatermark.objects.update_or_create(
+            pk=TransactionReportWatermark.SINGLETON_ID,
+            defaults={
+                "last_transaction_id": TransactionV2.objects.aggregate(Max("id"))[
+                    "id__max"
+                ]
+            },
+        )
+        return ArchivedTransaction.archive(
+            timezone.make_aware(datetime.datetime(2021, 10, day)), batch_size=4
+        )
+
+    def history(self, **params):
+        response = self.client.get(
+            self.history_url, params, HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_old_transactions_are_moved_with_checkpoints(self):
+        self.assertEqual(self.archive(), 9)
+
+        self.assertEqual(ArchivedTransaction.objects.count(), 9)
+        self.assertFalse(
+            TransactionV2.objects.filter(
+                timestamp__lt=timezone.make_aware(datetime.datetime(2021, 10, 4))
+            ).exists()
+        )
+        checkpoint = WalletArchiveCheckpoint.objects.get(wallet=self.wallet)
+        self.assertEqual(checkpoint.transactions, 6)
+        self.assertEqual(checkpoint.credit_sum, Decimal("30.00"))
+        self.assertEqual(checkpoint.debit_sum, Decimal("7.50"))
+        self.assertEqual(checkpoint.balance_after, Decimal("22.50"))
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.archived_until, checkpoint.last_timestamp)
+        self.assertEqual(
+            WalletArchiveCheckpoint.objects.get(wallet=self.recipient).credit_sum,
+            Decimal("7.50"),
+        )
+
+    def test_unreported_and_unreconciled_transactions_stay(self):
+        TransactionReportWatermark.objects.create(
+            pk=TransactionReportWatermark.SINGLETON_ID,
+            last_transaction_id=TransactionV2.objects.aggregate(Max("id"))["id__max"],
+        )
+        self.assertEqual(ArchivedTransaction.archive(timezone.now(), batch_size=4), 0)
+        TransactionReportWatermark.objects.update(last_transaction_id=0)
+        WalletReconciliation.reconcile(self.wallet.id, self.recipient.id)
+        self.assertEqual(ArchivedTransaction.archive(timezone.now(), batch_size=4), 0)
+
+    def test_history_reads_archive(self):
+        expected = {
+            ordering: [row["id"] for row in self.history(ordering=ordering)["results"]]
+            for ordering in ["-timestamp", "timestamp"]
+        }
+        csv_before = b"".join(self.client.get(self.export_url).streaming_content)
+        self.archive()
+
+        for ordering, ids in expected.items():
+            data = self.history(ordering=ordering)
+            self.assertEqual(data["count"], 12)
+            self.assertEqual([row["id"] for row in data["results"]], ids)
+            with patch.object(TransactionsCursorPagination, "page_size", 4):
+                cursor_ids = []
+                url = self.history_url + "?pagination=cursor&ordering=" + ordering
+                while url:
+                    response = self.client.get(url, HTTP_ACCEPT="application/json")
+                    cursor_ids += [row["id"] for row in response.data["results"]]
+                    url = response.data["next"]
+            self.assertEqual(cursor_ids, ids)
+        self.assertEqual(
+            b"".join(self.client.get(self.export_url).streaming_content), csv_before
+        )
+        archived = self.history(timestamp_before="2021-10-02", transaction_type="DEB")
+        self.assertEqual(
+            [row["balance_after"] for row in archived["results"]], ["15.00", "7.50"]
+        )
+
+    @override_settings(WALLET_CACHE_ENABLED=False)
+    def test_recent_history_doesnt_read_archive(self):
+        self.archive()
+
+        # user, wallet lookup, page count and the page itself
+        with self.assertNumQueries(4):
+            data = self.history(timestamp_after="2021-10-05")
+        self.assertEqual(data["count"], 4)
+
+    def test_balance_at_moment_reads_archive(self):
+        self.archive()
+
+        response = self.client.get(
+            "/api/wallets/" + self.wallet.name + "/balance/",
+            {"at": "2021-10-02T13:00:00Z"},
+        )
+        self.assertEqual(response.data["balance"], "15.00")
+
+    def test_reconciliation_is_consistent_after_archiving(self):
+        self.archive()
+        with at_day(7):
+            self.wallet.make_transaction(Decimal("1.00"), self.recipient.id)
+
+        self.assertEqual(
+            WalletReconciliation.reconcile(self.wallet.id, self.recipient.id), 0
+        )
+        self.assertEqual(
+            WalletReconciliation.objects.get(wallet=self.wallet).ledger_balance,
+            Decimal("44.00"),
+        )
+
+    def test_full_reconciliation_after_archiving(self):
+        self.archive()
+        out = StringIO()
+
+        call_command("reconcile_ledger", full=True, stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue()), [])
+        self.assertEqual(
+            WalletReconciliation.objects.get(wallet=self.wallet).ledger_balance,
+            Decimal("45.00"),
+        )
+        self.assertEqual(self.archive(day=6), 6)
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+from decimal import Decimal
+from unittest.mock import patch
+
+from api_basics import asgi
+from api_basics.middleware import query_stats
+from api_basics.test.factory import WalletFactory
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import resolve
+from rest_framework import status
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+class OrmThreadPoolTestCase(SimpleTestCase):
+    @override_settings(ASGI_ORM_THREADS=2)
+    async def test_pool_is_bounded(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def query():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return threading.current_thread().name
+
+        with patch.object(asgi, "_orm_executor", None):
+            threads = await asyncio.gather(*(asgi.run_orm(query) for _ in range(6)))
+            asgi.orm_executor().shutdown()
+        self.assertEqual(max(peak), 2)
+        self.assertTrue(all(name.startswith("orm") for name in threads))
+
+
+# ORM work runs in the thread of the test, so that it sees data of the test database transaction
+@override_settings(ROOT_URLCONF="PilotProject.asgi_urls", ASGI_ORM_THREADS=0)
+class AsyncViewsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.wallet = WalletFactory.create()
+        for _ in range(3):
+            cls.wallet.make_deposit(Decimal("10.00"))
+        cls.token = "Bearer " + str(
+            RefreshToken.for_user(cls.wallet.holder).access_token
+        )
+        cls.wallet_url = "/api/wallets/" + cls.wallet.name + "/"
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, path, **params):
+        return self.async_client.get(
+            path, params, authorization=self.token, accept="application/json"
+        )
+
+    async def test_read_endpoints_are_async(self):
+        for path, key, value in [
+            ("/api/wallets/", "count", 1),
+            (self.wallet_url, "balance", "30.00"),
+            (self.wallet_url + "history/", "count", 3),
+        ]:
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(path).func))
+            response = await self.get(path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json()[key], value)
+
+    async def test_permissions_are_checked(self):
+        response = await self.async_client.get(self.wallet_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_export_is_streamed_asynchronously(self):
+        response = await self.async_client.get(
+            self.wallet_url + "export_history/", authorization=self.token
+        )
+        self.assertIsInstance(response, asgi.AsyncStreamingHttpResponse)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        with override_settings(ASGI_STREAM_CHUNK_PARTS=2):
+            chunks = [chunk async for chunk in response]
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(len(b"".join(chunks).decode().splitlines()), 4)
+
+    async def test_queries_are_recorded(self):
+        query_stats.reset()
+        response = await self.get(self.wallet_url + "history/")
+        self.assertGreater(response.query_stats.count, 0)
+        self.assertIn("WalletViewSet.history", query_stats.snapshot())
+
+    async def test_writes_are_served_by_sync_views(self):
+        response = await self.async_client.post(
+            "/api/wallets/",
+            {"name": "async_wallet"},
+            content_type="application/json",
+            authorization=self.token,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(
+            asyncio.iscoroutinefunction(resolve(self.wallet_url + "make_deposit/").func)
+        )
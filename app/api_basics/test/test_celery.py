@@ -2,9 +2,16 @@ import datetime
 from decimal import Decimal
 from unittest.mock import patch
 
-from api_basics.models import TransactionReport
+from api_basics.models import (
+    TransactionReport,
+    TransactionReportShard,
+    TransactionReportWatermark,
+    TransactionV2,
+)
 from api_basics.tasks import generate_report
 from api_basics.test.factory import HistoryFactory, WalletFactory
+from django.db import DatabaseError
+from django.test import override_settings
 from django.utils import timezone
 from rest_framework.test import APITestCase
 
@@ -126,3 +133,111 @@ class GenerateReportTestCase(APITestCase):
             TransactionReport.objects.get(wallet=self.wallet_2).credit_sum,
             Decimal(str(400.55)),
         )
+
+    def test_report_is_updated_incrementally(self):
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, 13)),
+        ):
+            generate_report.apply()
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, 13, 5)),
+        ):
+            HistoryFactory.create(**self.records[1])
+            HistoryFactory.create(**self.records[2])
+            HistoryFactory.create(
+                wallet=self.wallet_3,
+                sender=None,
+                recipient=self.wallet_3,
+                amount=Decimal(str(50)),
+                transaction_type="CRED",
+            )
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, 13, 10)),
+        ):
+            generate_report.apply()
+            # nothing new since the previous run
+            generate_report.apply()
+
+        self.assertEqual(TransactionReport.objects.all().count(), 3)
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_1).debit_sum,
+            Decimal(str(801.10)),
+        )
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_2).credit_sum,
+            Decimal(str(801.10)),
+        )
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_3).credit_sum,
+            Decimal(str(50)),
+        )
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_3).date,
+            datetime.date(2021, 10, 19),
+        )
+
+    @override_settings(WALLETS_TRANSACTIONS_REPORT_SHARDS=2)
+    def test_failed_shard_is_retried_alone(self):
+        fold_transactions = TransactionReport.fold_transactions
+        calls = []
+
+        def fail_first_shard_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise DatabaseError("connection lost")
+            return fold_transactions(*args)
+
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, 13)),
+        ), patch.object(
+            TransactionReport, "fold_transactions", side_effect=fail_first_shard_once
+        ):
+            generate_report.apply()
+
+        # two shards and one retry of the first of them
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0], calls[1])
+        self.assertEqual(TransactionReport.objects.all().count(), 2)
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_1).credit_sum,
+            Decimal(str(1100)),
+        )
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_2).debit_sum,
+            Decimal(str(100)),
+        )
+        self.assertFalse(TransactionReportShard.objects.exists())
+
+    def test_unfinished_run_is_resumed(self):
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, 13)),
+        ):
+            shard_ids = TransactionReport.plan_report(shards=2)
+            TransactionReport.fold_shard(shard_ids[0])
+            # previous run is still in progress, so no new shards are planned
+            self.assertFalse(TransactionReport.finish_report())
+            self.assertEqual(TransactionReport.plan_report(shards=2), shard_ids[1:])
+            generate_report.apply()
+
+        self.assertEqual(
+            TransactionReportWatermark.objects.get().last_transaction_id,
+            TransactionV2.objects.order_by("-id")[0].id,
+        )
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_1).debit_sum,
+            Decimal(str(400.55)),
+        )
+        self.assertEqual(
+            TransactionReport.objects.get(wallet=self.wallet_2).credit_sum,
+            Decimal(str(400.55)),
+        )
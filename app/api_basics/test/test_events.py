@@ -0,0 +1,115 @@
+from decimal import Decimal
+
+from api_basics.events import publish_wallet_events, wallet_events_exchange
+from api_basics.models import TransactionV2, WalletEvent
+from api_basics.tasks import publish_wallet_events as publish_wallet_events_task
+from api_basics.test.factory import WalletFactory
+from django.db import connection
+from django.test import override_settings
+from kombu import Connection, Queue
+from rest_framework.test import APITestCase
+
+
+@override_settings(WALLET_EVENTS_BROKER_URL="memory://")
+class PublishWalletEventsTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sender_wallet = WalletFactory.create(balance=0)
+        cls.recipient_wallet = WalletFactory.create(balance=0)
+
+    def setUp(self):
+        self.connection = Connection("memory://")
+        self.queue = Queue(
+            "wallet_events_test",
+            exchange=wallet_events_exchange,
+            routing_key="wallet.*",
+        )(self.connection)
+        self.queue.declare()
+
+    def tearDown(self):
+        self.queue.delete()
+        self.connection.release()
+
+    def consume(self):
+        messages = []
+        while True:
+            message = self.queue.get(no_ack=True)
+            if message is None:
+                return messages
+            self.assertEqual(
+                message.properties["message_id"], message.payload["event_id"]
+            )
+            messages.append((message.delivery_info["routing_key"], message.payload))
+
+    def test_events_are_written_with_transactions(self):
+        self.sender_wallet.make_deposit(Decimal("10.00"))
+        self.sender_wallet.make_transaction(Decimal("2.50"), self.recipient_wallet.id)
+        self.sender_wallet.make_transactions(
+            [
+                {"amount": Decimal("1.00"), "recipient": self.recipient_wallet.name},
+                {"amount": Decimal("100.00"), "recipient": self.recipient_wallet.name},
+            ]
+        )
+
+        self.assertEqual(
+            list(
+                WalletEvent.objects.order_by("id").values_list("event_type", flat=True)
+            ),
+            ["deposit", "transfer", "transfer"],
+        )
+
+    def test_events_are_published_in_batches_and_deleted(self):
+        self.sender_wallet.make_deposit(Decimal("10.00"))
+        for _ in range(4):
+            self.sender_wallet.make_transaction(
+                Decimal("1.00"), self.recipient_wallet.id
+            )
+
+        event_ids = list(
+            WalletEvent.objects.order_by("id").values_list("id", flat=True)
+        )
+        debit, credit = TransactionV2.objects.order_by("id")[1:3]
+        returns_ids = connection.features.can_return_rows_from_bulk_insert
+
+        self.assertEqual(publish_wallet_events(batch_size=2), 5)
+
+        self.assertFalse(WalletEvent.objects.exists())
+        messages = self.consume()
+        self.assertEqual(
+            [routing_key for routing_key, _ in messages],
+            ["wallet.deposit"] + ["wallet.transfer"] * 4,
+        )
+        self.assertEqual(
+            messages[1][1],
+            {
+                "event_id": "default:{}".format(event_ids[1]),
+                "type": "transfer",
+                "debit_transaction_id": debit.id if returns_ids else None,
+                "credit_transaction_id": credit.id if returns_ids else None,
+                "sender": self.sender_wallet.name,
+                "recipient": self.recipient_wallet.name,
+                "amount": "1.00",
+                "sender_balance_after": "9.00",
+                "recipient_balance_after": "1.00",
+                "timestamp": messages[1][1]["timestamp"],
+            },
+        )
+
+    def test_deposit_event_has_transaction_id(self):
+        self.sender_wallet.make_deposit(Decimal("10.00"))
+        publish_wallet_events()
+
+        _, payload = self.consume()[0]
+        self.assertEqual(
+            payload["transaction_id"],
+            TransactionV2.objects.get(wallet=self.sender_wallet).id,
+        )
+
+    def test_task_publishes_events(self):
+        self.sender_wallet.make_deposit(Decimal("10.00"))
+
+        publish_wallet_events_task.apply()
+
+        self.assertFalse(WalletEvent.objects.exists())
+        self.assertEqual(len(self.consume()), 1)
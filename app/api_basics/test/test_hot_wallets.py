@@ -0,0 +1,197 @@
+import datetime
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from api_basics.models import (
+    TransactionV2,
+    Wallet,
+    WalletBalanceSlot,
+    WalletReconciliation,
+)
+from api_basics.test.factory import WalletFactory
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+def at_hour(hour):
+    return patch.object(
+        timezone,
+        "now",
+        return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, hour)),
+    )
+
+
+class HotWalletTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.merchant = WalletFactory.create()
+        self.customer = WalletFactory.create()
+        with at_hour(9):
+            self.merchant.make_deposit(Decimal("5.00"))
+            self.customer.make_deposit(Decimal("100.00"))
+            self.merchant.set_balance_slots(4)
+        self.client = APIClient()
+        refresh = RefreshToken.for_user(self.merchant.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+        self.merchant_url = "/api/wallets/" + self.merchant.name + "/"
+
+    def base_balance(self):
+        return Wallet.objects.get(id=self.merchant.id).balance
+
+    def slots_balance(self):
+        return sum(
+            WalletBalanceSlot.objects.filter(wallet=self.merchant).values_list(
+                "balance", flat=True
+            )
+        )
+
+    def test_credits_go_to_slots(self):
+        with at_hour(10):
+            for _ in range(3):
+                response = self.client.post(
+                    self.merchant_url + "make_deposit/", {"amount": "1.00"}
+                )
+            self.customer.make_transaction(Decimal("2.00"), self.merchant.id)
+
+        self.assertEqual(response.data["new_balance"], "8.00")
+        self.assertEqual(self.base_balance(), Decimal("5.00"))
+        self.assertEqual(self.slots_balance(), Decimal("5.00"))
+        credit = TransactionV2.objects.filter(wallet=self.merchant).first()
+        self.assertIsNone(credit.balance_after)
+        self.assertEqual(
+            TransactionV2.objects.get(
+                wallet=self.customer, transaction_type="DEB"
+            ).balance_after,
+            Decimal("98.00"),
+        )
+        response = self.client.get(self.merchant_url)
+        self.assertEqual(response.data["balance"], "10.00")
+        response = self.client.get("/api/wallets/")
+        self.assertEqual(response.data["results"][0]["balance"], "10.00")
+
+    def test_debit_collects_slots(self):
+        self.merchant.make_deposit(Decimal("3.00"))
+        self.merchant.make_transaction(Decimal("7.00"), self.customer.id)
+
+        self.assertEqual(self.base_balance(), Decimal("1.00"))
+        self.assertEqual(self.slots_balance(), 0)
+        debit = TransactionV2.objects.get(wallet=self.merchant, transaction_type="DEB")
+        self.assertEqual(
+            (debit.balance_before, debit.balance_after),
+            (Decimal("8.00"), Decimal("1.00")),
+        )
+
+    def test_failed_batch_keeps_collected_slots(self):
+        self.merchant.make_deposit(Decimal("3.00"))
+        results, balance = self.merchant.make_transactions(
+            [{"amount": Decimal("20.00"), "recipient": self.customer.name}]
+        )
+        self.assertEqual(results[0]["transaction_status"], "failed")
+        self.assertEqual(balance, Decimal("8.00"))
+        self.assertEqual(self.base_balance(), Decimal("8.00"))
+        self.assertEqual(self.slots_balance(), 0)
+
+    def test_fold_and_turning_hot_mode_off(self):
+        self.merchant.make_deposit(Decimal("3.00"))
+        self.assertEqual(WalletBalanceSlot.fold(), 1)
+        self.assertEqual(self.base_balance(), Decimal("8.00"))
+        self.assertEqual(WalletBalanceSlot.fold(), 0)
+
+        self.merchant.make_deposit(Decimal("1.00"))
+        call_command("hot_wallet", self.merchant.name, slots=0, stdout=StringIO())
+        self.assertFalse(WalletBalanceSlot.objects.exists())
+        self.assertEqual(self.base_balance(), Decimal("9.00"))
+        self.merchant.refresh_from_db()
+        self.merchant.make_deposit(Decimal("1.00"))
+        self.assertEqual(
+            TransactionV2.objects.filter(wallet=self.merchant).first().balance_after,
+            Decimal("10.00"),
+        )
+
+    def test_balance_at_adds_credits_without_running_balance(self):
+        for hour in (10, 12):
+            with at_hour(hour):
+                self.merchant.make_deposit(Decimal("2.00"))
+        with at_hour(13):
+            self.merchant.make_transaction(Decimal("1.00"), self.customer.id)
+        with at_hour(14):
+            self.merchant.make_deposit(Decimal("2.00"))
+
+        for at, balance in [
+            ("2021-10-19T09:30:00Z", "5.00"),
+            ("2021-10-19T11:00:00Z", "7.00"),
+            ("2021-10-19T12:30:00Z", "9.00"),
+            ("2021-10-19T13:30:00Z", "8.00"),
+            ("2021-10-19T15:00:00Z", "10.00"),
+        ]:
+            response = self.client.get(self.merchant_url + "balance/", {"at": at})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["balance"], balance, at)
+
+    def test_balance_at_starts_from_fold_snapshot(self):
+        with at_hour(10):
+            for _ in range(2):
+                self.merchant.make_deposit(Decimal("2.00"))
+        with at_hour(11):
+            self.assertEqual(WalletBalanceSlot.fold(), 1)
+        with at_hour(12):
+            self.merchant.make_deposit(Decimal("2.00"))
+        # credits made before the snapshot aren't read anymore
+        with at_hour(11):
+            TransactionV2.objects.filter(
+                wallet=self.merchant,
+                balance_after__isnull=True,
+                timestamp__lt=timezone.now(),
+            ).delete()
+
+        for at, balance in [
+            ("2021-10-19T11:30:00Z", "9.00"),
+            ("2021-10-19T12:30:00Z", "11.00"),
+        ]:
+            response = self.client.get(self.merchant_url + "balance/", {"at": at})
+            self.assertEqual(response.data["balance"], balance, at)
+
+    def test_reconciliation_counts_slots(self):
+        self.merchant.make_deposit(Decimal("3.00"))
+        self.assertEqual(
+            WalletReconciliation.reconcile(self.merchant.id, self.customer.id), 0
+        )
+
+    def test_reconciliation_waits_for_credits_in_flight(self):
+        with at_hour(10):
+            for amount in ("2.00", "3.00"):
+                self.merchant.make_deposit(Decimal(amount))
+        # the first credit is still in flight: neither its row nor its slot update is visible yet
+        late = TransactionV2.objects.filter(wallet=self.merchant).order_by("-id")[1]
+        late_id = late.id
+        late.delete()
+        slot = WalletBalanceSlot.objects.filter(wallet=self.merchant).first()
+        slot.balance -= late.amount
+        slot.save()
+
+        with at_hour(10):
+            WalletReconciliation.reconcile(self.merchant.id, self.merchant.id)
+        reconciliation = WalletReconciliation.objects.get(wallet=self.merchant)
+        self.assertTrue(reconciliation.is_consistent)
+        self.assertEqual(reconciliation.ledger_balance, Decimal("8.00"))
+        self.assertLess(reconciliation.last_transaction_id, late_id)
+
+        late.id = late_id
+        with at_hour(10):
+            late.save(force_insert=True)
+        slot.balance += late.amount
+        slot.save()
+        with at_hour(11):
+            WalletReconciliation.reconcile(self.merchant.id, self.merchant.id)
+        reconciliation.refresh_from_db()
+        self.assertTrue(reconciliation.is_consistent)
+        self.assertEqual(reconciliation.ledger_balance, Decimal("10.00"))
+        self.assertEqual(reconciliation.checkpoint_balance, Decimal("10.00"))
+        self.assertGreater(reconciliation.last_transaction_id, late.id)
@@ -0,0 +1,194 @@
+import json
+import os
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from api_basics.management.commands import import_transactions
+from api_basics.models import (
+    LedgerImport,
+    TransactionReport,
+    TransactionReportShard,
+    TransactionReportWatermark,
+    TransactionV2,
+    Wallet,
+)
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from rest_framework.test import APITestCase
+
+from .factory import WalletFactory
+
+CSV = """sender,recipient,amount,timestamp
+,alice,100.00,2021-01-01T10:00:00Z
+alice,bob,30.50,2021-01-02T10:00:00Z
+bob,alice,0.50,2021-01-03T10:00:00Z
+,bob,-1,2021-01-04T10:00:00Z
+carol,bob,1.00,2021-01-05T10:00:00Z
+alice,bob,1.00,yesterday
+"""
+
+
+class ImportTransactionsTestCase(APITestCase):
+    def setUp(self):
+        self.holder = User.objects.create(username="importer")
+        self.alice = WalletFactory.create(name="alice", holder=self.holder)
+        self.bob = WalletFactory.create(name="bob", holder=self.holder)
+
+    def write(self, content, suffix=".csv"):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def run_import(self, path, *args):
+        stdout = StringIO()
+        call_command("import_transactions", path, *args, stdout=stdout)
+        return json.loads(stdout.getvalue())
+
+    def assertLedger(self, wallet, balances):
+        rows = TransactionV2.objects.filter(wallet=wallet).order_by("id")
+        self.assertEqual([row.balance_after for row in rows], balances)
+        for previous, row in zip(rows, rows[1:]):
+            self.assertEqual(row.balance_before, previous.balance_after)
+        wallet.refresh_from_db()
+        self.assertEqual(wallet.balance, balances[-1] if balances else 0)
+
+    def test_csv_import(self):
+        summary = self.run_import(self.write(CSV), "--batch-size", "2")
+
+        self.assertEqual(summary["rows"], 6)
+        self.assertEqual(summary["transactions"], 5)
+        self.assertEqual(summary["wallets_updated"], 2)
+        self.assertEqual(
+            summary["errors"],
+            [
+                {"row": 4, "error": "Invalid amount '-1'"},
+                {"row": 5, "error": "Unknown wallet 'carol'"},
+                {"row": 6, "error": "Invalid timestamp 'yesterday'"},
+            ],
+        )
+        self.assertLedger(
+            self.alice, [Decimal("100.00"), Decimal("69.50"), Decimal("70.00")]
+        )
+        self.assertLedger(self.bob, [Decimal("30.50"), Decimal("30.00")])
+        transfer = TransactionV2.objects.get(
+            wallet=self.bob, transaction_type=TransactionV2.CREDIT
+        )
+        self.assertEqual(transfer.sender, self.alice)
+        self.assertEqual(transfer.timestamp.isoformat(), "2021-01-02T10:00:00+00:00")
+
+    def test_ndjson_import_continues_existing_history(self):
+        self.run_import(self.write(CSV))
+        rows = [
+            {"recipient": "bob", "amount": 5, "timestamp": "2021-02-01T10:00:00"},
+            {
+                "sender": "bob",
+                "recipient": "alice",
+                "amount": "1.25",
+                "timestamp": "2021-02-02T10:00:00+03:00",
+            },
+        ]
+        path = self.write(
+            "\n".join(json.dumps(row) for row in rows) + "\nnot json\n",
+            suffix=".ndjson",
+        )
+
+        summary = self.run_import(path)
+
+        self.assertEqual(summary["transactions"], 3)
+        self.assertEqual(summary["errors"], [{"row": 3, "error": "Invalid JSON"}])
+        self.assertLedger(
+            self.alice,
+            [Decimal("100.00"), Decimal("69.50"), Decimal("70.00"), Decimal("71.25")],
+        )
+        self.assertLedger(
+            self.bob,
+            [Decimal("30.50"), Decimal("30.00"), Decimal("35.00"), Decimal("33.75")],
+        )
+
+    def test_holder_gets_unknown_wallets(self):
+        summary = self.run_import(self.write(CSV), "--holder", "importer")
+
+        self.assertEqual(len(summary["errors"]), 2)
+        carol = Wallet.objects.get(name="carol", holder=self.holder)
+        self.assertLedger(carol, [Decimal("-1.00")])
+
+    def test_interrupted_import_resumes(self):
+        path = self.write(CSV)
+        batches = []
+
+        def fail_on_second_batch(chunk, use_copy):
+            batches.append(chunk)
+            if len(batches) == 2:
+                raise RuntimeError
+            original(chunk, use_copy)
+
+        original = import_transactions.write_transactions
+        with mock.patch.object(
+            import_transactions, "write_transactions", fail_on_second_batch
+        ):
+            with self.assertRaises(RuntimeError):
+                self.run_import(path, "--batch-size", "2")
+        self.assertEqual(LedgerImport.objects.get().rows_done, 2)
+        self.assertEqual(TransactionV2.objects.count(), 3)
+
+        summary = self.run_import(path, "--batch-size", "2")
+
+        self.assertEqual(summary["resumed_from_row"], 2)
+        self.assertEqual(summary["rows"], 4)
+        self.assertLedger(
+            self.alice, [Decimal("100.00"), Decimal("69.50"), Decimal("70.00")]
+        )
+        self.assertLedger(self.bob, [Decimal("30.50"), Decimal("30.00")])
+        with self.assertRaises(CommandError):
+            self.run_import(path)
+
+    @override_settings(WALLET_SHARDS=["default", "default"])
+    def test_sharded_wallets_are_refused(self):
+        path = self.write(CSV)
+        with self.assertRaises(CommandError):
+            self.run_import(path, "--holder", "importer")
+        self.assertFalse(TransactionV2.objects.exists())
+
+    def test_balances_keep_transactions_made_during_import(self):
+        self.alice.set_balance_slots(2)
+
+        def write_with_live_deposits(chunk, use_copy):
+            original(chunk, use_copy)
+            Wallet.objects.get(name="alice").make_deposit(Decimal("5.00"))
+            Wallet.objects.get(name="bob").make_deposit(Decimal("2.00"))
+
+        original = import_transactions.write_transactions
+        with mock.patch.object(
+            import_transactions, "write_transactions", write_with_live_deposits
+        ):
+            self.run_import(self.write(CSV), "--batch-size", "2")
+
+        balances = dict(
+            (wallet.name, wallet.balance)
+            for wallet in Wallet.objects.with_total_balance()
+        )
+        self.assertEqual(balances, {"alice": Decimal("80.00"), "bob": Decimal("34.00")})
+
+    def test_too_large_amount_is_skipped(self):
+        summary = self.run_import(
+            self.write("sender,recipient,amount,timestamp\n,alice,1e8,2021-01-01\n")
+        )
+
+        self.assertEqual(
+            summary["errors"], [{"row": 1, "error": "Amount '1e8' is too large"}]
+        )
+        self.assertFalse(TransactionV2.objects.exists())
+
+    def test_reports_wait_for_unfinished_import(self):
+        LedgerImport.objects.create(name="unfinished")
+        self.alice.make_deposit(Decimal("10.00"))
+
+        with mock.patch.object(TransactionReportWatermark, "LAG", timedelta(0)):
+            self.assertEqual(TransactionReport.plan_report(2), [])
+        self.assertFalse(TransactionReportShard.objects.exists())
@@ -0,0 +1,153 @@
+import datetime
+from decimal import Decimal
+from unittest.mock import patch
+
+from api_basics.models import TransactionReport
+from api_basics.tasks import generate_report
+from api_basics.test.factory import HistoryFactory, WalletFactory
+from django.db import DatabaseError
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class RequestMetricsTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = APIClient()
+
+    def setUp(self):
+        self.wallet = WalletFactory.create(balance=10)
+        self.recipient_wallet = WalletFactory.create(balance=0)
+        self.wallet_url = "/api/wallets/" + self.wallet.name + "/"
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_metrics_endpoint(self):
+        self.client.get(self.wallet_url)
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(
+            'wallets_http_requests_total{endpoint="WalletViewSet.retrieve",method="GET",status="200"}',
+            response.content.decode(),
+        )
+
+    def test_request_latency_and_in_progress_requests(self):
+        labels = {"endpoint": "WalletViewSet.retrieve", "method": "GET"}
+        before = sample("wallets_http_request_duration_seconds_count", **labels)
+
+        self.client.get(self.wallet_url)
+
+        self.assertEqual(
+            sample("wallets_http_request_duration_seconds_count", **labels),
+            before + 1,
+        )
+        self.assertEqual(
+            sample(
+                "wallets_http_requests_in_progress", endpoint="WalletViewSet.retrieve"
+            ),
+            0,
+        )
+
+    def test_operations_are_counted_by_result(self):
+        def transfers(result):
+            return sample(
+                "wallets_operations_total", operation="transfer", result=result
+            )
+
+        success, insufficient_funds, rejected = (
+            transfers("success"),
+            transfers("insufficient_funds"),
+            transfers("rejected"),
+        )
+        transfer_url = self.wallet_url + "make_transfer/"
+        self.client.post(
+            transfer_url, {"amount": "4.00", "recipient": self.recipient_wallet.name}
+        )
+        self.client.post(
+            transfer_url, {"amount": "40.00", "recipient": self.recipient_wallet.name}
+        )
+        self.client.post(transfer_url, {"amount": "4.00", "recipient": "missing"})
+        self.client.post(
+            self.wallet_url + "make_transfers/",
+            {
+                "transfers": [
+                    {"amount": "1.00", "recipient": self.recipient_wallet.name},
+                    {"amount": "100.00", "recipient": self.recipient_wallet.name},
+                ]
+            },
+            format="json",
+        )
+
+        self.assertEqual(transfers("success"), success + 2)
+        self.assertEqual(transfers("insufficient_funds"), insufficient_funds + 2)
+        self.assertEqual(transfers("rejected"), rejected + 1)
+
+    def test_replayed_deposit_is_counted_once(self):
+        before = sample(
+            "wallets_operations_total", operation="deposit", result="success"
+        )
+        for _ in range(2):
+            self.client.post(
+                self.wallet_url + "make_deposit/",
+                {"amount": "1.00"},
+                HTTP_IDEMPOTENCY_KEY="deposit-1",
+            )
+
+        self.assertEqual(
+            sample("wallets_operations_total", operation="deposit", result="success"),
+            before + 1,
+        )
+
+
+class TaskMetricsTestCase(APITestCase):
+    task = "api_basics.tasks.generate_report"
+
+    def setUp(self):
+        HistoryFactory.create(
+            wallet=WalletFactory.create(balance=0),
+            sender=None,
+            amount=Decimal("1.00"),
+            transaction_type="CRED",
+            balance_before=Decimal("0.00"),
+            balance_after=Decimal("1.00"),
+        )
+
+    def test_report_generation_duration_and_retries(self):
+        runs = sample("wallets_celery_task_duration_seconds_count", task=self.task)
+        retries = sample("wallets_celery_task_retries_total", task=self.task)
+        plan_report = TransactionReport.plan_report
+        calls = []
+
+        def fail_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise DatabaseError("connection lost")
+            return plan_report(*args)
+
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.now() + datetime.timedelta(minutes=1),
+        ), patch.object(TransactionReport, "plan_report", side_effect=fail_once):
+            generate_report.apply()
+
+        self.assertEqual(
+            sample("wallets_celery_task_retries_total", task=self.task), retries + 1
+        )
+        self.assertEqual(
+            sample("wallets_celery_task_duration_seconds_count", task=self.task),
+            runs + 2,
+        )
+        self.assertEqual(TransactionReport.objects.count(), 1)
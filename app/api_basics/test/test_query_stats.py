@@ -0,0 +1,127 @@
+from decimal import Decimal
+
+from api_basics.middleware import query_stats
+from api_basics.models import TransactionReport
+from api_basics.test.factory import HistoryFactory, WalletFactory
+from api_basics.test.query_budget import QueryBudgetMixin
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.test.factory import UserFactory
+
+
+@override_settings(WALLET_CACHE_ENABLED=False)
+class QueryBudgetTestCase(QueryBudgetMixin, APITestCase):
+    query_budgets = {
+        "WalletViewSet.list": 3,
+        "WalletViewSet.retrieve": 2,
+        "WalletViewSet.make_deposit": 8,
+        "WalletViewSet.make_transfer": 8,
+        "WalletViewSet.make_transfers": 8,
+        "WalletViewSet.history": 4,
+        "WalletViewSet.balance": 2,
+        "ReportsViewSet.list": 3,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = APIClient()
+
+    def setUp(self):
+        query_stats.reset()
+        self.wallet = WalletFactory.create(balance=100)
+        self.recipients = WalletFactory.create_batch(5, holder=self.wallet.holder)
+        for recipient in self.recipients:
+            HistoryFactory.create(
+                wallet=self.wallet,
+                sender=self.wallet,
+                recipient=recipient,
+                amount=Decimal("1.00"),
+                transaction_type="DEBT",
+                balance_before=Decimal("1.00"),
+                balance_after=Decimal("0.00"),
+            )
+            TransactionReport.objects.create(
+                wallet=recipient,
+                date=timezone.now().date(),
+                debit_sum=Decimal("0.00"),
+                credit_sum=Decimal("1.00"),
+            )
+        self.wallet_url = "/api/wallets/" + self.wallet.name + "/"
+        self.authenticate(self.wallet.holder)
+
+    def authenticate(self, user):
+        refresh = RefreshToken.for_user(user)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_wallet_endpoints_stay_within_query_budget(self):
+        transfer = {"amount": "1.00", "recipient": self.recipients[0].name}
+        responses = [
+            self.client.get("/api/wallets/"),
+            self.client.get(self.wallet_url),
+            self.client.post(self.wallet_url + "make_deposit/", {"amount": "1.00"}),
+            self.client.post(self.wallet_url + "make_transfer/", transfer),
+            self.client.post(
+                self.wallet_url + "make_transfers/",
+                {"transfers": [transfer] * 5},
+                format="json",
+            ),
+            self.client.get(
+                self.wallet_url + "history/", HTTP_ACCEPT="application/json"
+            ),
+            self.client.get(self.wallet_url + "balance/"),
+        ]
+        for response in responses:
+            self.assertIn(
+                response.status_code, (status.HTTP_200_OK, status.HTTP_201_CREATED)
+            )
+            self.assertQueryBudget(response)
+
+    def test_reports_stay_within_query_budget(self):
+        self.authenticate(UserFactory.create(is_staff=True))
+        response = self.client.get("/api/reports/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertQueryBudget(response)
+
+    def test_query_budget_failure_names_endpoint(self):
+        response = self.client.get(self.wallet_url)
+
+        with self.assertRaisesMessage(
+            AssertionError, "WalletViewSet.retrieve made 2 queries, budget is 1"
+        ):
+            self.assertQueryBudget(response, budget=1)
+
+    def test_server_timing_header(self):
+        response = self.client.get(self.wallet_url)
+
+        self.assertRegex(
+            response["Server-Timing"],
+            r'^db;dur=\d+\.\d{3};desc="2 queries", total;dur=\d+\.\d{3}$',
+        )
+
+    def test_stats_are_aggregated_per_endpoint(self):
+        self.client.get(self.wallet_url)
+        self.client.get(self.wallet_url)
+        self.client.get("/api/wallets/")
+
+        self.authenticate(UserFactory.create(is_staff=True))
+        response = self.client.get("/api/query_stats/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        retrieve = response.data["WalletViewSet.retrieve"]
+        self.assertEqual(retrieve["requests"], 2)
+        self.assertEqual(retrieve["queries"], 4)
+        self.assertEqual(retrieve["max_queries"], 2)
+        self.assertIsNotNone(retrieve["slowest_sql"])
+        self.assertEqual(response.data["WalletViewSet.list"]["requests"], 1)
+
+    def test_stats_are_for_admins_only(self):
+        response = self.client.get("/api/query_stats/")
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -0,0 +1,83 @@
+import json
+from decimal import Decimal
+from io import StringIO
+
+from api_basics.models import TransactionV2, Wallet, WalletReconciliation
+from api_basics.tasks import reconcile_ledger
+from api_basics.test.factory import WalletFactory
+from django.core.management import call_command
+from django.test import override_settings
+from rest_framework.test import APITestCase
+
+
+class ReconcileLedgerTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wallets = WalletFactory.create_batch(3, balance=0)
+        cls.wallets[0].make_deposit(Decimal("100.00"))
+        cls.wallets[1].make_deposit(Decimal("20.50"))
+        cls.wallets[0].make_transaction(Decimal("30.25"), cls.wallets[1].id)
+        cls.wallets[1].make_transaction(Decimal("0.75"), cls.wallets[2].id)
+
+    def test_consistent_ledger(self):
+        for first_wallet_id, last_wallet_id in WalletReconciliation.wallet_id_chunks(2):
+            self.assertEqual(
+                WalletReconciliation.reconcile(first_wallet_id, last_wallet_id), 0
+            )
+
+        self.assertEqual(WalletReconciliation.objects.count(), 3)
+        self.assertEqual(
+            WalletReconciliation.objects.get(wallet=self.wallets[1]).ledger_balance,
+            Decimal("50.00"),
+        )
+        self.assertEqual(
+            WalletReconciliation.objects.get(
+                wallet=self.wallets[2]
+            ).last_transaction_id,
+            TransactionV2.objects.filter(wallet=self.wallets[2]).get().id,
+        )
+
+    def test_only_new_transactions_are_read(self):
+        call_command("reconcile_ledger", stdout=StringIO())
+        # a transaction that was already reconciled can't affect next runs
+        TransactionV2.objects.filter(wallet=self.wallets[0]).update(amount=0)
+        self.wallets[2].make_deposit(Decimal("1.00"))
+
+        stdout = StringIO()
+        call_command("reconcile_ledger", stdout=stdout)
+
+        self.assertEqual(json.loads(stdout.getvalue()), [])
+        self.assertEqual(
+            WalletReconciliation.objects.get(wallet=self.wallets[2]).ledger_balance,
+            Decimal("1.75"),
+        )
+
+    def test_inconsistent_wallets_are_reported(self):
+        Wallet.objects.filter(id=self.wallets[1].id).update(balance=Decimal("49.00"))
+
+        stdout = StringIO()
+        call_command("reconcile_ledger", "--chunk-size", "1", stdout=stdout)
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["wallet"], self.wallets[1].name)
+        self.assertEqual(report[0]["balance"], "49.00")
+        self.assertEqual(report[0]["ledger_balance"], "50.00")
+        self.assertEqual(report[0]["difference"], "-1.00")
+
+    @override_settings(LEDGER_RECONCILIATION_CHUNK_SIZE=1)
+    def test_celery_task(self):
+        Wallet.objects.filter(id=self.wallets[0].id).update(balance=Decimal("0.00"))
+
+        reconcile_ledger.apply()
+
+        self.assertEqual(WalletReconciliation.objects.count(), 3)
+        self.assertEqual(
+            list(
+                WalletReconciliation.objects.filter(is_consistent=False).values_list(
+                    "wallet", flat=True
+                )
+            ),
+            [self.wallets[0].id],
+        )
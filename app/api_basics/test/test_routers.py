@@ -0,0 +1,125 @@
+import datetime
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest.mock import patch
+
+from api_basics.models import TransactionReport, TransactionV2
+from api_basics.routers import ReplicaRouter, in_current_context, read_from_replica
+from api_basics.test.factory import WalletFactory
+from django.core.cache import cache
+from django.db import router
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+@override_settings(DATABASE_REPLICAS=["replica_0"])
+class ReplicaRouterTestCase(SimpleTestCase):
+    def test_reads_go_to_replica_only_inside_block(self):
+        self.assertEqual(router.db_for_read(TransactionV2), "default")
+        with read_from_replica():
+            self.assertEqual(router.db_for_read(TransactionV2), "replica_0")
+            self.assertEqual(router.db_for_write(TransactionV2), "default")
+        self.assertEqual(router.db_for_read(TransactionV2), "default")
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(router.allow_migrate("replica_0", "api_basics"))
+        self.assertTrue(router.allow_migrate("default", "api_basics"))
+
+    def test_stream_keeps_database_of_the_view(self):
+        def aliases():
+            for _ in range(2):
+                yield router.db_for_read(TransactionV2)
+
+        with read_from_replica():
+            stream = in_current_context(aliases())
+        self.assertEqual(list(stream), ["replica_0", "replica_0"])
+
+
+# replica aliases of the test database are mirrors of the default one, so "default" stands in for a replica here
+@override_settings(DATABASE_REPLICAS=["default"])
+class ReplicaReadsTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wallet = WalletFactory.create(balance=0)
+        cls.wallet.make_deposit(Decimal("10.00"))
+        cls.client = APIClient()
+        cls.wallet_url = "/api/wallets/" + cls.wallet.name + "/"
+
+    def setUp(self):
+        cache.clear()
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    @contextmanager
+    def record_reads(self):
+        """Collects what ReplicaRouter returned for reads of transactions: "default" for a replica and None for the
+        primary. The user is authenticated before the view starts and is always read from the primary."""
+        reads = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def recording_db_for_read(router, model, **hints):
+            alias = db_for_read(router, model, **hints)
+            if model is TransactionV2:
+                reads.append(alias)
+            return alias
+
+        with patch.object(ReplicaRouter, "db_for_read", recording_db_for_read):
+            yield reads
+
+    def test_read_only_actions_read_replica(self):
+        for url in ["history/", "balance/?at=2030-01-01T00:00:00Z"]:
+            with self.record_reads() as reads:
+                response = self.client.get(
+                    self.wallet_url + url, HTTP_ACCEPT="application/json"
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(reads)
+            self.assertEqual(set(reads), {"default"})
+
+    def test_export_stream_reads_replica(self):
+        response = self.client.get(self.wallet_url + "export_history/")
+        with self.record_reads() as reads:
+            lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(set(reads), {"default"})
+
+    def test_user_is_pinned_to_primary_after_write(self):
+        with self.record_reads() as reads:
+            self.client.post(self.wallet_url + "make_deposit/", {"amount": "1.00"})
+            self.client.get(self.wallet_url + "history/")
+        self.assertEqual(set(reads), {None})
+
+        cache.clear()
+        with self.record_reads() as reads:
+            self.client.get(self.wallet_url + "history/")
+        self.assertEqual(set(reads), {"default"})
+
+    def test_failed_write_doesnt_pin(self):
+        self.client.post(self.wallet_url + "make_deposit/", {"amount": "-1.00"})
+        with self.record_reads() as reads:
+            self.client.get(self.wallet_url + "history/")
+        self.assertEqual(set(reads), {"default"})
+
+    def test_report_is_aggregated_on_replica(self):
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 19, 13)),
+        ):
+            self.wallet.make_deposit(Decimal("5.00"))
+        last_id = TransactionV2.objects.order_by("-id").first().id
+
+        TransactionReport.fold_transactions(0, last_id, using="default")
+        TransactionReport.fold_transactions(last_id - 1, last_id, using="default")
+
+        report = TransactionReport.objects.get(
+            wallet=self.wallet, date=datetime.date(2021, 10, 19)
+        )
+        self.assertEqual(report.credit_sum, Decimal("10.00"))
+        self.assertEqual(TransactionReport.objects.count(), 2)
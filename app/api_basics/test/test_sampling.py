@@ -0,0 +1,126 @@
+import time
+from unittest.mock import patch
+
+import sentry_sdk
+from api_basics.sampling import TokenBucket, TracesSampler
+from api_basics.test.factory import WalletFactory
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from sentry_sdk.transport import Transport
+
+
+class StubTransport(Transport):
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.envelopes = []
+
+    def capture_envelope(self, envelope):
+        self.envelopes.append(envelope)
+
+
+def sampling_context(method, path, parent_sampled=None):
+    return {
+        "parent_sampled": parent_sampled,
+        "wsgi_environ": {"REQUEST_METHOD": method, "PATH_INFO": path},
+    }
+
+
+class TracesSamplerTestCase(APITestCase):
+    def setUp(self):
+        self.sampler = TracesSampler(
+            rates={"WalletViewSet.retrieve": 0.0, "WalletViewSet.list": 1.0},
+            default_rate=0.0,
+            tail={"WalletViewSet.make_transfer": 0.5},
+            budget_per_second=100,
+        )
+
+    def test_rates_by_endpoint(self):
+        self.assertFalse(self.sampler(sampling_context("GET", "/api/wallets/w/")))
+        self.assertTrue(self.sampler(sampling_context("GET", "/api/wallets/")))
+        self.assertFalse(self.sampler(sampling_context("GET", "/api/reports/")))
+        self.assertFalse(self.sampler(sampling_context("GET", "/missing/")))
+
+    def test_tail_endpoints_are_always_traced(self):
+        self.assertTrue(
+            self.sampler(sampling_context("POST", "/api/wallets/w/make_transfer/"))
+        )
+
+    def test_parent_decision_is_kept(self):
+        self.assertTrue(
+            self.sampler(
+                sampling_context("GET", "/api/wallets/w/", parent_sampled=True)
+            )
+        )
+        self.assertFalse(
+            self.sampler(sampling_context("GET", "/api/wallets/", parent_sampled=False))
+        )
+
+    def test_budget_limits_sampled_transactions(self):
+        sampler = TracesSampler(default_rate=1.0, budget_per_second=3)
+        with patch.object(time, "monotonic", return_value=1000.0):
+            sampler.budget = TokenBucket(3)
+            sampled = [
+                sampler(sampling_context("GET", "/api/wallets/")) for _ in range(10)
+            ]
+        self.assertEqual(sum(sampled), 3)
+
+        with patch.object(time, "monotonic", return_value=1001.0):
+            self.assertTrue(sampler(sampling_context("GET", "/api/wallets/")))
+
+
+class TraceSamplingMiddlewareTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = APIClient()
+
+    def setUp(self):
+        self.wallet = WalletFactory.create(balance=10)
+        self.recipient_wallet = WalletFactory.create(balance=0)
+        self.transfer_url = "/api/wallets/" + self.wallet.name + "/make_transfer/"
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+        self.transport = StubTransport()
+        self.sampler = TracesSampler(
+            default_rate=0.0, tail={"WalletViewSet.make_transfer": 0.5}
+        )
+        self.hub = sentry_sdk.Hub(
+            sentry_sdk.Client(
+                dsn="https://public@localhost/1",
+                transport=self.transport,
+                traces_sampler=self.sampler,
+            )
+        )
+
+    def transfer(self, amount):
+        with self.hub:
+            transaction = self.hub.start_transaction(
+                name="transfer",
+                custom_sampling_context=sampling_context("POST", self.transfer_url),
+            )
+            with transaction:
+                self.client.post(
+                    self.transfer_url,
+                    {"amount": amount, "recipient": self.recipient_wallet.name},
+                )
+        return transaction
+
+    def test_fast_transfer_is_not_sent(self):
+        self.assertFalse(self.transfer("1.00").sampled)
+        self.assertEqual(self.transport.envelopes, [])
+
+    def test_slow_transfer_is_sent(self):
+        self.sampler.tail["WalletViewSet.make_transfer"] = 0.0
+
+        self.assertTrue(self.transfer("1.00").sampled)
+        self.assertEqual(len(self.transport.envelopes), 1)
+
+    def test_failed_transfer_is_sent(self):
+        with patch(
+            "api_basics.models.Wallet.make_transaction", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            self.transfer("1.00")
+
+        self.assertEqual(len(self.transport.envelopes), 1)
@@ -0,0 +1,92 @@
+import json
+from datetime import timedelta
+from io import StringIO
+
+from api_basics.models import TransactionV2, Wallet
+from django.core.management import CommandError, call_command
+from django.db.models import Count, Max, Min, Sum
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+
+class SeedLedgerTestCase(APITestCase):
+    def seed(self, *args):
+        stdout = StringIO()
+        call_command(
+            "seed_ledger",
+            "--users",
+            "20",
+            "--operations",
+            "500",
+            "--chunk-size",
+            "64",
+            *args,
+            stdout=stdout,
+        )
+        return json.loads(stdout.getvalue())
+
+    def test_ledger_is_consistent(self):
+        summary = self.seed("--wallets-per-user", "2")
+
+        self.assertEqual(summary["wallets"], 40)
+        self.assertEqual(TransactionV2.objects.count(), summary["transactions"])
+        self.assertGreater(
+            TransactionV2.objects.filter(sender__isnull=False).count(), 0
+        )
+        for wallet in Wallet.objects.all():
+            rows = list(TransactionV2.objects.filter(wallet=wallet).order_by("id"))
+            balance = 0
+            for row in rows:
+                self.assertEqual(row.balance_before, balance)
+                sign = 1 if row.transaction_type == TransactionV2.CREDIT else -1
+                self.assertEqual(row.balance_after, balance + sign * row.amount)
+                balance = row.balance_after
+            self.assertEqual(wallet.balance, balance)
+        # every transfer is a debit and a credit of the same amount
+        debits = TransactionV2.objects.filter(transaction_type=TransactionV2.DEBIT)
+        transfer_credits = TransactionV2.objects.filter(
+            transaction_type=TransactionV2.CREDIT, sender__isnull=False
+        )
+        self.assertEqual(
+            debits.aggregate(Sum("amount")), transfer_credits.aggregate(Sum("amount"))
+        )
+
+    def test_history_spans_days_in_order(self):
+        self.seed("--days", "10")
+
+        span = TransactionV2.objects.aggregate(Min("timestamp"), Max("timestamp"))
+        self.assertLess(span["timestamp__min"], timezone.now() - timedelta(days=8))
+        self.assertLessEqual(span["timestamp__max"], timezone.now())
+        timestamps = list(
+            TransactionV2.objects.order_by("id").values_list("timestamp", flat=True)
+        )
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_same_seed_gives_same_data(self):
+        def ledger(prefix):
+            self.seed("--prefix", prefix, "--seed", "7")
+            return list(
+                TransactionV2.objects.filter(wallet__name__startswith=prefix)
+                .order_by("id")
+                .values_list("amount", "transaction_type", "balance_after")
+            )
+
+        self.assertEqual(ledger("first"), ledger("second"))
+
+    def test_hot_wallets(self):
+        self.seed("--hot-wallets", "2", "--hot-share", "0.8", "--skew", "1.5")
+
+        counts = sorted(
+            Wallet.objects.annotate(rows=Count("current_wallet")).values_list(
+                "rows", flat=True
+            ),
+            reverse=True,
+        )
+        self.assertGreater(sum(counts[:2]), sum(counts) * 0.6)
+
+    @override_settings(WALLET_SHARDS=["default", "default"])
+    def test_sharded_wallets_are_refused(self):
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.assertFalse(Wallet.objects.exists())
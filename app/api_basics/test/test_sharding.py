@@ -0,0 +1,304 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from api_basics.errors_exceptions import (
+    RECIPIENT_DOESNT_EXIST_ERROR,
+    RECIPIENT_ON_ANOTHER_SHARD_ERROR,
+)
+from api_basics.models import (
+    IdempotencyKey,
+    QueuedTransfer,
+    ShardTransfer,
+    TransactionReport,
+    TransactionV2,
+    Wallet,
+    WalletDirectory,
+    WalletEvent,
+)
+from api_basics.sharding import on_shard, shard_alias
+from api_basics.test.factory import WalletFactory
+from api_basics.views import ReportsViewSet
+from django.core.cache import cache
+from django.db import DatabaseError, router
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.test.factory import UserFactory
+
+
+@override_settings(WALLET_SHARDS=["default", "shard_1"])
+class ShardRouterTestCase(SimpleTestCase):
+    def test_wallets_are_placed_by_holder(self):
+        self.assertEqual(shard_alias(4), "default")
+        self.assertEqual(shard_alias(7), "shard_1")
+        self.assertEqual(
+            router.db_for_write(Wallet, instance=Wallet(holder_id=7)), "shard_1"
+        )
+
+    def test_queries_go_to_current_shard(self):
+        with on_shard("shard_1"):
+            self.assertEqual(router.db_for_read(TransactionV2), "shard_1")
+            self.assertEqual(router.db_for_write(ShardTransfer), "shard_1")
+            self.assertEqual(router.db_for_read(WalletDirectory), "default")
+
+    def test_shards_get_only_sharded_tables(self):
+        self.assertTrue(
+            router.allow_migrate("shard_1", "api_basics", model_name="wallet")
+        )
+        self.assertFalse(
+            router.allow_migrate("shard_1", "api_basics", model_name="walletdirectory")
+        )
+        self.assertFalse(router.allow_migrate("shard_1", "auth", model_name="user"))
+        self.assertTrue(
+            router.allow_migrate("default", "api_basics", model_name="walletdirectory")
+        )
+
+
+# both shards are the test default database, which is enough for everything that decides by shard index
+@override_settings(WALLET_SHARDS=["default", "default"])
+class ShardedWalletsTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = WalletFactory.create()
+        self.recipient = WalletFactory.create()
+        if self.recipient.shard == self.sender.shard:
+            self.recipient = WalletFactory.create()
+        self.neighbour = WalletFactory.create(holder=self.sender.holder)
+        self.sender.make_deposit(Decimal("10.00"))
+        self.client = APIClient()
+        refresh = RefreshToken.for_user(self.sender.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def balances(self):
+        return [
+            Wallet.objects.get(id=wallet.id).balance
+            for wallet in [self.sender, self.recipient]
+        ]
+
+    def transfer(self):
+        """Makes a cross-shard transfer whose saga stops after the debit, the test database transaction is never
+        committed."""
+        self.sender.make_transaction(Decimal("4.00"), self.recipient.id)
+        return ShardTransfer.objects.get(role=ShardTransfer.SENDER)
+
+    def test_wallet_ids_come_from_directory(self):
+        self.assertNotEqual(self.sender.shard, self.recipient.shard)
+        self.assertEqual(
+            WalletDirectory.objects.get(id=self.recipient.id).name,
+            self.recipient.name,
+        )
+        self.sender.delete()
+        self.assertFalse(WalletDirectory.objects.filter(id=self.sender.id).exists())
+
+    def test_transfer_inside_shard_is_local(self):
+        self.sender.make_transaction(Decimal("1.00"), self.neighbour.id)
+        self.assertFalse(ShardTransfer.objects.exists())
+        self.assertEqual(Wallet.objects.get(id=self.neighbour.id).balance, 1)
+
+    def test_cross_shard_transfer(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/wallets/" + self.sender.name + "/make_transfer/",
+                {"amount": "4.00", "recipient": self.recipient.name},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.balances(), [Decimal("6.00"), Decimal("4.00")])
+        self.assertEqual(
+            dict(ShardTransfer.objects.values_list("role", "state")),
+            {"sender": "completed", "recipient": "credited"},
+        )
+        self.assertEqual(
+            WalletEvent.objects.filter(event_type=WalletEvent.TRANSFER).count(), 1
+        )
+
+        response = self.client.get(
+            "/api/wallets/" + self.sender.name + "/history/",
+            HTTP_ACCEPT="application/json",
+        )
+        self.assertEqual(response.data["results"][0]["recipient"], self.recipient.name)
+
+    @override_settings(TRANSFER_QUEUE_ENABLED=True)
+    def test_cross_shard_transfer_isnt_queued(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/wallets/" + self.sender.name + "/make_transfer/",
+                {"amount": "4.00", "recipient": self.recipient.name},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.balances(), [Decimal("6.00"), Decimal("4.00")])
+        self.assertFalse(QueuedTransfer.objects.exists())
+
+    def test_failed_credit_is_compensated(self):
+        step = self.transfer()
+        with patch.object(
+            ShardTransfer, "_credit", side_effect=DatabaseError("shard is down")
+        ):
+            step.finish()
+        self.assertIsInstance(step.error, DatabaseError)
+        self.assertEqual(self.balances(), [Decimal("10.00"), Decimal("0.00")])
+        self.assertEqual(
+            dict(ShardTransfer.objects.values_list("role", "state")),
+            {"sender": "compensated", "recipient": "aborted"},
+        )
+        self.assertEqual(
+            list(
+                TransactionV2.objects.filter(wallet=self.sender)
+                .order_by("id")
+                .values_list("transaction_type", "balance_after")
+            ),
+            [
+                ("CRED", Decimal("10.00")),
+                ("DEB", Decimal("6.00")),
+                ("CRED", Decimal("10.00")),
+            ],
+        )
+
+    def test_unfinished_transfer_is_recovered(self):
+        self.transfer()
+        self.assertEqual(self.balances(), [Decimal("6.00"), Decimal("0.00")])
+        self.assertEqual(ShardTransfer.recover(timedelta(minutes=1)), 0)
+
+        self.assertEqual(ShardTransfer.recover(timedelta(0)), 1)
+        self.assertEqual(self.balances(), [Decimal("6.00"), Decimal("4.00")])
+        self.assertEqual(ShardTransfer.objects.get(role="sender").state, "completed")
+
+    def test_credit_made_before_crash_isnt_repeated(self):
+        step = self.transfer()
+        with patch.object(ShardTransfer, "_complete"):
+            step.finish()
+        self.assertEqual(ShardTransfer.objects.get(role="sender").state, "debited")
+
+        ShardTransfer.recover(timedelta(0))
+        self.assertEqual(self.balances(), [Decimal("6.00"), Decimal("4.00")])
+        self.assertEqual(ShardTransfer.objects.get(role="sender").state, "completed")
+
+    def test_hot_recipient_is_credited_to_slot(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipient.set_balance_slots(2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sender.make_transaction(Decimal("4.00"), self.recipient.id)
+
+        self.assertEqual(self.balances(), [Decimal("6.00"), Decimal("0.00")])
+        self.assertEqual(
+            Wallet.objects.with_total_balance().get(id=self.recipient.id).balance,
+            Decimal("4.00"),
+        )
+        credit = TransactionV2.objects.get(
+            wallet=self.recipient, transaction_type=TransactionV2.CREDIT
+        )
+        self.assertIsNone(credit.balance_after)
+
+    def test_batch_transfers_stay_inside_shard(self):
+        results, balance = self.sender.make_transactions(
+            [
+                {"amount": Decimal("1.00"), "recipient": self.neighbour.name},
+                {"amount": Decimal("1.00"), "recipient": self.recipient.name},
+            ]
+        )
+        self.assertEqual(balance, Decimal("9.00"))
+        self.assertEqual(
+            results[1]["errors"], {"recipient": [RECIPIENT_ON_ANOTHER_SHARD_ERROR]}
+        )
+
+
+# sagas are finished by on_commit callbacks, so requests have to commit for real here
+@override_settings(WALLET_SHARDS=["default", "default"])
+class IdempotentShardTransferTestCase(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = WalletFactory.create()
+        self.recipient = WalletFactory.create()
+        if self.recipient.shard == self.sender.shard:
+            self.recipient = WalletFactory.create()
+        self.sender.make_deposit(Decimal("10.00"))
+        refresh = RefreshToken.for_user(self.sender.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_compensated_transfer_is_replayed_as_error(self):
+        url = "/api/wallets/" + self.sender.name + "/make_transfer/"
+        request_body = {"amount": "4.00", "recipient": self.recipient.name}
+        with patch.object(ShardTransfer, "_credit", side_effect=Wallet.DoesNotExist):
+            responses = [
+                self.client.post(url, request_body, HTTP_IDEMPOTENCY_KEY="key")
+                for _ in range(2)
+            ]
+
+        for response in responses:
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(
+                response.data, {"recipient": [RECIPIENT_DOESNT_EXIST_ERROR]}
+            )
+        self.assertEqual(responses[1]["Idempotent-Replayed"], "true")
+        self.assertEqual(
+            [
+                Wallet.objects.get(id=wallet.id).balance
+                for wallet in [self.sender, self.recipient]
+            ],
+            [Decimal("10.00"), Decimal("0.00")],
+        )
+        self.assertEqual(ShardTransfer.objects.filter(role="sender").count(), 1)
+
+    def test_key_of_failed_transfer_is_released(self):
+        url = "/api/wallets/" + self.sender.name + "/make_transfer/"
+        request_body = {"amount": "4.00", "recipient": self.recipient.name}
+        with patch.object(
+            ShardTransfer, "_credit", side_effect=DatabaseError("shard is down")
+        ):
+            with self.assertRaises(DatabaseError):
+                self.client.post(url, request_body, HTTP_IDEMPOTENCY_KEY="key")
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        response = self.client.post(url, request_body, HTTP_IDEMPOTENCY_KEY="key")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Wallet.objects.get(id=self.recipient.id).balance, 4)
+
+
+class ShardedReportsTestCase(APITestCase):
+    def setUp(self):
+        self.wallets = WalletFactory.create_batch(2)
+        for day, wallet in [
+            (1, self.wallets[0]),
+            (2, self.wallets[1]),
+            (3, self.wallets[0]),
+        ]:
+            TransactionReport.objects.create(
+                wallet=wallet, date=date(2021, 10, day), credit_sum=Decimal(day)
+            )
+        admin = UserFactory.create(is_staff=True)
+        refresh = RefreshToken.for_user(admin)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_reports_are_listed_from_all_shards(self):
+        using = QuerySet.using
+
+        def using_shard(queryset, alias):
+            # the test database stands for both shards, each holds reports of one wallet
+            if queryset.model is not TransactionReport:
+                return using(queryset, alias)
+            wallet = self.wallets[alias == "shard_1"]
+            return TransactionReport.objects.filter(wallet=wallet)
+
+        with override_settings(WALLET_SHARDS=["default", "shard_1"]), patch.object(
+            QuerySet, "using", using_shard
+        ), patch.object(
+            ReportsViewSet,
+            "queryset",
+            TransactionReport.objects.filter(wallet=self.wallets[0]),
+        ):
+            response = self.client.get("/api/reports/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 3)
+        self.assertEqual(
+            [report["date"] for report in response.data["results"]],
+            ["2021-10-03", "2021-10-02", "2021-10-01"],
+        )
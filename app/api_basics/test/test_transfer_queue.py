@@ -0,0 +1,110 @@
+from decimal import Decimal
+from io import StringIO
+
+from api_basics.errors_exceptions import INSUFFICIENT_FUNDS_ERROR
+from api_basics.models import QueuedTransfer, TransactionV2, Wallet, WalletEvent
+from api_basics.test.factory import WalletFactory
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+@override_settings(TRANSFER_QUEUE_ENABLED=True)
+class TransferQueueTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = WalletFactory.create()
+        self.recipients = WalletFactory.create_batch(2)
+        self.sender.make_deposit(Decimal("10.00"))
+        self.client = APIClient()
+        refresh = RefreshToken.for_user(self.sender.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+        self.sender_url = "/api/wallets/" + self.sender.name + "/"
+
+    def transfer(self, amount, recipient):
+        return self.client.post(
+            self.sender_url + "make_transfer/",
+            {"amount": amount, "recipient": recipient.name},
+        )
+
+    def balance(self, wallet):
+        return Wallet.objects.get(id=wallet.id).balance
+
+    def test_transfer_is_queued(self):
+        response = self.transfer("4.00", self.recipients[0])
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["transaction_status"], "pending")
+        self.assertEqual(self.balance(self.sender), Decimal("10.00"))
+        self.assertFalse(TransactionV2.objects.filter(transaction_type="DEB").exists())
+
+        response = self.client.get(response["Location"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["recipient"], self.recipients[0].name)
+        self.assertEqual(response.data["transaction_status"], "pending")
+
+    def test_invalid_transfer_isnt_queued(self):
+        response = self.transfer("-1.00", self.recipients[0])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(QueuedTransfer.objects.exists())
+
+    def test_batch_is_applied_in_order(self):
+        ids = [
+            self.transfer(amount, recipient).data["transfer_id"]
+            for amount, recipient in [
+                ("4.00", self.recipients[0]),
+                ("7.00", self.recipients[1]),
+                ("5.00", self.recipients[1]),
+            ]
+        ]
+
+        self.assertEqual(QueuedTransfer.execute(batch_size=2), 3)
+
+        self.assertEqual(
+            [self.balance(wallet) for wallet in [self.sender, *self.recipients]],
+            [Decimal("1.00"), Decimal("4.00"), Decimal("5.00")],
+        )
+        self.assertEqual(WalletEvent.objects.filter(event_type="transfer").count(), 2)
+        response = self.client.get(self.sender_url + "transfers/{}/".format(ids[1]))
+        self.assertEqual(response.data["transaction_status"], "failed")
+        self.assertEqual(
+            response.data["errors"], {"amount": [INSUFFICIENT_FUNDS_ERROR]}
+        )
+        self.assertEqual(response.data["new_balance"], "6.00")
+        response = self.client.get(self.sender_url + "transfers/{}/".format(ids[2]))
+        self.assertEqual(response.data["transaction_status"], "success")
+        self.assertEqual(response.data["new_balance"], "1.00")
+
+    def test_batch_costs_the_same_number_of_queries(self):
+        def execute(transfers):
+            for _ in range(transfers):
+                self.transfer("0.10", self.recipients[0])
+            with CaptureQueriesContext(connection) as queries:
+                QueuedTransfer.execute_batch(batch_size=100)
+            return len(queries)
+
+        self.assertEqual(execute(2), execute(20))
+        self.assertFalse(QueuedTransfer.objects.filter(state="pending").exists())
+
+    def test_status_of_another_wallet_transfer(self):
+        transfer_id = self.transfer("4.00", self.recipients[0]).data["transfer_id"]
+        other = WalletFactory.create(holder=self.sender.holder)
+
+        response = self.client.get(
+            "/api/wallets/" + other.name + "/transfers/{}/".format(transfer_id)
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_executor_command(self):
+        self.transfer("4.00", self.recipients[0])
+        out = StringIO()
+        call_command("execute_transfers", once=True, stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Processed 1 transfers.")
+        self.assertEqual(self.balance(self.recipients[0]), Decimal("4.00"))
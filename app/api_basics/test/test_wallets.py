@@ -1,11 +1,25 @@
+import datetime
 from decimal import Decimal
+from unittest.mock import patch
 
-from api_basics.models import Wallet
-from api_basics.test.factory import WalletFactory
+from api_basics.cache import wallet_cache
+from api_basics.errors_exceptions import (
+    INSUFFICIENT_FUNDS_ERROR,
+    RECIPIENT_DOESNT_EXIST_ERROR,
+    RECIPIENT_IS_SENDER_ERROR,
+    TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR,
+)
+from api_basics.models import IdempotencyKey, TransactionV2, Wallet
+from api_basics.tasks import purge_idempotency_keys
+from api_basics.test.factory import HistoryFactory, WalletFactory
+from api_basics.utils import TransactionsCursorPagination
 from api_basics.views import WalletViewSet
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
 from faker import Faker
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.test import APIClient, APITestCase
 from rest_framework_simplejwt.tokens import RefreshToken
 from users.test.factory import UserFactory
@@ -79,3 +93,512 @@ class MakeTransferTestCase(APITestCase):
             Wallet.objects.get(name=self.recipient_wallet.name).balance,
             new_recipient_balance,
         )
+
+    def test_transfers_record_running_balances(self):
+        sender = WalletFactory.create(balance=0)
+        recipient = WalletFactory.create(balance=0)
+        sender.make_deposit(Decimal("100.00"))
+
+        self.assertEqual(
+            sender.make_transaction(Decimal("30.50"), recipient.id), Decimal("69.50")
+        )
+        self.assertEqual(
+            recipient.make_transaction(Decimal("10.00"), sender.id), Decimal("20.50")
+        )
+        self.assertEqual(Wallet.objects.get(id=sender.id).balance, Decimal("79.50"))
+        self.assertEqual(Wallet.objects.get(id=recipient.id).balance, Decimal("20.50"))
+        self.assertEqual(
+            list(
+                TransactionV2.objects.filter(wallet=sender)
+                .order_by("id")
+                .values_list("transaction_type", "balance_before", "balance_after")
+            ),
+            [
+                ("CRED", Decimal("0.00"), Decimal("100.00")),
+                ("DEB", Decimal("100.00"), Decimal("69.50")),
+                ("CRED", Decimal("69.50"), Decimal("79.50")),
+            ],
+        )
+
+    def test_transfer_with_insufficient_funds_changes_nothing(self):
+        sender = WalletFactory.create(balance=0)
+        recipient = WalletFactory.create(balance=0)
+
+        with self.assertRaises(ValidationError):
+            sender.make_transaction(Decimal("1.00"), recipient.id)
+        self.assertEqual(Wallet.objects.get(id=sender.id).balance, 0)
+        self.assertFalse(TransactionV2.objects.filter(wallet=sender).exists())
+
+    @override_settings(WALLET_CACHE_ENABLED=False)
+    def test_transfer_request_resolves_wallets_by_one_query(self):
+        sender = WalletFactory.create(balance=10)
+        recipient = WalletFactory.create(balance=0)
+        refresh = RefreshToken.for_user(sender.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+        # user, sender and recipient, and 6 queries of the transfer itself
+        with self.assertNumQueries(8):
+            response = self.client.post(
+                "/api/wallets/" + sender.name + "/make_transfer/",
+                {"amount": "1.00", "recipient": recipient.name},
+            )
+        self.assertEqual(response.data["new_balance"], "9.00")
+
+    def test_transfer_query_count(self):
+        sender = WalletFactory.create(balance=10)
+        recipient = WalletFactory.create(balance=0)
+
+        # savepoint, lock of both wallets, ledger rows insert, outbox event insert, balances update, savepoint release
+        with self.assertNumQueries(6):
+            sender.make_transaction(Decimal("1.00"), recipient.id)
+
+
+class MakeTransfersTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = APIClient()
+        cls.recipient_wallets = WalletFactory.create_batch(3, balance=0)
+
+    def setUp(self):
+        self.sender_wallet = WalletFactory.create(balance=0)
+        self.sender_wallet.make_deposit(Decimal("100.00"))
+        self.transfers_url = (
+            "/api/wallets/" + self.sender_wallet.name + "/make_transfers/"
+        )
+        refresh = RefreshToken.for_user(self.sender_wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_transfers_get_own_results(self):
+        request_body = {
+            "transfers": [
+                {"amount": "10.00", "recipient": self.recipient_wallets[0].name},
+                {"amount": "20.00", "recipient": "no_such_wallet"},
+                {"amount": "30.00", "recipient": self.sender_wallet.name},
+                {"amount": "-1", "recipient": self.recipient_wallets[1].name},
+                {"amount": "85.00", "recipient": self.recipient_wallets[1].name},
+                {"amount": "90.00", "recipient": self.recipient_wallets[2].name},
+                {"amount": "5.00", "recipient": self.recipient_wallets[0].name},
+            ]
+        }
+        response = self.client.post(self.transfers_url, request_body, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["transaction_status"], "partial")
+        self.assertEqual(response.data["new_balance"], "0.00")
+        self.assertEqual(
+            [result["transaction_status"] for result in response.data["results"]],
+            ["success", "failed", "failed", "failed", "success", "failed", "success"],
+        )
+        self.assertEqual(
+            [result.get("errors") for result in response.data["results"]],
+            [
+                None,
+                {"recipient": [RECIPIENT_DOESNT_EXIST_ERROR]},
+                {"recipient": [RECIPIENT_IS_SENDER_ERROR]},
+                {"amount": [TRANSACTION_AMOUNT_ZERO_NEGATIVE_ERROR]},
+                None,
+                {"amount": [INSUFFICIENT_FUNDS_ERROR]},
+                None,
+            ],
+        )
+        self.assertEqual(Wallet.objects.get(id=self.sender_wallet.id).balance, 0)
+        self.assertEqual(
+            Wallet.objects.get(id=self.recipient_wallets[0].id).balance, 15
+        )
+        self.assertEqual(
+            list(
+                TransactionV2.objects.filter(wallet=self.sender_wallet)
+                .order_by("id")
+                .values_list("balance_before", "balance_after")
+            ),
+            [
+                (Decimal("0.00"), Decimal("100.00")),
+                (Decimal("100.00"), Decimal("90.00")),
+                (Decimal("90.00"), Decimal("5.00")),
+                (Decimal("5.00"), Decimal("0.00")),
+            ],
+        )
+
+    def test_all_or_nothing_doesnt_apply_anything_on_failure(self):
+        request_body = {
+            "transfers": [
+                {"amount": "10.00", "recipient": self.recipient_wallets[0].name},
+                {"amount": "20.00", "recipient": "no_such_wallet"},
+            ],
+            "all_or_nothing": True,
+        }
+        response = self.client.post(self.transfers_url, request_body, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["transaction_status"], "failed")
+        self.assertEqual(response.data["new_balance"], "100.00")
+        self.assertEqual(
+            [result["transaction_status"] for result in response.data["results"]],
+            ["not_applied", "failed"],
+        )
+        self.assertEqual(Wallet.objects.get(id=self.sender_wallet.id).balance, 100)
+        self.assertEqual(
+            TransactionV2.objects.filter(sender=self.sender_wallet).count(), 0
+        )
+
+    def test_transfers_query_count_doesnt_depend_on_batch_size(self):
+        transfers = [
+            {"amount": Decimal("1.00"), "recipient": wallet.name}
+            for wallet in self.recipient_wallets
+        ]
+        # savepoint, lock of all wallets, ledger rows insert, outbox events insert, balances update, savepoint release
+        with self.assertNumQueries(6):
+            self.sender_wallet.make_transactions(transfers)
+        with self.assertNumQueries(6):
+            self.sender_wallet.make_transactions(transfers * 10)
+        self.assertEqual(
+            Wallet.objects.get(id=self.sender_wallet.id).balance, Decimal("67.00")
+        )
+
+
+class HistoryTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wallet = WalletFactory.create(balance=0)
+        cls.counterparties = WalletFactory.create_batch(3, balance=0)
+        for counterparty in cls.counterparties:
+            HistoryFactory.create(
+                wallet=cls.wallet,
+                sender=cls.wallet,
+                recipient=counterparty,
+                amount=Decimal("1.00"),
+                transaction_type="DEB",
+            )
+            HistoryFactory.create(
+                wallet=cls.wallet,
+                sender=counterparty,
+                recipient=cls.wallet,
+                amount=Decimal("2.00"),
+                transaction_type="CRED",
+            )
+        HistoryFactory.create(
+            wallet=cls.wallet,
+            sender=None,
+            recipient=cls.wallet,
+            amount=Decimal("3.00"),
+            transaction_type="CRED",
+        )
+        cls.client = APIClient()
+        cls.history_url = "/api/wallets/" + cls.wallet.name + "/history/"
+
+    def setUp(self):
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_history_json_contains_wallet_names(self):
+        response = self.client.get(self.history_url, HTTP_ACCEPT="application/json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 7)
+        for row in response.data["results"]:
+            self.assertEqual(row["wallet"], self.wallet.name)
+            if row["transaction_type"] == "DEB":
+                self.assertEqual(row["sender"], self.wallet.name)
+                self.assertIn(row["recipient"], [w.name for w in self.counterparties])
+            elif row["sender"] is not None:
+                self.assertIn(row["sender"], [w.name for w in self.counterparties])
+                self.assertEqual(row["recipient"], self.wallet.name)
+
+    @override_settings(WALLET_CACHE_ENABLED=False)
+    def test_history_query_count_is_constant(self):
+        # user, wallet lookup, page count and the page itself with joined wallet names
+        with self.assertNumQueries(4):
+            response = self.client.get(self.history_url, HTTP_ACCEPT="application/json")
+        self.assertEqual(len(response.data["results"]), 7)
+
+        with self.assertNumQueries(4):
+            response = self.client.get(self.history_url, HTTP_ACCEPT="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_export_history_matches_history_csv(self):
+        history_response = self.client.get(self.history_url, HTTP_ACCEPT="text/csv")
+        export_response = self.client.get(
+            "/api/wallets/" + self.wallet.name + "/export_history/",
+            HTTP_ACCEPT="text/csv",
+        )
+
+        self.assertEqual(export_response.status_code, status.HTTP_200_OK)
+        self.assertTrue(export_response.streaming)
+        self.assertEqual(
+            b"".join(export_response.streaming_content).decode(),
+            history_response.content.decode(),
+        )
+
+    def test_export_history_applies_filters(self):
+        export_response = self.client.get(
+            "/api/wallets/" + self.wallet.name + "/export_history/",
+            {"transaction_type": "DEB", "ordering": "timestamp"},
+        )
+
+        lines = b"".join(export_response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(all(",DEB," in line for line in lines[1:]))
+
+    def test_iterator_by_key_returns_all_rows_across_chunks(self):
+        transactions = TransactionV2.objects.filter(wallet=self.wallet)
+        for ordering in ["-timestamp", "timestamp"]:
+            self.assertEqual(
+                [
+                    obj.id
+                    for obj in transactions.iterator_by_key(ordering, chunk_size=2)
+                ],
+                list(transactions.order_by_key(ordering).values_list("id", flat=True)),
+            )
+
+    def test_history_cursor_pagination_walks_all_rows(self):
+        for ordering in ["-timestamp", "timestamp"]:
+            with patch.object(TransactionsCursorPagination, "page_size", 3):
+                ids = []
+                url = self.history_url + "?pagination=cursor&ordering=" + ordering
+                while url:
+                    response = self.client.get(url, HTTP_ACCEPT="application/json")
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+                    self.assertNotIn("count", response.data)
+                    ids += [row["id"] for row in response.data["results"]]
+                    url = response.data["next"]
+
+            self.assertEqual(
+                ids,
+                list(
+                    TransactionV2.objects.filter(wallet=self.wallet)
+                    .order_by_key(ordering)
+                    .values_list("id", flat=True)
+                ),
+            )
+
+    def test_history_cursor_pagination_invalid_cursor(self):
+        response = self.client.get(
+            self.history_url,
+            {"pagination": "cursor", "cursor": "garbage"},
+            HTTP_ACCEPT="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BalanceTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wallet = WalletFactory.create(balance=0)
+        cls.recipient_wallet = WalletFactory.create(balance=0)
+        for day, amount in enumerate(["100.00", "50.00"], start=1):
+            with patch.object(
+                timezone,
+                "now",
+                return_value=timezone.make_aware(datetime.datetime(2021, 10, day)),
+            ):
+                cls.wallet.make_deposit(Decimal(amount))
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 3)),
+        ):
+            cls.wallet.make_transaction(Decimal("30.00"), cls.recipient_wallet.id)
+        cls.client = APIClient()
+        cls.balance_url = "/api/wallets/" + cls.wallet.name + "/balance/"
+
+    def setUp(self):
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_balance_at_moment(self):
+        for at, balance in [
+            ("2021-09-30T00:00:00Z", "0.00"),
+            ("2021-10-01T00:00:00Z", "100.00"),
+            ("2021-10-02T12:00:00Z", "150.00"),
+            ("2021-10-03T00:00:00Z", "120.00"),
+        ]:
+            response = self.client.get(self.balance_url, {"at": at})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response.data,
+                {"name": self.wallet.name, "at": at, "balance": balance},
+            )
+
+    def test_current_balance(self):
+        response = self.client.get(self.balance_url)
+        self.assertEqual(response.data["balance"], "120.00")
+
+    @override_settings(WALLET_CACHE_ENABLED=False)
+    def test_balance_at_moment_query_count(self):
+        # user, wallet lookup and the last transaction before the moment
+        with self.assertNumQueries(3):
+            self.client.get(self.balance_url, {"at": "2021-10-02T12:00:00Z"})
+
+
+class IdempotencyKeyTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = APIClient()
+
+    def setUp(self):
+        self.wallet = WalletFactory.create(balance=0)
+        self.recipient_wallet = WalletFactory.create(balance=0)
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_repeated_deposit_is_applied_once(self):
+        url = "/api/wallets/" + self.wallet.name + "/make_deposit/"
+        responses = [
+            self.client.post(url, {"amount": "10.00"}, HTTP_IDEMPOTENCY_KEY="key-1")
+            for _ in range(3)
+        ]
+
+        for response in responses:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response.data, {"transaction_status": "success", "new_balance": "10.00"}
+            )
+        self.assertNotIn("Idempotent-Replayed", responses[0])
+        self.assertEqual(responses[1]["Idempotent-Replayed"], "true")
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 10)
+        self.assertEqual(TransactionV2.objects.filter(wallet=self.wallet).count(), 1)
+
+        # different key is a different request
+        self.client.post(url, {"amount": "10.00"}, HTTP_IDEMPOTENCY_KEY="key-2")
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 20)
+
+    def test_repeated_transfer_is_applied_once(self):
+        self.wallet.make_deposit(Decimal("10.00"))
+        url = "/api/wallets/" + self.wallet.name + "/make_transfer/"
+        request_body = {"amount": "4.00", "recipient": self.recipient_wallet.name}
+        for _ in range(2):
+            response = self.client.post(url, request_body, HTTP_IDEMPOTENCY_KEY="key")
+            self.assertEqual(response.data["new_balance"], "6.00")
+
+        self.assertEqual(Wallet.objects.get(id=self.recipient_wallet.id).balance, 4)
+
+    def test_failed_request_is_not_stored(self):
+        url = "/api/wallets/" + self.wallet.name + "/make_transfer/"
+        request_body = {"amount": "4.00", "recipient": self.recipient_wallet.name}
+        response = self.client.post(url, request_body, HTTP_IDEMPOTENCY_KEY="key")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.wallet.make_deposit(Decimal("10.00"))
+        response = self.client.post(url, request_body, HTTP_IDEMPOTENCY_KEY="key")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Wallet.objects.get(id=self.recipient_wallet.id).balance, 4)
+
+    def test_key_reused_with_different_request(self):
+        url = "/api/wallets/" + self.wallet.name + "/make_deposit/"
+        self.client.post(url, {"amount": "10.00"}, HTTP_IDEMPOTENCY_KEY="key")
+        response = self.client.post(
+            url, {"amount": "11.00"}, HTTP_IDEMPOTENCY_KEY="key"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 10)
+
+    def test_old_keys_are_purged(self):
+        url = "/api/wallets/" + self.wallet.name + "/make_deposit/"
+        with patch.object(
+            timezone,
+            "now",
+            return_value=timezone.make_aware(datetime.datetime(2021, 10, 1)),
+        ):
+            self.client.post(url, {"amount": "10.00"}, HTTP_IDEMPOTENCY_KEY="old")
+        self.client.post(url, {"amount": "10.00"}, HTTP_IDEMPOTENCY_KEY="new")
+
+        purge_idempotency_keys.apply()
+
+        self.assertEqual(
+            list(IdempotencyKey.objects.values_list("key", flat=True)), ["new"]
+        )
+
+
+class WalletCacheTestCase(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = APIClient()
+
+    def setUp(self):
+        wallet_cache.clear()
+        self.wallet = WalletFactory.create(balance=0)
+        self.recipient_wallet = WalletFactory.create(balance=0)
+        self.wallet_url = "/api/wallets/" + self.wallet.name + "/"
+        refresh = RefreshToken.for_user(self.wallet.holder)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + str(refresh.access_token)
+        )
+
+    def test_retrieve_is_served_from_cache(self):
+        # the first lookup caches wallet id by name, the second one its data
+        self.client.get(self.wallet_url)
+        self.client.get(self.wallet_url)
+        # only the user is loaded
+        with self.assertNumQueries(1):
+            response = self.client.get(self.wallet_url)
+
+        self.assertEqual(response.data, {"name": self.wallet.name, "balance": "0.00"})
+        self.assertEqual(wallet_cache.stats()["misses"], 2)
+        self.assertEqual(wallet_cache.stats()["hits"], 1)
+
+    def test_uncached_wallets_are_loaded_by_one_query(self):
+        wallets = WalletFactory.create_batch(3)
+        self.client.get("/api/wallets/" + wallets[0].name + "/")
+        names = [wallet.name for wallet in wallets] + ["missing"]
+
+        with self.assertNumQueries(1):
+            found = wallet_cache.get_many_by_name(names)
+        self.assertEqual(set(found), set(names[:3]))
+        with self.assertNumQueries(1):
+            wallet_cache.get_many_by_name(names)
+        self.assertEqual(wallet_cache.get_by_name(names[0]).id, wallets[0].id)
+
+    def test_writes_invalidate_cache(self):
+        self.client.get(self.wallet_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.wallet_url + "make_deposit/", {"amount": "10.00"})
+        self.assertEqual(self.client.get(self.wallet_url).data["balance"], "10.00")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                self.wallet_url + "make_transfer/",
+                {"amount": "4.00", "recipient": self.recipient_wallet.name},
+            )
+        self.assertEqual(self.client.get(self.wallet_url).data["balance"], "6.00")
+        self.assertEqual(
+            wallet_cache.get_by_name(self.recipient_wallet.name).balance,
+            Decimal("4.00"),
+        )
+
+    def test_data_cached_before_commit_is_not_served_after_it(self):
+        self.client.get(self.wallet_url)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.recipient_wallet.make_deposit(Decimal("1.00"))
+            # a concurrent reader caches the balance it sees before the commit
+            Wallet.objects.filter(id=self.recipient_wallet.id).update(balance=0)
+            wallet_cache.get_by_id(self.recipient_wallet.id)
+            Wallet.objects.filter(id=self.recipient_wallet.id).update(balance=1)
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(
+            wallet_cache.get_by_id(self.recipient_wallet.id).balance, Decimal("1.00")
+        )
+
+    @override_settings(WALLET_CACHE_ENABLED=False)
+    def test_disabled_cache(self):
+        self.client.get(self.wallet_url)
+        with self.assertNumQueries(2):
+            self.client.get(self.wallet_url)
+        self.assertEqual(wallet_cache.stats()["misses"], 0)
@@ -1,11 +1,12 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from .views import ReportsViewSet, WalletViewSet
+from .views import QueryStatsView, ReportsViewSet, WalletViewSet
 
 router = DefaultRouter()
 router.register("wallets", WalletViewSet, basename="wallets")
 router.register("reports", ReportsViewSet, basename="reports")
 
-urlpatterns = []
+urlpatterns = [path("query_stats/", QueryStatsView.as_view(), name="query_stats")]
 
 urlpatterns += router.urls
@@ -1,5 +1,29 @@
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.permissions import BasePermission
+import csv
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils.dateparse import parse_datetime
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.fields import DateTimeField
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.permissions import SAFE_METHODS, BasePermission
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from . import sharding
+from .cache import wallet_cache
+from .errors_exceptions import (
+    IDEMPOTENCY_KEY_REUSED_ERROR,
+    IDEMPOTENCY_KEY_TOO_LONG_ERROR,
+)
+from .models import IdempotencyKey, ShardTransfer
+from .routers import is_pinned_to_primary, pin_to_primary, read_from_replica
 
 
 class UserWalletPermission(BasePermission):
@@ -7,7 +31,85 @@ class UserWalletPermission(BasePermission):
     by current user and raise 403 in this case."""
 
     def has_object_permission(self, request, view, obj):
-        return obj.holder == request.user
+        return obj.holder_id == request.user.id
+
+
+class ReplicaReadsMixin:
+    """Viewset mixin that runs 'replica_actions' with reads routed to a replica (see api_basics.routers), unless the
+    user is pinned to the primary. Any successful unsafe request pins its user to the primary for a short time, so
+    their next reads see what they have just written."""
+
+    replica_actions = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if (
+            settings.DATABASE_REPLICAS
+            and self.action in self.replica_actions
+            and not is_pinned_to_primary(request.user.id)
+        ):
+            self._replica_reads = read_from_replica()
+            self._replica_reads.__enter__()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        replica_reads = getattr(self, "_replica_reads", None)
+        if replica_reads is not None:
+            self._replica_reads = None
+            replica_reads.__exit__(None, None, None)
+        if (
+            settings.DATABASE_REPLICAS
+            and request.method not in SAFE_METHODS
+            and status.is_success(response.status_code)
+            and request.user.is_authenticated
+        ):
+            pin_to_primary(request.user.id)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class WalletShardMixin:
+    """Viewset mixin that runs the action on the shard (see api_basics.sharding) of the wallet from the URL, or of
+    the user for actions without one, like 'list' and 'create'. The wallet is looked up by the same request-scoped
+    'wallets' resolver as 'get_object' uses, so this costs no extra query."""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if sharding.is_sharded():
+            name = self.kwargs.get(self.lookup_field)
+            wallet = self.wallets.get(name) if name is not None else None
+            holder_id = wallet.holder_id if wallet is not None else request.user.id
+            self._shard = sharding.on_shard(sharding.shard_alias(holder_id))
+            self._shard.__enter__()
+
+    def dispatch(self, request, *args, **kwargs):
+        # not in 'finalize_response', which is skipped when the action raises an unexpected error, and the shard
+        # would be left chosen for the next request of the thread
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            shard = getattr(self, "_shard", None)
+            if shard is not None:
+                self._shard = None
+                shard.__exit__(None, None, None)
+
+
+class WalletResolver:
+    """Request-scoped lookup of wallets by name. All wallets that a request refers to (sender from URL and
+    recipient from the body) are resolved together by one wallet cache call, which means at most one query, and the
+    result is shared by the serializer, object permission check and the view itself."""
+
+    def __init__(self):
+        self.wallets = {}
+
+    def resolve(self, *names):
+        missing = {name for name in names if name not in self.wallets}
+        if missing:
+            found = wallet_cache.get_many_by_name(missing)
+            self.wallets.update({name: found.get(name) for name in missing})
+        return self.wallets
+
+    def get(self, name):
+        """Returns wallet with given name or None if it doesn't exist."""
+        return self.resolve(name)[name]
 
 
 class WalletsPagination(PageNumberPagination):
@@ -24,3 +126,184 @@ class TransactionsPagination(PageNumberPagination):
     page_size = 50
     page_query_param = "page_size"
     max_page_size = 100
+
+
+class TransactionsCursorPagination(BasePagination):
+    """Keyset pagination class for 'history' action of 'wallets' resource, enabled by 'pagination=cursor' parameter.
+    Every page seeks past ('timestamp', 'id') of the last row of the previous page instead of counting all rows and
+    skipping them with OFFSET, so the cost of a page doesn't depend on how deep it is."""
+
+    page_size = 50
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = request.query_params.get("ordering", "-timestamp")
+        queryset = queryset.order_by_key(self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.after_key(*self.decode_cursor(cursor), self.ordering)
+        results = list(queryset[: self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[: self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict([("next", self.get_next_link()), ("results", data)])
+        )
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(last.timestamp, last.id)
+        )
+
+    @staticmethod
+    def encode_cursor(timestamp, pk):
+        return urlsafe_b64encode(
+            "{}|{}".format(timestamp.isoformat(), pk).encode()
+        ).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            timestamp, pk = urlsafe_b64decode(cursor.encode()).decode().split("|")
+            timestamp, pk = parse_datetime(timestamp), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                "name": self.cursor_query_param,
+                "required": False,
+                "in": "query",
+                "description": "The pagination cursor value.",
+                "schema": {"type": "string"},
+            }
+        ]
+
+
+# same columns in the same order as CSVRenderer output of 'history' action
+HISTORY_CSV_HEADER = [
+    "amount",
+    "balance_after",
+    "balance_before",
+    "id",
+    "recipient",
+    "sender",
+    "timestamp",
+    "transaction_type",
+    "wallet",
+]
+
+
+class _EchoBuffer:
+    """File-like object for csv.writer that returns written line instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def stream_history_csv(transactions, ordering="-timestamp"):
+    """Generator of CSV lines for 'export_history' action. 'transactions' should have wallet names joined
+    (TransactionV2QuerySet.with_wallet_names), rows are fetched in keyset chunks so only one chunk is kept in memory.
+    """
+    writer = csv.writer(_EchoBuffer())
+    timestamp_field = DateTimeField()
+    yield writer.writerow(HISTORY_CSV_HEADER)
+    for obj in transactions.iterator_by_key(ordering):
+        yield writer.writerow(
+            [
+                obj.amount,
+                obj.balance_after,
+                obj.balance_before,
+                obj.id,
+                obj.recipient.name,
+                obj.sender.name if obj.sender else "",
+                timestamp_field.to_representation(obj.timestamp),
+                obj.transaction_type,
+                obj.wallet.name,
+            ]
+        )
+
+
+def idempotent(view_method):
+    """Decorator for view actions that makes repeated requests with the same 'Idempotency-Key' header return the stored
+    response of the first one without applying it again. Successful response is stored in the same database
+    transaction as the action's changes; if two requests with the same key race, the second one is rolled back by
+    the unique constraint and gets the stored response too. A cross-shard transfer whose credit fails after that
+    commit gets its error response stored instead. Requests without the header are handled as usual."""
+
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key or not request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field("key").max_length:
+            return Response(
+                {"detail": IDEMPOTENCY_KEY_TOO_LONG_ERROR},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        fingerprint = hashlib.sha256(
+            json.dumps(
+                [request.path, request.data], sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+        stored = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+        if stored is None:
+            try:
+                with ShardTransfer.track() as sagas:
+                    with sharding.atomic():
+                        response = view_method(self, request, *args, **kwargs)
+                        if status.is_success(response.status_code):
+                            stored = IdempotencyKey.objects.create(
+                                user=request.user,
+                                key=key,
+                                request_fingerprint=fingerprint,
+                                response_status=response.status_code,
+                                response_body=response.data,
+                            )
+                return _replace_with_saga_error(self, stored, sagas, response)
+            except IntegrityError:
+                stored = IdempotencyKey.objects.get(user=request.user, key=key)
+        if stored.request_fingerprint != fingerprint:
+            return Response(
+                {"detail": IDEMPOTENCY_KEY_REUSED_ERROR},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        response = Response(stored.response_body, status=stored.response_status)
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+    return wrapper
+
+
+def _replace_with_saga_error(view, stored, sagas, response):
+    """Sagas of cross-shard transfers made by the view are finished after the transaction with the stored response
+    commits. If the debit of one has been compensated, its error response is returned and stored for the key
+    instead. An unexpected error isn't stored: the key is deleted, so that a retry makes the transfer again, as the
+    sender has got the amount back."""
+    for saga in sagas:
+        try:
+            saga.raise_error()
+        except APIException as error:
+            response = view.handle_exception(error)
+            if stored is not None:
+                IdempotencyKey.objects.filter(pk=stored.pk).update(
+                    response_status=response.status_code,
+                    response_body=response.data,
+                )
+            return response
+        except Exception:
+            if stored is not None:
+                IdempotencyKey.objects.filter(pk=stored.pk).delete()
+            raise
+    return response
@@ -1,45 +1,104 @@
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema
 from rest_framework import filters, mixins, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import DateTimeField
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 from rest_framework_csv import renderers as r
 
+from . import sharding
+from .archive import MergedHistory
 from .documentation_stuff import (
+    GET_BALANCE_RESPONSE,
     GET_HISTORY_CSV_RESPONSE,
     GET_HISTORY_JSON_RESPONSE,
+    IDEMPOTENCY_KEY_PARAMETER,
     INSUFFICIENT_FUNDS_RESPONSE,
     MAKE_DEPOSIT_REQUEST,
     MAKE_TRANSFER_REQUEST,
+    MAKE_TRANSFERS_REQUEST,
+    MAKE_TRANSFERS_RESPONSE,
+    QUEUED_TRANSFER_RESPONSE,
     RECIPIENT_DOESNT_EXIST_RESPONSE,
     RECIPIENT_IS_SENDER_RESPONSE,
     TRANSACTION_NEGATIVE_ZERO_AMOUNT_RESPONSE,
     TRANSACTION_RESPONSE,
+    TRANSFER_STATUS_RESPONSE,
 )
+from .errors_exceptions import WALLET_NAME_TAKEN_ERROR
 from .filters import HistoryFilter
-from .models import TransactionReport, TransactionV2, Wallet
+from .metrics import count_operation
+from .middleware import query_stats
+from .models import (
+    ArchivedTransaction,
+    QueuedTransfer,
+    TransactionReport,
+    TransactionV2,
+    Wallet,
+)
+from .routers import in_current_context
 from .serializers import (
     DepositSerializer,
+    GetBalanceParamsSerializer,
     GetHistoryParamsSerializer,
     MakeTransferSerializer,
+    MakeTransfersSerializer,
+    QueuedTransferSerializer,
     ReportsSerializer,
     TransactionV2Serializer,
     WalletSerializer,
 )
-from .utils import TransactionsPagination, UserWalletPermission, WalletsPagination
+from .utils import (
+    ReplicaReadsMixin,
+    TransactionsCursorPagination,
+    TransactionsPagination,
+    UserWalletPermission,
+    WalletResolver,
+    WalletShardMixin,
+    WalletsPagination,
+    idempotent,
+    stream_history_csv,
+)
 
 
-class ReportsViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
+class ReportsViewSet(ReplicaReadsMixin, viewsets.GenericViewSet, mixins.ListModelMixin):
     permission_classes = [IsAdminUser]
+    replica_actions = ("list",)
     queryset = TransactionReport.objects.all()
     pagination_class = WalletsPagination
     serializer_class = ReportsSerializer
 
+    def get_queryset(self):
+        # reports are generated on the shard of their wallet
+        queryset = super().get_queryset()
+        if sharding.is_sharded():
+            return sharding.AllShards(queryset)
+        return queryset
+
+
+class QueryStatsView(APIView):
+    """Returns number of queries and DB time aggregated per endpoint by QueryStatsMiddleware in this process."""
+
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(responses={200: OpenApiTypes.OBJECT})
+    def get(self, request):
+        return Response(query_stats.snapshot())
+
 
 class WalletViewSet(
+    WalletShardMixin,
+    ReplicaReadsMixin,
     viewsets.GenericViewSet,
     mixins.CreateModelMixin,
     mixins.ListModelMixin,
@@ -51,6 +110,7 @@ class WalletViewSet(
     queryset = Wallet.objects.all()
     serializer_class = WalletSerializer
     lookup_field = "name"
+    replica_actions = ("list", "retrieve", "history", "export_history", "balance")
     pagination_class = WalletsPagination
     filter_backends = [filters.OrderingFilter]
     ordering_fields = ["name", "id", "balance"]
@@ -61,20 +121,41 @@ class WalletViewSet(
         """'list' action will return only those wallets that are owned by user."""
         if self.action == "list":
             user = self.request.user
-            return Wallet.objects.filter(holder=user)
+            return Wallet.objects.filter(holder=user).with_total_balance()
         elif (
             self.action == "retrieve"
             or self.action == "make_deposit"
             or self.action == "make_transfer"
+            or self.action == "make_transfers"
+            or self.action == "transfer_status"
             or self.action == "history"
+            or self.action == "export_history"
+            or self.action == "balance"
         ):
             return super().get_queryset()
 
+    @property
+    def wallets(self):
+        """Request-scoped WalletResolver shared by 'get_object', serializers and the actions."""
+        if not hasattr(self, "_wallets"):
+            self._wallets = WalletResolver()
+        return self._wallets
+
+    def get_object(self):
+        """Wallet lookup by name for detail actions goes through the wallet cache. The cache may be behind the
+        database only until 'on_commit' hooks of a write are done, and all balance changing actions lock and re-read
+        the wallet anyway."""
+        wallet = self.wallets.get(self.kwargs[self.lookup_field])
+        if wallet is None:
+            raise Http404
+        self.check_object_permissions(self.request, wallet)
+        return wallet
+
     def get_renderers(self):
         """Method to exclude 'CSVRenderer' from this view 'renderer_classes' for all actions except history.
-        - 'history' action returns response in csv by default
+        - 'history' and 'export_history' actions return response in csv by default
         - all other actions return JSON response by default"""
-        if self.action != "history":
+        if self.action not in ("history", "export_history"):
             return [
                 renderer()
                 for renderer in self.renderer_classes
@@ -84,11 +165,18 @@ class WalletViewSet(
             return super().get_renderers()
 
     def perform_create(self, serializer):
-        """To set current user as wallet's holder on it's creation"""
-        serializer.save(holder=self.request.user)
+        """To set current user as wallet's holder on it's creation. When wallets are sharded, the serializer checks
+        uniqueness of the name only on the shard of the user, the name may still be taken on another one."""
+        try:
+            serializer.save(holder=self.request.user)
+        except IntegrityError:
+            if not sharding.is_sharded():
+                raise
+            raise ValidationError({"name": [WALLET_NAME_TAKEN_ERROR]})
 
     @extend_schema(
         request=DepositSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={200: OpenApiTypes.OBJECT, 400: OpenApiTypes.OBJECT},
         examples=[
             MAKE_DEPOSIT_REQUEST,
@@ -97,28 +185,33 @@ class WalletViewSet(
         ],
     )
     @action(detail=True, methods=["post"], permission_classes=[UserWalletPermission])
+    @idempotent
+    @count_operation("deposit")
     def make_deposit(self, request, name=None):
         """Implements 'make_deposit' action on 'wallet' resource.
         Calls Wallet.make_deposit method using serializer's validated data."""
         serializer = DepositSerializer(data=request.data)
         wallet = self.get_object()
         if serializer.is_valid():
-            wallet.make_deposit(serializer.validated_data.get("amount"))
+            new_balance = wallet.make_deposit(serializer.validated_data.get("amount"))
             return Response(
-                {
-                    "transaction_status": "success",
-                    "new_balance": str(Wallet.objects.filter(name=name)[0].balance),
-                }
+                {"transaction_status": "success", "new_balance": str(new_balance)}
             )
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @extend_schema(
         request=MakeTransferSerializer,
-        responses={200: OpenApiTypes.OBJECT, 400: OpenApiTypes.OBJECT},
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={
+            200: OpenApiTypes.OBJECT,
+            202: QueuedTransferSerializer,
+            400: OpenApiTypes.OBJECT,
+        },
         examples=[
             MAKE_TRANSFER_REQUEST,
             TRANSACTION_RESPONSE,
+            QUEUED_TRANSFER_RESPONSE,
             TRANSACTION_NEGATIVE_ZERO_AMOUNT_RESPONSE,
             INSUFFICIENT_FUNDS_RESPONSE,
             RECIPIENT_IS_SENDER_RESPONSE,
@@ -126,21 +219,111 @@ class WalletViewSet(
         ],
     )
     @action(detail=True, methods=["post"], permission_classes=[UserWalletPermission])
+    @idempotent
+    @count_operation("transfer")
     def make_transfer(self, request, name=None):
         """Implements 'make_transfer' action on 'wallet' resource.
-        Makes additional validations and calls Wallet.make_transfer method using serializer's validated data."""
-        serializer = MakeTransferSerializer(data=request.data, context={"sender": name})
+        Makes additional validations and calls Wallet.make_transfer method using serializer's validated data.
+        If TRANSFER_QUEUE_ENABLED is set, a valid transfer is only queued and the response has 202 status, it's
+        applied later by an executor (see QueuedTransfer). Transfers to wallets on other shards are always made
+        right away."""
+        recipient_name = (
+            request.data.get("recipient") if isinstance(request.data, dict) else None
+        )
+        # sender and recipient are loaded together before any of them is needed
+        self.wallets.resolve(
+            name, *([recipient_name] if isinstance(recipient_name, str) else [])
+        )
+        serializer = MakeTransferSerializer(
+            data=request.data, context={"sender": name, "wallets": self.wallets}
+        )
         if serializer.is_valid():
             wallet = self.get_object()
             amount = serializer.validated_data.get("amount")
             recipient_name = serializer.validated_data.get("recipient")
-            recipient_id = Wallet.objects.filter(name=recipient_name)[0].id
-            wallet.make_transaction(amount=amount, recipient_id=recipient_id)
+            recipient = self.wallets.get(recipient_name)
+            if settings.TRANSFER_QUEUE_ENABLED and recipient.shard == wallet.shard:
+                queued = QueuedTransfer.objects.create(
+                    sender=wallet, recipient=recipient, amount=amount
+                )
+                return Response(
+                    QueuedTransferSerializer(queued).data,
+                    status=status.HTTP_202_ACCEPTED,
+                    headers={
+                        "Location": self.reverse_action(
+                            "transfer-status",
+                            kwargs={"name": name, "transfer_id": queued.id},
+                        )
+                    },
+                )
+            new_balance = wallet.make_transaction(
+                amount=amount, recipient_id=recipient.id
+            )
+            return Response(
+                {"transaction_status": "success", "new_balance": str(new_balance)}
+            )
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @extend_schema(
+        responses={200: QueuedTransferSerializer},
+        examples=[TRANSFER_STATUS_RESPONSE],
+    )
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"transfers/(?P<transfer_id>[0-9]+)",
+        url_name="transfer-status",
+        permission_classes=[UserWalletPermission],
+    )
+    def transfer_status(self, request, name=None, transfer_id=None):
+        """Implements 'transfer_status' action on 'wallet' resource to return the outcome of a transfer from the
+        wallet that was queued by 'make_transfer' action."""
+        wallet = self.get_object()
+        queued = get_object_or_404(
+            QueuedTransfer.objects.select_related("recipient"),
+            sender=wallet,
+            id=transfer_id,
+        )
+        return Response(QueuedTransferSerializer(queued).data)
+
+    @extend_schema(
+        request=MakeTransfersSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={200: OpenApiTypes.OBJECT, 400: OpenApiTypes.OBJECT},
+        examples=[MAKE_TRANSFERS_REQUEST, MAKE_TRANSFERS_RESPONSE],
+    )
+    @action(detail=True, methods=["post"], permission_classes=[UserWalletPermission])
+    @idempotent
+    @count_operation("transfer")
+    def make_transfers(self, request, name=None):
+        """Implements 'make_transfers' action on 'wallet' resource to apply a batch of transfers in one database
+        transaction. Calls Wallet.make_transactions method using serializer's validated data.
+            - Status is 'success' if all transfers were applied, 'partial' if some of them failed, 'failed' if none
+            - If 'all_or_nothing' is true and some transfer failed, nothing is applied and response status is 400"""
+        serializer = MakeTransfersSerializer(data=request.data)
+        if serializer.is_valid():
+            wallet = self.get_object()
+            all_or_nothing = serializer.validated_data.get("all_or_nothing")
+            results, new_balance = wallet.make_transactions(
+                serializer.validated_data.get("transfers"), all_or_nothing
+            )
+            failed = sum(result["transaction_status"] == "failed" for result in results)
+            if not failed:
+                transaction_status = "success"
+            elif failed == len(results) or all_or_nothing:
+                transaction_status = "failed"
+            else:
+                transaction_status = "partial"
             return Response(
                 {
-                    "transaction_status": "success",
-                    "new_balance": str(Wallet.objects.filter(name=name)[0].balance),
-                }
+                    "transaction_status": transaction_status,
+                    "new_balance": str(new_balance),
+                    "results": results,
+                },
+                status=status.HTTP_400_BAD_REQUEST
+                if all_or_nothing and failed
+                else status.HTTP_200_OK,
             )
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -157,6 +340,8 @@ class WalletViewSet(
         filter.
             - If 'HTTP_ACCEPT' header is 'application/json', returns JSON response
             - If 'HTTP_ACCEPT' header is '*/*' or 'text/csv', returns CSV response
+            - If 'pagination' parameter is 'cursor', pages are seeked by ('timestamp', 'id') of the previous page's
+            last row passed in 'cursor' parameter, see TransactionsCursorPagination
 
         Had to re-implement ordering for this action here and in GetHistoryParamsSerializer because this action
         requires Wallets model queryset from GenericViewSet.get_queryset(), and filters.OrderingFilter also uses
@@ -166,11 +351,9 @@ class WalletViewSet(
         serializer = GetHistoryParamsSerializer(data=request.query_params)
         self.renderer_classes = [JSONRenderer]
         if serializer.is_valid():
-            wallet_id = self.get_object().id
-            initial_queryset = TransactionV2.objects.filter(wallet=wallet_id)
-            transactions = HistoryFilter(
-                data=serializer.validated_data, queryset=initial_queryset
-            ).qs.order_by(serializer.validated_data.get("ordering", "-timestamp"))
+            if serializer.validated_data.get("pagination") == "cursor":
+                self.pagination_class = TransactionsCursorPagination
+            transactions = self.get_history_queryset(serializer.validated_data)
             if request.META.get("HTTP_ACCEPT") == "application/json":
                 return self.get_paginated_response(
                     TransactionV2Serializer(
@@ -188,3 +371,89 @@ class WalletViewSet(
                 serializer.errors,
                 status=status.HTTP_400_BAD_REQUEST,
             )
+
+    @extend_schema(
+        parameters=[GetHistoryParamsSerializer],
+        request=GetHistoryParamsSerializer,
+        responses={200: OpenApiTypes.STR},
+        examples=[GET_HISTORY_CSV_RESPONSE],
+    )
+    @action(detail=True, methods=["get"], permission_classes=[UserWalletPermission])
+    def export_history(self, request, name=None):
+        """Implements 'export_history' action on 'wallet' resource to stream all transactions that satisfy applied
+        filter as one CSV file, without pagination. Accepts the same parameters as 'history' action.
+        Rows are fetched and written in chunks, so memory usage doesn't depend on the number of exported rows."""
+        serializer = GetHistoryParamsSerializer(data=request.query_params)
+        if serializer.is_valid():
+            transactions = self.get_history_queryset(serializer.validated_data)
+            response = StreamingHttpResponse(
+                in_current_context(
+                    stream_history_csv(
+                        transactions,
+                        serializer.validated_data.get("ordering", "-timestamp"),
+                    )
+                ),
+                content_type="text/csv",
+            )
+            response["Content-Disposition"] = 'attachment; filename="{}.csv"'.format(
+                name
+            )
+            return response
+        else:
+            return Response(
+                serializer.errors,
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    def get_history_queryset(self, params):
+        """Transactions of the current wallet filtered and ordered by validated GetHistoryParamsSerializer data.
+        If the wallet has archived transactions and 'timestamp_after' doesn't exclude them, archived transactions
+        are read together with the hot ones, see MergedHistory."""
+        wallet = self.get_object()
+        ordering = params.get("ordering", "-timestamp")
+        transactions = HistoryFilter(
+            data=params,
+            queryset=TransactionV2.objects.filter(wallet=wallet.id).with_wallet_names(),
+        ).qs.order_by_key(ordering)
+        timestamp_after = params.get("timestamp_after")
+        if wallet.archived_until is None or (
+            timestamp_after is not None
+            and timestamp_after > timezone.localtime(wallet.archived_until).date()
+        ):
+            return transactions
+        archived = HistoryFilter(
+            data=params,
+            queryset=ArchivedTransaction.objects.filter(
+                wallet=wallet.id
+            ).with_wallet_names(),
+        ).qs
+        return MergedHistory(
+            transactions, archived, wallet.archived_until
+        ).order_by_key(ordering)
+
+    @extend_schema(
+        parameters=[GetBalanceParamsSerializer],
+        responses={200: OpenApiTypes.OBJECT, 400: OpenApiTypes.OBJECT},
+        examples=[GET_BALANCE_RESPONSE],
+    )
+    @action(detail=True, methods=["get"], permission_classes=[UserWalletPermission])
+    def balance(self, request, name=None):
+        """Implements 'balance' action on 'wallet' resource to return wallet's balance at the moment passed in 'at'
+        parameter, or current balance if it's omitted."""
+        serializer = GetBalanceParamsSerializer(data=request.query_params)
+        if serializer.is_valid():
+            wallet = self.get_object()
+            at = serializer.validated_data.get("at")
+            if at is None:
+                at, balance = timezone.now(), wallet.balance
+            else:
+                balance = wallet.balance_at(at)
+            return Response(
+                {
+                    "name": wallet.name,
+                    "at": DateTimeField().to_representation(at),
+                    "balance": str(balance),
+                }
+            )
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -11,10 +11,26 @@ then
     echo "PostgreSQL started"
 fi
 
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]
+then
+    # metrics of processes from the previous run must not be served
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 echo yes | python manage.py collectstatic
 python manage.py flush --no-input
 python manage.py makemigrations
 python manage.py migrate
 python manage.py migrate django_celery_results
 
+# shards of wallets get only their own tables, see api_basics.sharding
+shard=1
+for location in $(echo "$SQL_SHARDS" | tr "," " ")
+do
+    python manage.py flush --no-input --database "shard_$shard"
+    python manage.py migrate --database "shard_$shard"
+    shard=$((shard + 1))
+done
+
 exec "$@"
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+
+from prometheus_client import multiprocess
+
+bind = "0.0.0.0:8000"
+
+# ASGI=1 serves PilotProject.asgi with uvicorn workers, read endpoints of wallets are async views then
+if int(os.environ.get("ASGI", 0)):
+    wsgi_app = "PilotProject.asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "PilotProject.wsgi:application"
+    reload = True
+
+
+def child_exit(server, worker):
+    """Removes live gauge values of a dead worker from PROMETHEUS_MULTIPROC_DIR, see api_basics.metrics."""
+    multiprocess.mark_process_dead(worker.pid)